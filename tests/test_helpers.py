@@ -0,0 +1,373 @@
+"""
+不連網、不開視窗的純函式與小元件：網址整理與去重、下載紀錄、解析快取、音訊標頭、MP4 修復、限速、工作日誌。
+主程式檔名有連字號，照 spec 載入；canonical_url 需要 yt-dlp（沒裝時略過那幾項）。
+"""
+import importlib.util
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_spec = importlib.util.spec_from_file_location('video_download_gui', os.path.join(ROOT, 'video-download-gui.py'))
+vdg = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = vdg
+_spec.loader.exec_module(vdg)
+
+
+@pytest.fixture(scope='module')
+def ytdlp():
+    pytest.importorskip('yt_dlp')
+    vdg.YtDlpLoader.ensure()
+
+
+class _Job:
+    """BandwidthScheduler 只用到這幾個欄位。"""
+    def __init__(self, weight: float = 1.0):
+        self.priority_weight = weight
+        self.stop_flag = False
+        self.pause_flag = False
+
+
+# ---- canonical_url / dedupe_urls ----
+
+@pytest.mark.parametrize('raw', [
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'youtu.be/dQw4w9WgXcQ?si=abc&t=10',
+    'https://m.youtube.com/watch?v=dQw4w9WgXcQ&list=PLx&index=3',
+    'https://www.youtube.com/shorts/dQw4w9WgXcQ',
+    'https://music.youtube.com/watch?v=dQw4w9WgXcQ&feature=share',
+])
+def test_canonical_url_youtube(ytdlp, raw):
+    assert vdg.canonical_url(raw) == ('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'youtube dQw4w9WgXcQ')
+
+
+def test_canonical_url_keep_lists(ytdlp):
+    url, key = vdg.canonical_url('https://m.youtube.com/watch?v=dQw4w9WgXcQ&list=PLx', keep_lists=True)
+    assert url == 'https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLx'
+    assert key == 'youtubetab PLx'
+
+
+def test_canonical_url_twitter(ytdlp):
+    assert vdg.canonical_url('https://x.com/jack/status/20?s=20') == \
+        ('https://twitter.com/jack/status/20', 'twitter 20')
+
+
+def test_canonical_url_strips_tracking_only(ytdlp):
+    url, key = vdg.canonical_url('https://Example.com/v?id=3&utm_source=x&fbclid=1#top')
+    assert url == key == 'https://example.com/v?id=3'
+
+
+def test_canonical_url_bilibili_share_params(ytdlp):
+    plain = vdg.canonical_url('https://www.bilibili.com/video/BV1xx411c7mD')
+    shared = vdg.canonical_url('https://www.bilibili.com/video/BV1xx411c7mD?spm_id_from=333.1007&vd_source=abc')
+    assert shared == plain
+    # 分P 是不同內容，不能併掉
+    part = vdg.canonical_url('https://www.bilibili.com/video/BV1xx411c7mD?p=2&vd_source=abc')
+    assert part[0] == 'https://www.bilibili.com/video/BV1xx411c7mD?p=2'
+    assert part[1] != plain[1]
+
+
+def test_dedupe_urls(ytdlp):
+    seen = {'twitter 20': 'https://twitter.com/jack/status/20'}
+    unique, dropped = vdg.dedupe_urls([
+        'https://youtu.be/dQw4w9WgXcQ',
+        '',
+        '# 註解',
+        'https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=5',
+        'https://x.com/jack/status/20',
+        'https://example.com/a',
+        'https://example.com/a',
+    ], seen=seen)
+    assert unique == [('https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'youtube dQw4w9WgXcQ'),
+                      ('https://example.com/a', 'https://example.com/a')]
+    assert dropped == [('https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=5', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'),
+                       ('https://x.com/jack/status/20', 'https://twitter.com/jack/status/20'),
+                       ('https://example.com/a', 'https://example.com/a')]
+    assert seen['youtube dQw4w9WgXcQ'] == 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+def test_dedupe_urls_hints_match_full_scan(ytdlp):
+    urls = [f'https://vimeo.com/{i}' for i in range(100, 110)] + [f'https://example.com/v/{i}' for i in range(10)]
+    hints = {}
+    with_hints, _ = vdg.dedupe_urls(urls, hints=hints)
+    assert with_hints == [vdg.canonical_url(u) for u in urls]
+    assert 'vimeo.com' in hints
+
+
+# ---- BloomFilter / DownloadArchive ----
+
+def test_bloom_filter():
+    bloom = vdg.BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(f'youtube {i}')
+    assert all(f'youtube {i}' in bloom for i in range(1000))
+    false_hits = sum(f'vimeo {i}' in bloom for i in range(10000))
+    assert false_hits < 300      # 設計誤判率 1%
+
+
+def test_download_archive(tmp_path):
+    path = tmp_path / 'archive.txt'
+    path.write_text('youtube aaa\n\nyoutube bbb\n', encoding='utf-8')
+    archive = vdg.DownloadArchive(str(path))
+    assert archive.count == 2
+    assert 'youtube aaa' in archive and 'youtube ccc' not in archive
+    assert None not in archive
+    archive.add('youtube ccc')
+    archive.add('youtube ccc')
+    archive.add(None)
+    assert path.read_text(encoding='utf-8').split() == ['youtube', 'aaa', 'youtube', 'bbb', 'youtube', 'ccc']
+    assert 'youtube ccc' in vdg.DownloadArchive(str(path))
+
+
+def test_download_archive_without_exact_set(tmp_path, monkeypatch):
+    monkeypatch.setattr(vdg, 'ARCHIVE_SET_LIMIT', 2)
+    archive = vdg.DownloadArchive(str(tmp_path / 'archive.txt'))
+    for i in range(5):
+        archive.add(f'youtube {i}')
+    assert not archive._exact
+    assert all(f'youtube {i}' in archive for i in range(5))
+    assert 'youtube 5' not in archive
+    assert archive.count == 5
+
+
+# ---- ExtractionCache ----
+
+def test_extraction_cache_ttl(tmp_path, monkeypatch):
+    cache = vdg.ExtractionCache(str(tmp_path))
+    cache.put('https://example.com/v?id=1', {'id': '1', 'title': 't'}, ttl=60)
+    assert cache.get('https://example.com/v?id=1') == {'id': '1', 'title': 't'}
+    info, expires = cache.get('https://example.com/v?id=1', with_expiry=True)
+    assert info['id'] == '1' and expires > time.time()
+    cache.put('https://example.com/v?id=2', {'id': '2'}, ttl=0)
+    assert cache.get('https://example.com/v?id=2') is None
+
+    now = time.time()
+    monkeypatch.setattr(vdg.time, 'time', lambda: now + 61)
+    assert cache.get('https://example.com/v?id=1') is None
+    assert not [fn for fn in os.listdir(tmp_path) if fn.endswith('.json')]
+
+
+def test_extraction_cache_lru(tmp_path):
+    cache = vdg.ExtractionCache(str(tmp_path))
+    cache.put('https://example.com/a', {'id': 'a'}, ttl=60)
+    cache.max_bytes = int(cache._total * 2.5)
+    cache.put('https://example.com/b', {'id': 'b'}, ttl=60)
+    assert cache.get('https://example.com/a') is not None      # a 變成最近用過的
+    cache.put('https://example.com/c', {'id': 'c'}, ttl=60)
+    assert cache.get('https://example.com/b') is None
+    assert cache.get('https://example.com/a') == {'id': 'a'}
+    assert cache.get('https://example.com/c') == {'id': 'c'}
+
+
+def test_extraction_cache_never_persists_cookies(tmp_path):
+    info = {
+        'id': 'x',
+        'cookies': 'SESSDATA=secret-top',
+        'http_headers': {'Cookie': 'SESSDATA=secret-header', 'Referer': 'https://www.bilibili.com/'},
+        'formats': [{'format_id': 'f1', 'url': 'https://cdn/1', 'cookies': 'SESSDATA=secret-format',
+                     'http_headers': {'cookie': 'SESSDATA=secret-format-header'}}],
+        'requested_formats': [{'format_id': 'f1', 'cookies': 'SESSDATA=secret-requested'}],
+    }
+    original = json.dumps(info, sort_keys=True)
+    cache = vdg.ExtractionCache(str(tmp_path))
+    cache.put('https://www.bilibili.com/video/BV1xx411c7mD', info, ttl=60)
+
+    assert json.dumps(info, sort_keys=True) == original       # 呼叫端的 info 不被改
+    on_disk = ''.join((tmp_path / fn).read_text(encoding='utf-8') for fn in os.listdir(tmp_path))
+    assert 'secret' not in on_disk
+    cached = cache.get('https://www.bilibili.com/video/BV1xx411c7mD')
+    assert cached['http_headers'] == {'Referer': 'https://www.bilibili.com/'}
+    assert cached['formats'][0]['url'] == 'https://cdn/1'
+
+
+# ---- read_audio_header ----
+
+def test_read_audio_header_mp4(tmp_path):
+    path = tmp_path / 'a.m4a'
+    path.write_bytes(vdg.build_synthetic_mp4(200_000, 10.0, kbps=128))
+    codec, kbps, duration = vdg.read_audio_header(str(path))
+    assert codec == 'aac' and kbps == 128
+    assert duration == pytest.approx(10.0, abs=0.05)
+
+
+def test_read_audio_header_cbr_mp3(tmp_path):
+    frame = b'\xff\xfb\x90\x64' + b'\x00' * 413       # MPEG-1 Layer III、128 kbps、44.1 kHz
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(frame * 100)
+    codec, kbps, duration = vdg.read_audio_header(str(path))
+    assert (codec, kbps) == ('mp3', 128)
+    assert duration == pytest.approx(100 * 1152 / 44100, rel=0.01)
+
+
+def test_read_audio_header_flac(tmp_path):
+    fields = (44100 << 44) | (1 << 41) | (15 << 36) | 441000      # 44.1 kHz、雙聲道、16 bit、10 秒
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + fields.to_bytes(8, 'big') + b'\x00' * 16
+    path = tmp_path / 'a.flac'
+    path.write_bytes(b'fLaC\x80' + (34).to_bytes(3, 'big') + streaminfo + b'\x00' * 1000)
+    codec, _, duration = vdg.read_audio_header(str(path))
+    assert codec == 'flac'
+    assert duration == pytest.approx(10.0)
+
+
+def test_read_audio_header_unknown(tmp_path):
+    path = tmp_path / 'noise.bin'
+    path.write_bytes(bytes(range(256)) * 20)
+    assert vdg.read_audio_header(str(path)) is None
+    assert vdg.read_audio_header(str(tmp_path / 'missing.mp3')) is None
+
+
+# ---- _patch_chunk_offsets / fix_mp4_inplace ----
+
+def _top_level(data: bytes) -> dict:
+    return {kind: (body - 8, stop) for kind, body, stop in vdg._iter_mp4_boxes(data)}
+
+
+def _moov_at_end(faststart: bytes) -> bytes:
+    boxes = _top_level(faststart)
+    ftyp = faststart[slice(*boxes[b'ftyp'])]
+    moov = bytearray(faststart[slice(*boxes[b'moov'])])
+    mdat = faststart[slice(*boxes[b'mdat'])]
+    assert vdg._patch_chunk_offsets(moov, -len(moov))
+    return ftyp + mdat + bytes(moov)
+
+
+def _chunk_offsets(data: bytes) -> list:
+    offsets = []
+
+    def walk(start, end):
+        for kind, body, stop in vdg._iter_mp4_boxes(data, start, end):
+            if kind in vdg._MP4_CONTAINERS:
+                walk(body, stop)
+            elif kind == b'stco':
+                count = struct.unpack_from('>I', data, body + 4)[0]
+                offsets.extend(struct.unpack_from(f'>{count}I', data, body + 8))
+    walk(0, len(data))
+    return offsets
+
+
+def test_patch_chunk_offsets():
+    data = vdg.build_synthetic_mp4(50_000, 2.0)
+    start, stop = _top_level(data)[b'moov']
+    moov = bytearray(data[start:stop])
+    before = _chunk_offsets(bytes(moov))
+    assert vdg._patch_chunk_offsets(moov, 1000)
+    assert _chunk_offsets(bytes(moov)) == [o + 1000 for o in before]
+    assert not vdg._patch_chunk_offsets(bytearray(data[start:stop]), 0xFFFFFFFF)     # stco 溢位
+
+
+def test_fix_mp4_inplace_moves_moov(tmp_path):
+    faststart = vdg.build_synthetic_mp4(300_000, 5.0)
+    path = tmp_path / 'v.mp4'
+    path.write_bytes(_moov_at_end(faststart))
+    assert vdg.fix_mp4_inplace(str(path))
+    fixed = path.read_bytes()
+    assert fixed == faststart
+    mdat_start = _top_level(fixed)[b'mdat'][0]
+    assert _chunk_offsets(fixed) == [mdat_start + 8]
+
+
+def test_fix_mp4_inplace_leaves_faststart_alone(tmp_path):
+    data = vdg.build_synthetic_mp4(50_000, 2.0)
+    path = tmp_path / 'v.mp4'
+    path.write_bytes(data)
+    mtime = os.stat(path).st_mtime_ns
+    assert vdg.fix_mp4_inplace(str(path))
+    assert path.read_bytes() == data and os.stat(path).st_mtime_ns == mtime
+
+
+# ---- BandwidthScheduler ----
+
+def _feed(scheduler, job, total: int, chunk: int, name: str = 'a.part', start: int = 0):
+    for done in range(start, start + total + 1, chunk):
+        scheduler.consume(job, {'downloaded_bytes': done, 'tmpfilename': name})
+
+
+def test_bandwidth_unlimited_does_not_wait():
+    scheduler = vdg.BandwidthScheduler(None)
+    t0 = time.monotonic()
+    _feed(scheduler, _Job(), 50_000_000, 1_000_000)
+    assert time.monotonic() - t0 < 0.5
+
+
+def test_bandwidth_rate_limit():
+    scheduler = vdg.BandwidthScheduler(200_000)
+    job = _Job()
+    t0 = time.monotonic()
+    _feed(scheduler, job, 100_000, 10_000)
+    elapsed = time.monotonic() - t0
+    assert 0.35 < elapsed < 2.0
+
+
+def test_bandwidth_resume_baseline_is_free():
+    # 續傳時第一次回報的 downloaded_bytes 是 .part 裡已有的量，不算這次的用量
+    scheduler = vdg.BandwidthScheduler(100_000)
+    t0 = time.monotonic()
+    scheduler.consume(_Job(), {'downloaded_bytes': 50_000_000, 'tmpfilename': 'a.part'})
+    assert time.monotonic() - t0 < 0.2
+
+
+def test_bandwidth_stop_releases_waiter():
+    scheduler = vdg.BandwidthScheduler(1_000)
+    job = _Job()
+    scheduler.consume(job, {'downloaded_bytes': 0, 'tmpfilename': 'a.part'})
+    threading.Timer(0.2, lambda: setattr(job, 'stop_flag', True)).start()
+    t0 = time.monotonic()
+    scheduler.consume(job, {'downloaded_bytes': 1_000_000, 'tmpfilename': 'a.part'})
+    assert time.monotonic() - t0 < 2.0
+
+
+def test_bandwidth_weights_share_the_rate():
+    scheduler = vdg.BandwidthScheduler(400_000)
+    heavy, light = _Job(3.0), _Job(1.0)
+    got = {heavy: 0, light: 0}
+    deadline = time.monotonic() + 1.0
+
+    def run(job):
+        done = 0
+        scheduler.consume(job, {'downloaded_bytes': 0, 'tmpfilename': 'a.part'})
+        while time.monotonic() < deadline:
+            done += 4_000
+            scheduler.consume(job, {'downloaded_bytes': done, 'tmpfilename': 'a.part'})
+            got[job] = done
+
+    threads = [threading.Thread(target=run, args=(j,)) for j in (heavy, light)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert got[heavy] > 2 * got[light]
+
+
+# ---- JobJournal ----
+
+def test_job_journal_replay(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    lines = [
+        {'op': 'submit', 'id': 'a', 'time': 1, 'url': 'https://example.com/a', 'fmt_kind': 'mp4'},
+        {'op': 'submit', 'id': 'b', 'time': 2, 'url': 'https://example.com/b', 'fmt_kind': 'mp3'},
+        {'op': 'update', 'id': 'a', 'time': 3, 'state': 'paused', 'title': 'A'},
+        {'op': 'done', 'id': 'b', 'time': 4},
+        {'op': 'update', 'id': 'zzz', 'time': 5, 'state': 'paused'},
+    ]
+    path.write_text(''.join(json.dumps(rec) + '\n' for rec in lines) + '{"op": "done", "id": "a"',
+                    encoding='utf-8')
+    journal = vdg.JobJournal(str(path))
+    try:
+        expected = [{'id': 'a', 'state': 'paused', 'url': 'https://example.com/a', 'fmt_kind': 'mp4', 'title': 'A'}]
+        assert journal.pending == expected
+        # 重播後壓縮成只剩未完成的工作
+        compacted = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+        assert compacted == [dict(expected[0], op='submit')]
+
+        journal.append('update', 'a', state='downloading')
+        journal.append('submit', 'c', url='https://example.com/c')
+    finally:
+        journal.close()
+    reopened = vdg.JobJournal(str(path))
+    reopened.close()
+    assert [(rec['id'], rec['state']) for rec in reopened.pending] == [('a', 'downloading'), ('c', 'queued')]
@@ -1,13 +1,31 @@
-import tkinter as tk
-from tkinter import ttk, messagebox
+import time
+_PROCESS_T0 = time.time()      # 啟動量測（--startup-probe）的起點
+try:
+    import tkinter as tk
+    from tkinter import ttk, messagebox, filedialog
+except ImportError:      # 無圖形環境的伺服器只跑 --batch，不需要 Tk
+    tk = ttk = messagebox = filedialog = None
 import threading
+import itertools
+import collections
 import os
 import re
+import copy
+import json
+import hashlib
+import glob
+import uuid
+import atexit
+import math
+import io
+import mmap
+import struct
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse, parse_qs
-import yt_dlp
-from yt_dlp import utils as ydl_utils
 import shutil, subprocess
-import sys, signal
+import sqlite3
+import sys
 
 SITE_SPECIFIC_OPTS = {
     "twitcasting.tv": {"live_from_start": True},
@@ -30,6 +48,190 @@ SITE_SPECIFIC_OPTS = {
     "x.com": "twitter.com",
 }
 
+# extract_info 快取的存活秒數：簽名串流網址各站過期速度不同
+EXTRACT_CACHE_TTL = {
+    "youtube.com": 5 * 3600,
+    "youtu.be": "youtube.com",
+    "bilibili.com": 1800,
+    "twitter.com": 3600,
+    "x.com": "twitter.com",
+    "twitcasting.tv": 600,
+    "twitch.tv": 600,
+}
+DEFAULT_EXTRACT_CACHE_TTL = 1800
+
+# 播放清單同時「已排入但未完成」的子工作上限，也就是記憶體裡最多同時存在的已解析 info 數
+PLAYLIST_MAX_IN_FLIGHT = 8
+
+# 進度列每秒最多重繪幾次
+PROGRESS_FPS = 10
+
+# HLS/DASH 分片並行數：自適應調整的上下限與起始值
+FRAGMENT_CONCURRENCY_MIN = 1
+FRAGMENT_CONCURRENCY_MAX = 16
+FRAGMENT_CONCURRENCY_START = 4
+# 每累積幾個分片評估一次是否加減並行數
+FRAGMENT_WINDOW = 8
+# HTTP 請求與單一分片的重試次數（同 yt-dlp 命令列預設；以 API 呼叫時預設完全不重試，一次 503 就丟分片）
+DOWNLOAD_RETRIES = 10
+# HLS 簽名清單過期時，連續幾次重新取得清單都沒有新進度才放棄、改用非 HLS 格式
+HLS_REFRESH_ATTEMPTS = 3
+
+# 全域頻寬：所有進行中的工作共用一個 token bucket；桶容量為幾秒份的額度，
+# HTTP 每次讀取的固定區塊（yt-dlp 預設會自動放大到 4 MiB，限速時一次就超額太多），
+# 「優先」工作的權重（一般為 1）
+BANDWIDTH_BURST = 0.25
+BANDWIDTH_BLOCK = 256 * 1024
+PRIORITY_WEIGHT = 4
+
+# 挑格式：合併輸出容器可直接封裝（不重新編碼）的影音編碼，以 yt-dlp 的 vcodec/acodec 開頭比對；
+# 不在表中的容器（如 mkv）不限。音訊至少取到這個位元率（來源最高不到就取最高），不為了省空間犧牲音質。
+MERGE_CODECS = {
+    'mp4': (('avc1', 'avc3', 'h264', 'hev1', 'hvc1', 'h265', 'av01', 'vp09', 'vp9'),
+            ('mp4a', 'aac', 'opus')),
+    'webm': (('vp8', 'vp09', 'vp9', 'av01'), ('opus', 'vorbis')),
+}
+FORMAT_MIN_AUDIO_KBPS = 128
+# 依此站實測吞吐量估計下載時間超過影片長度的這個倍數時，往下一級解析度找下載得完的組合，
+# 但不低於 FORMAT_MIN_STEP_HEIGHT；沒有實測值（第一次連這個站、也沒限速）時不降
+FORMAT_MAX_REALTIME = 3.0
+FORMAT_MIN_STEP_HEIGHT = 720
+
+# 抽音訊：無損編碼（目標是這些而來源有損時不轉，只換容器），與轉 MP3 時可用的標準位元率（不超過來源）
+LOSSLESS_ACODECS = ('flac', 'alac', 'wav')
+MP3_BITRATES = (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+
+# 輸出目錄（<網域>_<格式>）旁的下載紀錄資料庫
+CATALOG_FILE = "download_catalog.sqlite3"
+
+# 每個工作結束時的時間軸與統計（JSON lines，一行一個工作）
+METRICS_FILE = "job_metrics.jsonl"
+
+# 工作日誌（預寫、只附加）：重新開啟時恢復上次沒做完的工作；每隔幾秒批次 fsync 一次
+JOURNAL_FILE = "job_journal.jsonl"
+JOURNAL_FSYNC_INTERVAL = 0.5
+# 續傳紀錄（也會寫進工作日誌）只留這些欄位：不含字幕、縮圖、說明；cookies 另由 strip_cookies 拿掉
+RESUME_INFO_FIELDS = ('id', 'title', 'extractor', 'extractor_key', 'webpage_url', 'duration')
+RESUME_FORMAT_FIELDS = ('format_id', 'url', 'manifest_url', 'protocol', 'ext', 'http_headers',
+                        'fragments', 'fragment_base_url', 'vcodec', 'acodec', 'abr', 'tbr', 'asr',
+                        'width', 'height', 'fps', 'filesize', 'filesize_approx')
+
+# 已下載清單（yt-dlp --download-archive 格式，每種輸出格式一份）；
+# 超過 ARCHIVE_SET_LIMIT 筆就不再整份放記憶體，只留 Bloom filter，命中時才回頭讀檔確認
+ARCHIVE_FILE = "download_archive_{fmt}.txt"
+ARCHIVE_SET_LIMIT = 1_000_000
+ARCHIVE_BLOOM_ERROR = 0.01
+
+# 後製程序池：預設與 CPU 核心數相同；佇列上限為程序數的幾倍（滿了就擋住下載端）
+POSTPROCESS_WORKERS = os.cpu_count() or 1
+POSTPROCESS_QUEUE_FACTOR = 2
+
+# 直播中止：送 'q' 給 ffmpeg 後最多等幾秒讓它寫完檔尾，逾時才強制結束
+LIVE_STOP_GRACE = 10
+
+# MP4 faststart：原地搬移 moov 時每次 memmove 的區塊大小
+FASTSTART_CHUNK = 64 * 1024 * 1024
+
+# 啟動量測：--startup-benchmark 預設重複啟動幾次
+STARTUP_BENCHMARK_RUNS = 5
+
+# 離線基準測試（--benchmark）：合成媒體的大小與長度、HLS/DASH 切成幾段、每個情境跑幾次
+BENCHMARK_MEDIA_MB = 32
+BENCHMARK_MEDIA_SECONDS = 60
+BENCHMARK_SEGMENTS = 16
+BENCHMARK_RUNS = 3
+
+# yt-dlp 在 YtDlpLoader 載入完成前都是 None（import 連同擷取器註冊表要好幾百毫秒）
+yt_dlp = ydl_utils = gen_extractor_classes = _TrackedCookieJar = None
+
+
+class YtDlpLoader:
+    """
+    延後載入 yt-dlp：視窗先畫出來，import 與擷取器暖機（編譯所有網址樣式、建一次 YoutubeDL）
+    放到背景執行緒，使用者貼網址的同時就做完。用到 yt-dlp 的地方先呼叫 ensure()，
+    尚未載入完才會等；批次模式與後製子程序也走同一條路。
+    """
+    _lock = threading.Lock()
+    _done = threading.Event()
+    _thread = None
+    error = None
+    ready_at = None         # 載入完成的 time.time()，給啟動量測用
+
+    @classmethod
+    def start(cls):
+        with cls._lock:
+            if cls._thread is None and not cls._done.is_set():
+                cls._thread = threading.Thread(target=cls._load, name="yt-dlp-warmup", daemon=True)
+                cls._thread.start()
+
+    @classmethod
+    def ready(cls) -> bool:
+        return cls._done.is_set()
+
+    @classmethod
+    def ensure(cls):
+        """
+        阻塞到 yt-dlp 可用；背景載入失敗時把同一個錯誤丟給呼叫端。
+        """
+        if not cls._done.is_set():
+            cls.start()
+            cls._done.wait()
+        if cls.error is not None:
+            raise cls.error
+
+    @classmethod
+    def _load(cls):
+        global yt_dlp, ydl_utils, gen_extractor_classes, _TrackedCookieJar
+        try:
+            import yt_dlp as _yt_dlp
+            from yt_dlp import utils as _utils
+            from yt_dlp.extractor import gen_extractor_classes as _gen
+            from yt_dlp.cookies import YoutubeDLCookieJar
+
+            class _TrackedCookieJar(YoutubeDLCookieJar):
+                """
+                記錄載入後有沒有被網站改過，沒改過就不必每個工作結束都重寫一次 cookies.txt。
+                """
+                changed = False
+
+                def set_cookie(self, cookie):
+                    super().set_cookie(cookie)
+                    self.changed = True
+
+                def clear(self, *args):
+                    super().clear(*args)
+                    self.changed = True
+
+            yt_dlp, ydl_utils, gen_extractor_classes = _yt_dlp, _utils, _gen
+            # 暖機：第一次比對網址時才編譯各擷取器的 _VALID_URL，這裡先全部編好
+            for ie in gen_extractor_classes():
+                ie.suitable('https://example.com/')
+            yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True})
+        except Exception as e:
+            cls.error = e
+        finally:
+            cls.ready_at = time.time()
+            cls._done.set()
+
+def host_matches(netloc: str, key: str) -> bool:
+    """
+    嚴格比對站點：完全相等或以 .key 結尾（支援子網域）
+    """
+    net = (netloc or "").split(":", 1)[0].lower()
+    k = (key or "").lower()
+    return net == k or net.endswith("." + k)
+
+def lookup_site(table: dict, netloc: str, default=None):
+    """
+    在 SITE_SPECIFIC_OPTS 這類表中找出符合 netloc 的項目，字串值視為別名。
+    """
+    for key, value in table.items():
+        if host_matches(netloc, key):
+            if isinstance(value, str):
+                value = table[value]
+            return value
+    return default
+
 def normalize_url(url: str) -> str:
     url = url.strip()
     if not url:
@@ -50,6 +252,144 @@ def normalize_url(url: str) -> str:
             return f"https://www.youtube.com/watch?v={qs['v'][0]}" + (f"&{rest}" if rest else '')
     return url
 
+def url_archive_id(url: str, hints: dict | None = None) -> str | None:
+    """
+    不連網、只從網址推出封存鍵（「extractor id」，與 yt-dlp 下載封存相同）。
+    YouTube 沿用 normalize_url 對 youtu.be / shorts / watch?v= 的整理；其他站用擷取器的網址樣式。
+    逐一比對上千個擷取器一次約 8 ms。大量匯入時傳入 hints（網域 → 先前比中的擷取器），
+    同網域先試這幾個；整個掃過都沒有對應擷取器的網域記成 None，之後直接回傳 None（以網址本身去重）。
+    """
+    parsed = urlparse(normalize_url(url))
+    if host_matches(parsed.netloc, 'youtube.com') and parsed.path == '/watch':
+        qs = parse_qs(parsed.query)
+        if 'list' in qs:        # 帶清單的網址會展開整個播放清單，不能只看 v
+            return None
+        vid = qs.get('v', [None])[0]
+        return ydl_utils.make_archive_id('Youtube', vid) if vid else None
+    host = parsed.netloc.lower()
+    if hints is not None:
+        for ie in hints.get(host) or ():
+            if ie is None:
+                return None
+            if ie.suitable(url):
+                temp_id = ie.get_temp_id(url)
+                return ydl_utils.make_archive_id(ie.ie_key(), temp_id) if temp_id else None
+    for ie in gen_extractor_classes():
+        if ie.ie_key() == 'Generic':
+            continue
+        if ie.suitable(url):
+            if hints is not None:
+                hints.setdefault(host, []).append(ie)
+            temp_id = ie.get_temp_id(url)
+            return ydl_utils.make_archive_id(ie.ie_key(), temp_id) if temp_id else None
+    if hints is not None:
+        hints.setdefault(host, [None])
+    return None
+
+YOUTUBE_ID_RE = re.compile(r'^[0-9A-Za-z_-]{11}$')
+TWEET_PATH_RE = re.compile(r'^/(i/web|[^/]+)/status(?:es)?/(\d+)')
+# 一般網站只去掉這些分享／廣告追蹤參數，其餘參數可能影響內容，保留
+URL_TRACKING_PARAMS = {'fbclid', 'gclid', 'igshid', 'mc_cid', 'mc_eid', 'si'}
+# 各站自己的分享／來源參數（在別站可能有意義，只對該站去掉），格式同 SITE_SPECIFIC_OPTS
+SITE_TRACKING_PARAMS = {
+    "bilibili.com": {'spm_id_from', 'vd_source', 'from_spmid', 'share_source', 'share_medium',
+                     'share_plat', 'share_session_id', 'share_tag', 'share_from', 'unique_k',
+                     'bbid', 'ts', 'timestamp', 'buvid', 'mid', 'up_id', 'plat_id', 'is_story_h5',
+                     'from', 'seid', 't'},
+}
+
+def canonical_url(url: str, keep_lists: bool = False, hints: dict | None = None) -> tuple:
+    """
+    匯入用：網址 → (要下載的網址, 去重鍵)，不連網。
+    YouTube 的 youtu.be / shorts / live / embed、m. 與 music. 網域、&t= &si= &list= 等尾巴都收斂成 watch?v=ID
+    （匯出清單裡帶 &list= 的是單支影片）；keep_lists 時保留 &list=，照舊下載整個播放清單，鍵為清單 ID。
+    Twitter / X 收斂成 twitter.com/…/status/ID；其他站去掉追蹤參數（通用的與 SITE_TRACKING_PARAMS 裡該站的），
+    剩下的參數可能指向不同內容（例如 bilibili 的 ?p= 分P），有參數就以網址本身當鍵，沒有才用 url_archive_id。
+    """
+    url = url.strip()
+    parsed = urlparse(url if '://' in url else 'https://' + url)
+    host = parsed.netloc.lower().split(':', 1)[0]
+    vid = None
+    if host_matches(host, 'youtu.be'):
+        vid = parsed.path.strip('/').split('/')[0]
+    elif host_matches(host, 'youtube.com') or host_matches(host, 'youtube-nocookie.com'):
+        parts = parsed.path.strip('/').split('/')
+        if parts[0] == 'watch':
+            vid = parse_qs(parsed.query).get('v', [None])[0]
+        elif parts[0] in ('shorts', 'live', 'embed', 'v') and len(parts) > 1 and parts[1] != 'videoseries':
+            vid = parts[1]
+    if vid and YOUTUBE_ID_RE.match(vid):
+        playlist = parse_qs(parsed.query).get('list', [None])[0] if keep_lists else None
+        if playlist:
+            return (f'https://www.youtube.com/watch?v={vid}&list={playlist}',
+                    ydl_utils.make_archive_id('YoutubeTab', playlist))
+        return f'https://www.youtube.com/watch?v={vid}', ydl_utils.make_archive_id('Youtube', vid)
+    if host_matches(host, 'twitter.com') or host_matches(host, 'x.com'):
+        m = TWEET_PATH_RE.match(parsed.path)
+        if m:
+            return (f'https://twitter.com/{m.group(1)}/status/{m.group(2)}',
+                    ydl_utils.make_archive_id('Twitter', m.group(2)))
+    if not host:
+        return url, url
+    noise = URL_TRACKING_PARAMS | lookup_site(SITE_TRACKING_PARAMS, host, set())
+    query = '&'.join(kv for kv in parsed.query.split('&')
+                     if kv and not kv.split('=', 1)[0].lower().startswith('utm_')
+                     and kv.split('=', 1)[0].lower() not in noise)
+    canon = normalize_url(parsed._replace(netloc=parsed.netloc.lower(), query=query, fragment='').geturl())
+    return canon, (None if query else url_archive_id(canon, hints)) or canon
+
+def dedupe_urls(raw_urls, seen: dict | None = None, keep_lists: bool = False,
+                hints: dict | None = None) -> tuple:
+    """
+    匯入去重：每筆整理成 (網址, 去重鍵)，鍵第一次出現才保留，一趟 O(n)；完全相同的字串不重算。
+    seen 為已在佇列中的 鍵 → 網址（會被更新）；keep_lists 見 canonical_url，hints 見 url_archive_id（預設每次新建）。
+    上千筆非 YouTube / Twitter 的網址仍可能要數秒，GUI 在背景執行緒呼叫。
+    回傳 ([(網址, 鍵), …], 略過的 [(原始網址, 重複的那個網址), …])。
+    """
+    seen = {} if seen is None else seen
+    hints = {} if hints is None else hints
+    memo = {}
+    unique, dropped = [], []
+    for raw in raw_urls:
+        raw = raw.strip()
+        if not raw or raw.startswith('#'):
+            continue
+        if raw not in memo:
+            memo[raw] = canonical_url(raw, keep_lists, hints)
+        url, key = memo[raw]
+        if key in seen:
+            dropped.append((raw, seen[key]))
+            continue
+        seen[key] = url
+        unique.append((url, key))
+    return unique, dropped
+
+def strip_cookies(info):
+    """
+    yt-dlp 會把 cookie jar 的內容填進每個格式的 cookies 欄位與 http_headers 的 Cookie。
+    寫到磁碟（解析快取、續傳紀錄／工作日誌）前拿掉，回傳副本（含 formats、requested_formats、entries），原 info 不動。
+    讀回來的 info 沒有 cookies，process_ie_result 就不會把過期的 cookie 灌回共用的 cookie jar。
+    """
+    if not isinstance(info, dict):
+        return info
+    out = {k: v for k, v in info.items() if k != 'cookies'}
+    if isinstance(out.get('http_headers'), dict):
+        out['http_headers'] = {k: v for k, v in out['http_headers'].items() if k.lower() != 'cookie'}
+    for key in ('formats', 'requested_formats', 'entries'):
+        if isinstance(out.get(key), list):
+            out[key] = [strip_cookies(f) for f in out[key]]
+    return out
+
+def info_archive_id(info: dict) -> str | None:
+    """
+    由抽取結果（或播放清單 flat 項目的 ie_key/id）組封存鍵。
+    Generic 的 id 只是檔名，不同網站很容易撞名，不列入。
+    """
+    extractor = info.get('extractor_key') or info.get('ie_key')
+    if extractor and extractor != 'Generic' and info.get('id'):
+        return ydl_utils.make_archive_id(extractor, info['id'])
+    return None
+
 ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')   
 
 def strip_ansi(txt: str) -> str:
@@ -58,444 +398,2629 @@ def strip_ansi(txt: str) -> str:
     """
     return ANSI_RE.sub('', txt)
 
-class YTDownloaderGUI(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        self.title("Video Downloader")
-        self.geometry("560x320")
-        self.resizable(False, False)
-        self.paused = False              
-        self.pause_flag = False          
-        self.current_url = None          
-        self.stop_flag = False           
-        self.last_filename = None        
-        self.source_bitrate_kbps = None  
-        self.ffprobe_warned = False      
-        self.live_proc = None
-
-        ttk.Label(self, text="影片 / 播放清單 URL:").pack(pady=(20, 5), anchor="w", padx=20)
-        self.url_var = tk.StringVar()
-        ttk.Entry(self, textvariable=self.url_var, width=75).pack(padx=20)
+def parse_rate_limit(value: str) -> int | None:
+    """
+    限速設定（MB/s 字串）→ bytes/s；空字串或 0 回傳 None（不限速），非正數丟 ValueError。
+    """
+    value = (value or "").strip()
+    if not value or value == "0":
+        return None
+    mbps = float(value)
+    if mbps <= 0:
+        raise ValueError(value)
+    return int(mbps * 1024 * 1024)
 
-        self.format_var = tk.StringVar(value="mp4")
-        fmt_frame = ttk.Frame(self)
-        fmt_frame.pack(pady=10, anchor="w", padx=20)
-        ttk.Label(fmt_frame, text="下載格式:").pack(side="left")
-        ttk.Radiobutton(fmt_frame, text="MP4 (影片)", variable=self.format_var, value="mp4").pack(side="left", padx=5)
-        ttk.Radiobutton(fmt_frame, text="MP3 (音檔)", variable=self.format_var, value="mp3").pack(side="left")
-        ttk.Radiobutton(fmt_frame, text="FLAC (無損音檔)", variable=self.format_var, value="flac").pack(side="left", padx=5)
+def split_output_kinds(kinds) -> tuple:
+    """
+    要的輸出格式 → (實際下載的格式, 其餘從本機檔案產出的格式)。要 mp4 就下載影片，音檔都從影片抽。
+    """
+    kinds = list(dict.fromkeys(kinds))
+    primary = "mp4" if "mp4" in kinds else kinds[0]
+    return primary, tuple(k for k in kinds if k != primary)
 
-        q_frame = ttk.Frame(self)
-        q_frame.pack(pady=(0, 5), anchor="w", padx=20)
+def format_size(num) -> str:
+    """
+    bytes → 人類可讀字串（1024 進位，與 yt-dlp 顯示一致）。
+    """
+    if num is None:
+        return "N/A"
+    num = float(num)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(num) < 1024.0:
+            return f"{num:.0f}{unit}" if unit == "B" else f"{num:.2f}{unit}"
+        num /= 1024.0
+    return f"{num:.2f}TiB"
 
-        ttk.Label(q_frame, text="畫質:").pack(side="left")
-        self.quality_var = tk.StringVar(value="原片最高")
-        q_choices = ["360p", "480p", "720p", "1080p", "1440p", "4k", "原片最高"]
-        ttk.Combobox(q_frame, textvariable=self.quality_var,
-                     values=q_choices, width=10, state="readonly"
-                     ).pack(side="left", padx=5)
+def format_eta(seconds) -> str:
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    h, rem = divmod(seconds, 3600)
+    m, sec = divmod(rem, 60)
+    return f"{h}:{m:02d}:{sec:02d}" if h else f"{m:02d}:{sec:02d}"
 
-        pass_frame = ttk.Frame(self)
-        pass_frame.pack(pady=(5, 0), anchor="w", padx=20)
-        self.need_pass_var = tk.BooleanVar(value=False)
-        ttk.Checkbutton(pass_frame, text="需要密碼", variable=self.need_pass_var, command=self.toggle_password).pack(side="left")
-        self.pass_var = tk.StringVar()
-        self.pass_entry = ttk.Entry(pass_frame, textvariable=self.pass_var, width=25, state="disabled")
-        self.pass_entry.pack(side="left", padx=5)
+def format_progress(downloaded, total, speed, eta):
+    """
+    由 hook 的原始數值（bytes、bytes/s、秒）組出 (百分比, 總大小, 速度, ETA) 四段字串。
+    """
+    pct = f"{downloaded * 100.0 / total:5.1f}%" if downloaded is not None and total else "  N/A%"
+    speed_s = f"{format_size(speed)}/s" if speed else "N/A"
+    return pct.strip(), format_size(total), speed_s, format_eta(eta)
 
-        rate_frame = ttk.Frame(self)
-        rate_frame.pack(pady=(5, 0), anchor="w", padx=20)
+def format_stage_depths(d: dict) -> str:
+    """
+    DownloadEngine.stage_depths() → 一行「下載／後製」佇列摘要。
+    """
+    text = f"下載：{d['download_running']} 進行／{d['download_pending']} 排隊　" \
+           f"後製：{d['post_running']} 進行／{d['post_pending']} 排隊"
+    if d['post_blocked']:
+        text += f"（{d['post_blocked']} 個下載等後製）"
+    return text
 
-        ttk.Label(rate_frame, text="限速:").pack(side="left")
 
-        self.rate_choice_var = tk.StringVar(value="0")       
-        choices = [str(i) for i in range(1, 11)] + ["自訂"]
-        self.rate_combo = ttk.Combobox(
-            rate_frame, textvariable=self.rate_choice_var,
-            values=choices, width=5, state="readonly"
-        )
-        self.rate_combo.pack(side="left", padx=(0, 5))
-        self.rate_combo.bind("<<ComboboxSelected>>", self.toggle_custom_rate)
+class ProgressAggregator:
+    """
+    下載執行緒的 _hook 只把每個工作「最新」的數值狀態丟進來，不碰 Tk；
+    UI 以 PROGRESS_FPS 的頻率一次取走，同一幀內的多次更新只留最後一筆。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
 
-        self.custom_rate_var = tk.StringVar()
-        self.custom_rate_entry = ttk.Entry(
-            rate_frame, textvariable=self.custom_rate_var,
-            width=8, state="disabled"
-        )
-        self.custom_rate_entry.pack(side="left")
-        ttk.Label(rate_frame, text="MB/s (0代表全速)").pack(side="left")
+    def update(self, job, downloaded, total, speed, eta):
+        with self._lock:
+            self._latest[job.id] = (job, downloaded, total, speed, eta)
 
-        btn_frame = ttk.Frame(self)
-        btn_frame.pack(pady=15)
+    def discard(self, job):
+        """
+        工作改為顯示一般狀態文字時，丟掉還沒畫出的舊進度，避免蓋掉新狀態。
+        """
+        with self._lock:
+            self._latest.pop(job.id, None)
 
-        ttk.Button(btn_frame, text="開始下載",
-                   command=self.start_download_thread).pack(side="left", padx=6)
+    def drain(self) -> list:
+        with self._lock:
+            items = list(self._latest.values())
+            self._latest.clear()
+        return items
 
-        self.pause_btn = ttk.Button(btn_frame, text="暫停",
-                                    command=self.toggle_pause,
-                                    state="disabled")
-        self.pause_btn.pack(side="left", padx=6)
 
-        self.stop_btn = ttk.Button(
-            btn_frame, text="中止",
-            command=self.stop_download,
-            state="disabled"
-        )
-        self.stop_btn.pack(side="left", padx=6)
-        
-        self.status_text = tk.Text(self, height=1, width=60,
-                                   bd=0, relief="flat",
-                                   bg=self.cget("bg"),          
-                                   state="disabled")
-        self.status_text.pack(pady=3)
+class FragmentConcurrency:
+    """
+    依分片吞吐量與錯誤/429 比例調整每個工作的 concurrent_fragment_downloads（加法增、乘法減）。
+    - 每 FRAGMENT_WINDOW 個分片評估一次：遇到 429 減半、錯誤率 >10% 減一、吞吐量仍在成長就加一
+    - yt-dlp 在每個格式開始下載時才讀取並行數，所以調整會套用到同一工作的下一個格式（影/音分軌）
+    - 每個站點記住最後收斂的值，同站的新工作直接從這裡起跳
+    """
+    def __init__(self, min_n: int = FRAGMENT_CONCURRENCY_MIN,
+                 max_n: int = FRAGMENT_CONCURRENCY_MAX,
+                 start: int = FRAGMENT_CONCURRENCY_START):
+        self.min_n = min_n
+        self.max_n = max(min_n, max_n)
+        self.start = min(max(start, min_n), self.max_n)
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._jobs = {}
 
-        self.title_var = tk.StringVar(value="")
-        ttk.Label(self, textvariable=self.title_var,
-                  font=("Helvetica", 10, "bold")).pack(pady=(2, 0))
+    def initial(self, job) -> int:
+        host = urlparse(job.url).netloc.lower().split(":", 1)[0]
+        with self._lock:
+            n = self._hosts.get(host, self.start)
+            self._jobs[job.id] = {
+                "host": host, "n": n, "frag": None, "frags": 0, "errors": 0,
+                "throttled": False, "t0": time.monotonic(), "b0": 0, "bytes": 0, "tput": None,
+            }
+        return n
 
-        self.status_text.tag_config("white",  foreground="#202020")
-        self.status_text.tag_config("blue",   foreground="blue")
-        self.status_text.tag_config("green",  foreground="green")
-        self.status_text.tag_config("yellow", foreground="orange")   
+    def current(self, job) -> int:
+        with self._lock:
+            st = self._jobs.get(job.id)
+            return st["n"] if st else self.start
 
-    def toggle_pause(self):
+    def record_error(self, job, throttled: bool = False):
+        with self._lock:
+            st = self._jobs.get(job.id)
+            if st:
+                st["errors"] += 1
+                st["throttled"] = st["throttled"] or throttled
+
+    def record_progress(self, job, d: dict):
         """
-        yt-dlp 的續傳依賴 .part 檔與伺服器 Range 支援，部分來源或直播在「暫停→續傳」未必成功。
-        若處於後製（postprocessors，例如轉檔/嵌圖）階段，按「暫停」無法保證狀態回復。
+        由 progress hook 呼叫；回傳新的並行數（有變動時），否則 None。
         """
-        if not self.current_url:     
-            return
-        if self.paused:              
-            self.paused = False
-            self.pause_btn.config(text="暫停")
-            self._update_status("重新續傳…")
-            threading.Thread(target=self.download,     
-                             args=(self.current_url,), daemon=True).start()
-        else:                        
-            self.pause_flag = True   
-            self.pause_btn.config(state="disabled")    
+        frag = d.get("fragment_index")
+        if frag is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            st = self._jobs.get(job.id)
+            if st is None:
+                return None
+            downloaded = d.get("downloaded_bytes") or 0
+            if st["frag"] is None or downloaded < st["bytes"]:
+                # 新的格式（或第一次）：重設量測視窗
+                st.update(frag=frag, frags=0, errors=0, throttled=False, t0=now, b0=downloaded)
+            elif frag != st["frag"]:
+                st["frags"] += max(1, frag - st["frag"])
+                st["frag"] = frag
+            st["bytes"] = downloaded
+            if st["frags"] < FRAGMENT_WINDOW:
+                return None
 
-    def stop_download(self):
-        if not self.current_url:
-            return
+            elapsed = max(now - st["t0"], 1e-3)
+            tput = (downloaded - st["b0"]) / elapsed
+            n = st["n"]
+            if st["throttled"]:
+                n = max(self.min_n, n // 2)
+            elif st["errors"] * 10 > st["frags"]:
+                n = max(self.min_n, n - 1)
+            elif st["tput"] is None or tput > st["tput"] * 1.1:
+                n = min(self.max_n, n + 1)
+            changed = n != st["n"]
+            st.update(n=n, frags=0, errors=0, throttled=False, t0=now, b0=downloaded, tput=tput)
+            self._hosts[st["host"]] = n
+            return n if changed else None
 
-        if self.live_proc and self.live_proc.poll() is None:
-            try:
-                self._kill_live_proc_tree(self.live_proc, polite_timeout=3.0)
-            finally:
-                
-                self.live_proc = None
-                self._update_status("已中止（直播錄製已強制停止）。")
-                self.pause_btn.config(state="disabled")
-                self.stop_btn.config(state="disabled")
-                self.current_url = None
-                self.paused = False
-            return
+    def forget(self, job):
+        with self._lock:
+            self._jobs.pop(job.id, None)
 
-        self.stop_flag = True
-        self.stop_btn.config(state="disabled")
 
-    def toggle_password(self):
-        state = "normal" if self.need_pass_var.get() else "disabled"
-        self.pass_entry.configure(state=state)
+class FormatScorer:
+    """
+    在畫質上限內挑總位元組最少的影音組合，取代固定的「mp4+m4a」格式字串：
+    - 先鎖定可取得的最高解析度與幀率，再比較同一級的各種編碼（AV1/VP9/HEVC/AVC）與單檔/分軌組合
+    - 大小依序取 filesize、filesize_approx、tbr×長度；只考慮合併容器能直接封裝的編碼
+    - 每個站點記住實測吞吐量（EWMA）：預估下載時間超過影片長度 FORMAT_MAX_REALTIME 倍時逐級降解析度
+      （最低 FORMAT_MIN_STEP_HEIGHT），否則只把省下的位元組換算成預估秒數寫進理由
+    最高一級的格式都不知道大小時不做選擇，沿用原本的格式字串。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
 
-    def toggle_custom_rate(self, _evt=None):
-        """
-        當選到自訂時才開放輸入欄。
-        """
-        state = "normal" if self.rate_choice_var.get() == "自訂" else "disabled"
-        self.custom_rate_entry.configure(state=state)
+    def observe(self, host: str, nbytes: int, seconds: float):
+        if nbytes <= 0 or seconds <= 0:
+            return
+        speed = nbytes / seconds
+        with self._lock:
+            prev = self._hosts.get(host)
+            self._hosts[host] = speed if prev is None else prev * 0.7 + speed * 0.3
 
-    def _apply_rate_limit(self, opts: dict) -> bool:
-        """
-        依 UI 設定將 ratelimit 寫入 opts。
-        回傳 True 表示成功；False 代表格式錯誤，須中止下載。
-        """
-        value = self.custom_rate_var.get().strip() if self.rate_choice_var.get() == "自訂" else self.rate_choice_var.get()
-        if not value or value == "0":         
-            return True
-        try:
-            mbps = float(value)
-            if mbps <= 0:
-                raise ValueError
-            opts['ratelimit'] = int(mbps * 1024 * 1024)   
-            return True
-        except ValueError:
-            self._update_status("限速數字格式錯誤")
-            messagebox.showerror(
-                "限速格式錯誤",
-                "請輸入正數（例：0.5、1、2、2.5）。\n0 代表不限速。"
-            )
-            return False
+    def throughput(self, host: str) -> float | None:
+        with self._lock:
+            return self._hosts.get(host)
 
-    def start_download_thread(self):
-        self.title_var.set("")          
-        raw_url = self.url_var.get().strip()
-        if not raw_url:
-            messagebox.showwarning("提醒", "請輸入 URL")
-            return
-        url = normalize_url(raw_url)
-        self._update_status(f"初始化下載 …（{self.quality_var.get()}）")
-        threading.Thread(target=self.download, args=(url,), daemon=True).start()
+    @staticmethod
+    def size(fmt: dict, duration) -> float | None:
+        for key in ('filesize', 'filesize_approx'):
+            if fmt.get(key):
+                return float(fmt[key])
+        if fmt.get('tbr') and duration:
+            return fmt['tbr'] * 1000 / 8 * duration
+        return None
 
-    def download(self, url: str):
-        """
-        單一路徑完成抓資訊 → 下載並支援暫停/續傳。
-        """
-        self.current_url = url
-        self.pause_flag = False
-        self.stop_flag = False
-        self.paused = False
-        self.after(0, lambda: self.pause_btn.config(state="normal", text="暫停"))
-        self.after(0, lambda: self.stop_btn.config(state="normal"))
+    @staticmethod
+    def _codec(fmt: dict, key: str) -> str | None:
+        """'none' 表示沒有這一軌；None 表示 yt-dlp 不知道是什麼編碼。"""
+        c = fmt.get(key)
+        return c.lower() if c else None
 
-        try:
-            ydl_opts = self._build_base_opts()
-            self._add_format_opts(ydl_opts, url)
+    def choose(self, formats: list, duration, height_cap: int | None, target: str | None,
+               speed: float | None = None) -> tuple[str, str] | None:
+        """回傳 (格式字串, 理由)；資料不足以比較時回傳 None。"""
+        vok, aok = MERGE_CODECS.get(target, (None, None))
 
-            fmt_kind = self.format_var.get()
-            netloc = urlparse(url).netloc.lower().split(':', 1)[0]
-            domain_for_dir = re.sub(r'[^a-z0-9.-]', '_', netloc)
-            save_dir = f"{domain_for_dir}_{fmt_kind}"
-            os.makedirs(save_dir, exist_ok=True)
-            ydl_opts['outtmpl'] = os.path.join(save_dir, '%(title)s.%(ext)s')
+        def allowed(codec, prefixes):
+            if prefixes is None:
+                return True
+            return codec is not None and codec != 'none' and codec.startswith(prefixes)
 
-            info_opts = {k: v for k, v in ydl_opts.items() if k != 'postprocessors'}
-            info_opts.update({'quiet': True, 'skip_download': True})
-            with yt_dlp.YoutubeDL(info_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
+        videos, audios = [], []
+        for f in formats:
+            if f.get('has_drm') or not f.get('format_id'):
+                continue
+            v, a = self._codec(f, 'vcodec'), self._codec(f, 'acodec')
+            if v == 'none' and a not in (None, 'none'):
+                if allowed(a, aok):
+                    audios.append(f)
+            elif v not in (None, 'none') and f.get('height'):
+                if height_cap and f['height'] > height_cap:
+                    continue
+                muxed = a not in (None, 'none')
+                if muxed and vok is not None and f.get('ext') != target:
+                    continue            # 單檔不經合併，副檔名就是輸出容器
+                if allowed(v, vok) and (not muxed or allowed(a, aok)):
+                    videos.append(f)
+        if not videos:
+            return None
 
-            is_live = bool(info.get('is_live'))
-            if is_live:
-                proc = None
-                fmt_kind = self.format_var.get()
-                q = self.quality_var.get()
-                try:
-                    self._update_status("偵測到直播，切換至子程序錄製模式…")
-
-                    cmd = ["yt-dlp", url, "-N", "4"] 
-
-                    ck = os.path.join(os.path.dirname(__file__), 'cookies.txt')
-                    if os.path.exists(ck):
-                        cmd += ["--cookies", ck]
-
-                    value = self.custom_rate_var.get().strip() if self.rate_choice_var.get() == "自訂" else self.rate_choice_var.get()
-                    if value and value != "0":
-                        try:
-                            mbps = float(value)
-                            if mbps > 0:
-                                cmd += ["--limit-rate", f"{mbps}M"]
-                        except Exception:
-                            pass
-
-                    netloc = urlparse(url).netloc.lower()
-                    for key, site_opts in SITE_SPECIFIC_OPTS.items():
-                        if self._host_matches(netloc, key):
-                            if isinstance(site_opts, str):
-                                site_opts = SITE_SPECIFIC_OPTS[site_opts]
-                            if isinstance(site_opts, dict):
-                                if site_opts.get("live_from_start"):
-                                    cmd += ["--live-from-start"]
-                                if "extractor_args" in site_opts and "twitter" in site_opts["extractor_args"]:
-                                    cmd += ["--extractor-args", "twitter:api=syndication"]
-                            break
-
-                    netloc = urlparse(url).netloc.lower().split(':', 1)[0]
-                    domain_for_dir = re.sub(r'[^a-z0-9.-]', '_', netloc)
-                    save_dir = f"{domain_for_dir}_{fmt_kind}"
-                    os.makedirs(save_dir, exist_ok=True)
-                    outtmpl = os.path.join(save_dir, '%(title)s.%(ext)s')
-                    cmd += ["-o", outtmpl]
-
-                    cmd += ["--hls-use-mpegts", "--hls-prefer-ffmpeg"]
-
-                    cmd += ["--downloader-args", "ffmpeg_i:-nostdin -y"]
-
-                    if fmt_kind == "mp3":
-                        cmd += ["-f", "bestaudio/best", "-x", "--audio-format", "mp3",
-                                "--embed-thumbnail", "--embed-metadata"]
-                    elif fmt_kind == "flac":
-                        cmd += ["-f", "bestaudio/best", "-x", "--audio-format", "flac",
-                                "--embed-thumbnail", "--embed-metadata"]
-                    else:
-                        if q == "原片最高":
-                            cmd += ["-f", "bestvideo*+bestaudio/best"]
-                        else:
-                            height = 2160 if q.lower() == "4k" else int(q.rstrip("p"))
-                            cmd += ["-f",
-                                    f"bestvideo[height<={height}]+bestaudio/"
-                                    f"best[height<={height}]"]
-
-                    cmd += ["--no-progress", "-q"]
-                    creationflags = 0
-                    if sys.platform.startswith("win"):
-                        CREATE_NEW_PROCESS_GROUP = 0x00000200
-                        CREATE_NO_WINDOW = 0x08000000
-                        creationflags = CREATE_NEW_PROCESS_GROUP | CREATE_NO_WINDOW
-
-                    kwargs = {}
-                    if not sys.platform.startswith("win"):
-                        kwargs["preexec_fn"] = os.setsid  
-                    proc = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,          
-                        creationflags=creationflags,
-                        **kwargs                            
-                    )
-                    self.live_proc = proc
-
-                    self._update_status("直播錄製中…按「中止」會立刻停止錄製。")
-                    self.after(0, lambda: self.pause_btn.config(state="disabled"))
-                    self.after(0, lambda: self.stop_btn.config(state="normal"))
-
-                    rc = proc.wait() 
-
-                    if rc == 0:
-                        self._update_status("直播錄製結束。")
-                    else:
-                        self._update_status("直播錄製結束。(把檔案後綴.mp4.part刪除.part留下.mp4)")
+        level = lambda f: (f['height'], round(f.get('fps') or 0))
+        top = max(map(level, videos))
+        if not any(self.size(f, duration) for f in videos if level(f) == top):
+            return None
 
-                    try:
-                        if fmt_kind not in ("mp3", "flac"):
-                            latest = None
-                            latest_t = -1
-                            for fn in os.listdir(save_dir):
-                                if fn.lower().endswith(".mp4"):
-                                    full = os.path.join(save_dir, fn)
-                                    t = os.path.getmtime(full)
-                                    if t > latest_t:
-                                        latest, latest_t = full, t
-                            if latest:
-                                if self._try_fix_mp4_inplace(latest):
-                                    self._update_status("已修復 MP4 。(把檔案後綴.mp4.part刪除.part留下.mp4)")
-                    except Exception:
-                        pass
-
-                    self.after(0, lambda: self.stop_btn.config(state="disabled"))
-                    self.current_url = None
-                    return
+        audio = None
+        if audios:
+            kbps = lambda f: f.get('abr') or f.get('tbr') or 0
+            floor = min(FORMAT_MIN_AUDIO_KBPS, max(map(kbps, audios))) * 0.95
+            pool = [(self.size(f, duration), f) for f in audios if kbps(f) >= floor]
+            pool = [(n, f) for n, f in pool if n]
+            if pool:
+                audio = min(pool, key=lambda p: p[0])
 
-                except Exception as e:
-                    self._update_status(f"直播子程序啟動或錄製失敗：{strip_ansi(str(e))}")
-                    self.after(0, lambda: self.pause_btn.config(state="disabled"))
-                    self.after(0, lambda: self.stop_btn.config(state="disabled"))
-                    self.current_url = None
-                    return
+        def combos_at(lv):
+            combos = []
+            for f in videos:
+                n = self.size(f, duration) if level(f) == lv else None
+                if not n:
+                    continue
+                if self._codec(f, 'acodec') not in (None, 'none'):
+                    combos.append((n, f['format_id'], f, None))
+                elif audio is not None:
+                    combos.append((n + audio[0], f"{f['format_id']}+{audio[1]['format_id']}", f, audio[1]))
+            return sorted(combos, key=lambda c: c[0])
 
-                finally:
-                    try:
-                        if getattr(self, "live_proc", None) is proc:
-                            self.live_proc = None
-                    except Exception:
-                        self.live_proc = None
+        combos = combos_at(top)
+        if not combos:
+            return None
+        picked, slow = top, None
+        if speed and duration and combos[0][0] / speed > duration * FORMAT_MAX_REALTIME:
+            # 這個站實測太慢：往下一級找預估下載得完的，找不到就用允許的最低一級
+            slow = combos[0][0] / speed
+            for lv in sorted({level(f) for f in videos if level(f) < top}, reverse=True):
+                if lv[0] < FORMAT_MIN_STEP_HEIGHT:
+                    break
+                lower = combos_at(lv)
+                if lower:
+                    picked, combos = lv, lower
+                    if lower[0][0] / speed <= duration * FORMAT_MAX_REALTIME:
+                        break
+        total, spec, video, aud = combos[0]
 
-            if ydl_opts.get('merge_output_format') == 'mp4':
-                v_ext = (info.get('ext') or '').lower()
-                if v_ext and v_ext not in ('mp4', 'm4v', 'mov'):
-                    ydl_opts.pop('merge_output_format', None)
+        def label(f):
+            return (self._codec(f, 'vcodec') or '?').split('.')[0]
 
-            self.source_bitrate_kbps = self._get_source_audio_bitrate_kbps(info)
-            duration = info.get('duration')
+        reason = f"{picked[0]}p{picked[1] if picked[1] > 30 else ''} {label(video)}"
+        if aud is not None:
+            reason += f" + {(self._codec(aud, 'acodec') or '?').split('.')[0]}"
+        reason += f"，約 {format_size(total)}"
+        worst = combos[-1]
+        if worst[0] > total:
+            saved = worst[0] - total
+            reason += f"，比 {label(worst[2])} 組合小 {saved / worst[0]:.0%}"
+            if speed:
+                reason += f"（此站約 {format_size(speed)}/s，預估省 {saved / speed:.1f} 秒）"
+        if picked != top:
+            reason += (f"；此站約 {format_size(speed)}/s，{top[0]}p 預估要 {slow:.0f} 秒"
+                       f"（片長 {duration:.0f} 秒），降為 {picked[0]}p")
+        return spec, reason
 
-            title = info.get('title', '未知標題')
-            self.current_title = title
-            self.after(0, lambda: self.title_var.set(f"下載中：{title}"))
-            safe_title = ydl_utils.sanitize_filename(title, restricted=False)  
-            expected_path = info.get('_filename')
 
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
-            except Exception as e:
-                if "fragment not found" in str(e).lower():
-                    self._update_status("HLS 分片失效，嘗試改用 DASH/mp4 下載…")
-                    try:
-                        q = self.quality_var.get()
-                        if q == "原片最高":
-                            fmt_str = "bestvideo[protocol!=m3u8]+bestaudio[protocol!=m3u8]/best[protocol!=m3u8]"
-                        else:
-                            height = 2160 if q.lower() == "4k" else int(q.rstrip("p"))
-                            fmt_str = (
-                                f"bestvideo[height<={height}][protocol!=m3u8]+"
-                                f"bestaudio[protocol!=m3u8]/best[height<={height}][protocol!=m3u8]"
-                            )
+class BandwidthScheduler:
+    """
+    全域限速：所有工作從同一個 token bucket 取額度，總量不超過 rate（bytes/s，None=不限）。
+    progress hook 每收到一個 block 就呼叫 consume()，額度不足時在下載執行緒裡等（TCP 自然放慢）。
+    多個工作同時在等時，先放行「已取得位元組 / 權重」最少的那個，依權重公平分配；
+    沒在等的工作不佔份額，頻寬不會閒置。rate 可隨時修改，進行中的傳輸不需重來。
+    """
+    def __init__(self, rate: int | None = None):
+        self.rate = rate
+        self._cond = threading.Condition()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._jobs = {}        # job -> [已取得位元組/權重, 權重, 目前檔案, 已回報位元組]
+        self._waiting = []
 
-                        ydl_opts['format'] = fmt_str
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            ydl.download([url])
-                    except Exception as e2:
-                        raise e2
-                else:
-                    raise e
+    def set_rate(self, rate: int | None):
+        with self._cond:
+            self._refill()
+            self.rate = rate or None
+            self._tokens = min(self._tokens, self._burst())
+            self._cond.notify_all()
 
-            final_path = self._resolve_final_output_path(
-                save_dir, safe_title, self.format_var.get(), self.last_filename, expected_path
-            )
-            threading.Thread(
-                target=self._probe_and_display,
-                args=(final_path, duration),
-                daemon=True
-            ).start()
+    def set_weight(self, job, weight: float):
+        with self._cond:
+            entry = self._jobs.get(job)
+            if entry is not None:
+                entry[1] = float(weight)
+            self._cond.notify_all()
 
-            self.after(0, lambda: self.pause_btn.config(state="disabled"))
-            self.after(0, lambda: self.stop_btn.config(state="disabled"))
-            self.current_url = None
+    def forget(self, job):
+        with self._cond:
+            self._jobs.pop(job, None)
+            self._cond.notify_all()
 
-        except yt_dlp.utils.DownloadCancelled:
-            if self.stop_flag:
-                self._update_status("已中止。已下載的部分已保留（.part），可日後續傳。")
-                self.after(0, lambda: self.pause_btn.config(state="disabled"))
-                self.after(0, lambda: self.stop_btn.config(state="disabled"))
-                self.current_url = None
-                self.paused = False
-                return
-            self.paused = True
-            self._update_status("已暫停")
-            self.after(0, lambda: self.pause_btn.config(text="繼續", state="normal"))
+    def _burst(self) -> float:
+        return (self.rate or 0) * BANDWIDTH_BURST
 
-        except Exception as e:
-            self.after(0, lambda: self._write_status_plain(f"錯誤：{strip_ansi(str(e))}"))
-            self.after(0, self._show_help)
-            self.after(0, lambda: self.pause_btn.config(state="disabled"))
-            self.after(0, lambda: self.stop_btn.config(state="disabled"))
-            self.current_url = None
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self._tokens + (now - self._last) * self.rate, self._burst())
+        self._last = now
 
-    def _host_matches(self, netloc: str, key: str) -> bool:
-        """
-        嚴格比對站點：完全相等或以 .key 結尾（支援子網域）
-        """
-        net = (netloc or "").split(":", 1)[0].lower()
-        k = (key or "").lower()
-        return net == k or net.endswith("." + k)
+    def _entry(self, job) -> list:
+        entry = self._jobs.get(job)
+        if entry is None:
+            # 新加入的工作從目前最小的虛擬時間起算，不會因為「還沒用過」而長時間獨占
+            start = min((e[0] for e in self._jobs.values()), default=0.0)
+            entry = self._jobs[job] = [start, float(job.priority_weight), None, 0]
+        return entry
 
-    def _add_password_opts(self, opts: dict):
+    def consume(self, job, d: dict):
         """
-        依 GUI需要密碼勾選，自動塞入三種參數。
+        由 progress hook 呼叫：依 downloaded_bytes 的增量扣額度，不足就等。暫停/中止時立刻返回。
         """
-        if self.need_pass_var.get():
-            pwd = self.pass_var.get().strip()
-            if pwd:
-                opts.update({
-                    'video_password': pwd,   
-                    'videopassword':  pwd,   
-                    'http_password':  pwd,   
-                })
+        downloaded = d.get('downloaded_bytes') or 0
+        name = d.get('tmpfilename') or d.get('filename')
+        with self._cond:
+            entry = self._entry(job)
+            if entry[2] != name or downloaded < entry[3]:
+                # 新檔案（影像→音訊）或續傳：第一次回報只當基準，不把 .part 裡已有的位元組算成這次的用量
+                entry[2], entry[3] = name, downloaded
+            nbytes = downloaded - entry[3]
+            entry[3] = downloaded
+            if nbytes <= 0 or not self.rate:
+                entry[0] += max(nbytes, 0) / entry[1]
+                return
+            self._waiting.append(job)
+            try:
+                while self.rate and not (job.stop_flag or job.pause_flag):
+                    self._refill()
+                    head = min(self._waiting, key=lambda j: self._jobs[j][0] if j in self._jobs else 0.0)
+                    if head is job and self._tokens > 0:
+                        break
+                    if head is job:
+                        self._cond.wait(min(1.0, -self._tokens / self.rate + 0.001))
+                    else:
+                        self._cond.wait(0.5)
+                self._tokens -= nbytes
+                entry[0] += nbytes / entry[1]
+            finally:
+                self._waiting.remove(job)
+                self._cond.notify_all()
 
-    def _build_base_opts(self) -> dict:
-        opts = {
-            'continuedl': True,
-            'progress_hooks': [self._hook],
-        }
-        ck = os.path.join(os.path.dirname(__file__), 'cookies.txt')
-        if os.path.exists(ck):
-            opts['cookiefile'] = ck
-        if not self._apply_rate_limit(opts):
-            raise ValueError("限速數字格式錯誤")
-        self._add_password_opts(opts)
-        return opts
 
-    def _get_source_audio_bitrate_kbps(self, info: dict):
+class FragmentLost(Exception):
+    """分片重試用盡（多半是簽名網址過期），yt-dlp 原本會略過它繼續下載。"""
+
+
+class _JobLogger:
+    """
+    掛在每個工作 YoutubeDL 上的 logger：把分片重試、HTTP 429 回報給 FragmentConcurrency，
+    一般下載遇到重試用盡、yt-dlp 要略過的分片時丟 FragmentLost 中斷，不留缺段的檔案，
+    其餘訊息照 yt-dlp 預設方式輸出（quiet 時只留警告與錯誤）。
+    多執行緒抓分片時 yt-dlp 一開始就把所有分片排進執行緒池，離開時會等它們跑完；
+    所以同時標記 job.fragments_lost，讓 _hook 在剩下的分片第一次回報進度時就中止，
+    每個分片最多多發一個請求、讀一個區塊，不會把整份已過期的清單抓完再丟掉。
+    """
+    _PROGRESS_RE = re.compile(r'^\r?\[download\]\s+[\d.]+%')
+
+    def __init__(self, engine, job):
+        self.engine = engine
+        self.job = job
+
+    def _inspect(self, msg: str):
+        if "Got error:" in msg or "Skipping fragment" in msg:
+            self.engine.fragments.record_error(self.job, throttled="429" in msg)
+            if "Skipping fragment" not in msg:
+                self.job.metrics.retries += 1
+            elif self.job.is_live:
+                self.job.metrics.skipped_fragments += 1
+            else:
+                # 此時 .part 與 .ytdl 都停在前一個分片，引擎換新清單後從這裡接續
+                self.job.fragments_lost = True
+                raise FragmentLost(strip_ansi(msg))
+
+    def debug(self, msg: str):
+        self._inspect(msg)
+        if self.engine.quiet or msg.startswith("[debug] ") or self._PROGRESS_RE.match(msg):
+            return
+        sys.stdout.write(msg + "\n")
+
+    def info(self, msg: str):
+        self.debug(msg)
+
+    def warning(self, msg: str):
+        self._inspect(msg)
+        sys.stderr.write(msg + "\n")
+
+    def error(self, msg: str):
+        sys.stderr.write(msg + "\n")
+
+
+def _iter_format_urls(info: dict):
+    for f in (info.get('requested_formats') or []) + (info.get('formats') or []):
+        if f.get('url'):
+            yield f['url']
+    for entry in info.get('entries') or []:
+        if isinstance(entry, dict):
+            yield from _iter_format_urls(entry)
+
+def extract_cache_ttl(url: str, info: dict) -> int:
+    """
+    站點 TTL；若串流網址帶 expire= 參數（如 googlevideo），取兩者較早者並預留 5 分鐘。
+    """
+    netloc = urlparse(url).netloc.lower()
+    ttl = lookup_site(EXTRACT_CACHE_TTL, netloc, DEFAULT_EXTRACT_CACHE_TTL)
+    now = time.time()
+    for fu in _iter_format_urls(info):
+        exp = parse_qs(urlparse(fu).query).get('expire')
+        if exp and exp[0].isdigit():
+            ttl = min(ttl, int(exp[0]) - now - 300)
+    return int(ttl)
+
+# 容器標頭解析：只讀標頭就拿到音訊 codec / 位元率 / 時長，省掉每個檔案一次 ffprobe
+
+_MP4_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+_MP4_AUDIO_CODECS = {
+    b'Opus': 'opus', b'fLaC': 'flac', b'alac': 'alac',
+    b'ac-3': 'ac3', b'ec-3': 'eac3', b'.mp3': 'mp3',
+}
+_MP4_OBJECT_TYPES = {0x40: 'aac', 0x66: 'aac', 0x67: 'aac', 0x68: 'aac', 0x69: 'mp3', 0x6B: 'mp3', 0xDD: 'vorbis'}
+_MKV_AUDIO_CODECS = {
+    'A_OPUS': 'opus', 'A_VORBIS': 'vorbis', 'A_FLAC': 'flac', 'A_MPEG/L3': 'mp3',
+    'A_AC3': 'ac3', 'A_EAC3': 'eac3', 'A_ALAC': 'alac',
+}
+_MP3_KBPS = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+def _iter_mp4_boxes(data: bytes, pos: int = 0, end: int | None = None):
+    end = len(data) if end is None else end
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        hdr = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            hdr = 16
+        elif size == 0:
+            size = end - pos
+        if size < hdr:
+            return
+        yield kind, pos + hdr, min(pos + size, end)
+        pos += size
+
+def _parse_mp4(f, file_size: int):
+    # moov 可能在檔尾（未 faststart），只跳著讀頂層 box 標頭找它
+    pos = 0
+    moov = None
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        head = f.read(16)
+        size, kind = struct.unpack_from('>I4s', head)
+        if size == 1:
+            size = struct.unpack_from('>Q', head, 8)[0]
+        elif size == 0:
+            size = file_size - pos
+        if size < 8:
+            return None
+        if kind == b'moov':
+            f.seek(pos)
+            moov = f.read(size)
+            break
+        pos += size
+    if moov is None:
+        return None
+
+    def _walk(start, end):
+        found = {}
+        for kind, body, stop in _iter_mp4_boxes(moov, start, end):
+            if kind in _MP4_CONTAINERS:
+                if kind == b'trak':
+                    trak = _walk(body, stop)
+                    if trak.get('handler') == b'soun':
+                        trak.setdefault('movie_duration', found.get('movie_duration'))
+                        return trak
+                    continue
+                found.update(_walk(body, stop))
+            elif kind in (b'mvhd', b'mdhd'):
+                ver = moov[body]
+                if ver == 1:
+                    scale, dur = struct.unpack_from('>IQ', moov, body + 20)
+                else:
+                    scale, dur = struct.unpack_from('>II', moov, body + 12)
+                if scale and dur:
+                    found['movie_duration' if kind == b'mvhd' else 'duration'] = dur / scale
+            elif kind == b'hdlr':
+                found['handler'] = moov[body + 8:body + 12]
+            elif kind == b'stsd':
+                found.update(_parse_mp4_stsd(moov, body + 8, stop))
+            elif kind == b'stsz':
+                sample_size, count = struct.unpack_from('>II', moov, body + 4)
+                if sample_size:
+                    found['bytes'] = sample_size * count
+                elif count:
+                    found['bytes'] = sum(struct.unpack_from(f'>{count}I', moov, body + 12))
+        return found
+
+    trak = _walk(0, len(moov))
+    codec = trak.get('codec')
+    if trak.get('handler') != b'soun' or not codec:
+        return None
+    duration = trak.get('duration') or trak.get('movie_duration')
+    kbps = trak.get('avg_bitrate', 0) / 1000.0 or None
+    if not kbps and trak.get('bytes') and duration:
+        kbps = trak['bytes'] * 8.0 / duration / 1000.0
+    return codec, kbps, duration
+
+def _parse_mp4_stsd(data: bytes, start: int, end: int) -> dict:
+    for kind, body, stop in _iter_mp4_boxes(data, start, end):
+        if kind == b'mp4a':
+            ver = struct.unpack_from('>H', data, body + 8)[0]
+            child = body + 28 + {1: 16, 2: 36}.get(ver, 0)
+            for sub, sbody, sstop in _iter_mp4_boxes(data, child, stop):
+                if sub == b'esds':
+                    return _parse_esds(data, sbody + 4, sstop)
+                if sub == b'wave':   # QuickTime 把 esds 包在 wave 裡
+                    for sub2, sbody2, sstop2 in _iter_mp4_boxes(data, sbody, sstop):
+                        if sub2 == b'esds':
+                            return _parse_esds(data, sbody2 + 4, sstop2)
+            return {'codec': 'aac'}
+        if kind in _MP4_AUDIO_CODECS:
+            return {'codec': _MP4_AUDIO_CODECS[kind]}
+    return {}
+
+def _parse_esds(data: bytes, pos: int, end: int) -> dict:
+    def _desc(p):
+        tag = data[p]
+        size = 0
+        p += 1
+        for _ in range(4):
+            b = data[p]
+            p += 1
+            size = (size << 7) | (b & 0x7F)
+            if not b & 0x80:
+                break
+        return tag, p, size
+
+    tag, p, _ = _desc(pos)
+    if tag == 0x03:
+        flags = data[p + 2]
+        p += 3
+        if flags & 0x80:
+            p += 2
+        if flags & 0x40:
+            p += 1 + data[p]
+        if flags & 0x20:
+            p += 2
+        tag, p, _ = _desc(p)
+    if tag != 0x04 or p + 13 > end:
+        return {'codec': 'aac'}
+    oti = data[p]
+    avg = struct.unpack_from('>I', data, p + 9)[0]
+    return {'codec': _MP4_OBJECT_TYPES.get(oti, 'aac'), 'avg_bitrate': avg}
+
+def _skip_id3v2(f) -> int:
+    f.seek(0)
+    head = f.read(10)
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    return 10 + size + (10 if head[5] & 0x10 else 0)
+
+def _parse_flac(f, offset: int):
+    f.seek(offset)
+    head = f.read(4 + 4 + 34)
+    if head[:4] != b'fLaC' or head[4] & 0x7F != 0:
+        return None
+    info = head[8 + 10:8 + 18]
+    bits = int.from_bytes(info, 'big')
+    rate = bits >> 44
+    samples = bits & 0xFFFFFFFFF
+    duration = samples / rate if rate and samples else None
+    return 'flac', None, duration
+
+def _mp3_frame_length(buf, i: int):
+    """
+    buf[i:] 若是 MPEG Layer III 幀頭，回傳這一幀的長度（含幀頭），否則 None。
+    """
+    if i + 4 > len(buf) or buf[i] != 0xFF:
+        return None
+    b1, b2 = buf[i + 1], buf[i + 2]
+    ver_bits = (b1 >> 3) & 3
+    if (b1 & 0xE0) != 0xE0 or ver_bits == 1 or ((b1 >> 1) & 3) != 1 \
+            or not 0 < (b2 >> 4) < 15 or ((b2 >> 2) & 3) == 3:
+        return None
+    mpeg1 = ver_bits == 3
+    rate = (44100, 48000, 32000)[(b2 >> 2) & 3] // (1 if mpeg1 else (2 if ver_bits == 2 else 4))
+    kbps = _MP3_KBPS[1 if mpeg1 else 2][b2 >> 4]
+    return (144 if mpeg1 else 72) * kbps * 1000 // rate + ((b2 >> 1) & 1)
+
+def _parse_mp3(f, offset: int, file_size: int):
+    """
+    其他格式都不是時才當 MP3 看。只認有 Xing/Info/VBRI 標頭、或後面接連兩個同格式幀頭的幀，
+    否則回傳 None（交給 ffprobe）——隨機資料裡很容易碰巧有一個長得像幀頭的位元組。
+    """
+    f.seek(offset)
+    buf = f.read(64 * 1024)
+    i = 0
+    while True:
+        i = buf.find(b'\xff', i)
+        if i < 0 or i + 4 > len(buf):
+            return None
+        length = _mp3_frame_length(buf, i)
+        if length:
+            b1, b2, b3 = buf[i + 1], buf[i + 2], buf[i + 3]
+            ver_bits = (b1 >> 3) & 3
+            mono = (b3 >> 6) == 3
+            x = i + 4 + ((17 if mono else 32) if ver_bits == 3 else (9 if mono else 17))
+            if buf[x:x + 4] in (b'Xing', b'Info') or buf[i + 36:i + 40] == b'VBRI':
+                break
+            # 同一個串流的幀：版本、層、取樣率一致
+            j = i + length
+            nxt = _mp3_frame_length(buf, j)
+            if nxt and buf[j + 1] == b1 and (buf[j + 2] >> 2) & 3 == (b2 >> 2) & 3:
+                k = j + nxt
+                if _mp3_frame_length(buf, k) and buf[k + 1] == b1 and (buf[k + 2] >> 2) & 3 == (b2 >> 2) & 3:
+                    break
+        i += 1
+
+    mpeg1 = ver_bits == 3
+    mono = (b3 >> 6) == 3
+    rate = (44100, 48000, 32000)[(b2 >> 2) & 3] // (1 if mpeg1 else (2 if ver_bits == 2 else 4))
+    kbps = _MP3_KBPS[1 if mpeg1 else 2][b2 >> 4]
+    spf = 1152 if mpeg1 else 576
+    audio_start = offset + i
+    audio_bytes = file_size - audio_start
+    f.seek(file_size - 128)
+    if f.read(3) == b'TAG':
+        audio_bytes -= 128
+
+    side = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    frames = nbytes = None
+    x = i + 4 + side
+    if buf[x:x + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack_from('>I', buf, x + 4)[0]
+        p = x + 8
+        if flags & 1:
+            frames = struct.unpack_from('>I', buf, p)[0]
+            p += 4
+        if flags & 2:
+            nbytes = struct.unpack_from('>I', buf, p)[0]
+    elif buf[i + 36:i + 40] == b'VBRI':
+        nbytes, frames = struct.unpack_from('>II', buf, i + 36 + 10)
+
+    if frames:
+        duration = frames * spf / rate
+        kbps = (nbytes or audio_bytes) * 8.0 / duration / 1000.0
+    else:
+        duration = audio_bytes * 8.0 / (kbps * 1000.0)
+    return 'mp3', float(kbps), duration
+
+def _read_ebml_vint(f, keep_marker: bool):
+    first = f.read(1)
+    if not first:
+        raise EOFError
+    b = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not b & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("bad EBML vint")
+    value = b if keep_marker else b & (mask - 1)
+    all_ones = (b & (mask - 1)) == mask - 1
+    for c in f.read(length - 1):
+        value = (value << 8) | c
+        all_ones = all_ones and c == 0xFF
+    return value, (None if all_ones and not keep_marker else value)
+
+def _parse_matroska(f, file_size: int):
+    f.seek(0)
+    _read_ebml_vint(f, True)
+    size = _read_ebml_vint(f, False)[1]
+    f.seek(f.tell() + size)
+    seg_id = _read_ebml_vint(f, True)[0]
+    seg_size = _read_ebml_vint(f, False)[1]
+    if seg_id != 0x18538067:
+        return None
+    end = file_size if seg_size is None else min(file_size, f.tell() + seg_size)
+
+    scale, duration, codec = 1000000, None, None
+    while f.tell() < end and (codec is None or duration is None):
+        eid = _read_ebml_vint(f, True)[0]
+        esize = _read_ebml_vint(f, False)[1]
+        body = f.tell()
+        if eid == 0x1F43B675 or esize is None:   # Cluster：標頭已經讀完
+            break
+        if eid == 0x1549A966:                    # Info
+            for cid, data in _iter_ebml_children(f, body + esize):
+                if cid == 0x2AD7B1:
+                    scale = int.from_bytes(data, 'big')
+                elif cid == 0x4489:
+                    duration = struct.unpack('>d' if len(data) == 8 else '>f', data)[0]
+        elif eid == 0x1654AE6B:                  # Tracks
+            for cid, data in _iter_ebml_children(f, body + esize):
+                if cid != 0xAE:
+                    continue
+                track = {}
+                sub = io.BytesIO(data)
+                for tid, tdata in _iter_ebml_children(sub, len(data)):
+                    track[tid] = tdata
+                if track.get(0x83) == b'\x02' and codec is None:
+                    cid_str = track.get(0x86, b'').decode('ascii', 'replace')
+                    codec = _MKV_AUDIO_CODECS.get(cid_str) or \
+                        ('aac' if cid_str.startswith('A_AAC') else
+                         'pcm_s16le' if cid_str.startswith('A_PCM') else '')
+        f.seek(body + esize)
+    if not codec:
+        return None
+    return codec, None, (duration * scale / 1e9 if duration else None)
+
+def _iter_ebml_children(f, end: int):
+    while f.tell() < end:
+        cid = _read_ebml_vint(f, True)[0]
+        size = _read_ebml_vint(f, False)[1]
+        if size is None:
+            return
+        yield cid, f.read(size)
+
+def _parse_ogg(f, file_size: int):
+    f.seek(0)
+    page = f.read(27 + 255 + 64)
+    nseg = page[26]
+    packet = page[27 + nseg:]
+    if packet.startswith(b'OpusHead'):
+        codec, pre_skip, rate, kbps = 'opus', struct.unpack_from('<H', packet, 10)[0], 48000, None
+    elif packet.startswith(b'\x01vorbis'):
+        rate, nominal = struct.unpack_from('<I4xi', packet, 12)
+        codec, pre_skip, kbps = 'vorbis', 0, (nominal / 1000.0 if nominal > 0 else None)
+    else:
+        return None
+    f.seek(max(0, file_size - 64 * 1024))
+    tail = f.read()
+    last = tail.rfind(b'OggS')
+    duration = None
+    if last >= 0 and last + 14 <= len(tail):
+        granule = struct.unpack_from('<q', tail, last + 6)[0]
+        if granule > pre_skip:
+            duration = (granule - pre_skip) / rate
+    return codec, kbps, duration
+
+def read_audio_header(path: str):
+    """
+    只讀容器標頭取得 (codec_name, stream_kbps, duration_sec)；codec 名稱與 ffprobe 一致。
+    支援 MP4/M4A（moov/stsd/esds）、FLAC STREAMINFO、MP3（Xing/Info/VBRI 或 CBR）、
+    WebM/Matroska 與 Ogg（Opus/Vorbis）。不認得或沒有音軌時回傳 None，由呼叫端改用 ffprobe。
+    """
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            head = f.read(12)
+            if head[4:8] in (b'ftyp', b'moov', b'free', b'mdat', b'skip', b'wide'):
+                return _parse_mp4(f, file_size)
+            if head[:4] == b'\x1a\x45\xdf\xa3':
+                return _parse_matroska(f, file_size)
+            if head[:4] == b'OggS':
+                return _parse_ogg(f, file_size)
+            offset = _skip_id3v2(f)
+            f.seek(offset)
+            if f.read(4) == b'fLaC':
+                return _parse_flac(f, offset)
+            return _parse_mp3(f, offset, file_size)
+    except (OSError, EOFError, ValueError, IndexError, struct.error):
+        return None
+
+def _scan_top_level_atoms(f, file_size: int) -> list | None:
+    """
+    頂層 atom 清單 [(type, offset, size)]；長度不合理或被截斷（錄到一半中斷）時回傳 None。
+    """
+    atoms = []
+    pos = 0
+    while pos < file_size:
+        f.seek(pos)
+        head = f.read(16)
+        if len(head) < 8:
+            return None
+        size, kind = struct.unpack_from('>I4s', head)
+        if size == 1:
+            if len(head) < 16:
+                return None
+            size = struct.unpack_from('>Q', head, 8)[0]
+        elif size == 0:
+            size = file_size - pos
+        if size < 8 or pos + size > file_size:
+            return None
+        atoms.append((kind, pos, size))
+        pos += size
+    return atoms
+
+def _patch_chunk_offsets(moov: bytearray, delta: int, start: int = 0, end: int | None = None) -> bool:
+    """
+    把 moov 內所有 stco/co64 的 chunk offset 加上 delta；32 位元 stco 會溢位時回傳 False。
+    """
+    for kind, body, stop in _iter_mp4_boxes(moov, start, end):
+        if kind in _MP4_CONTAINERS:
+            if not _patch_chunk_offsets(moov, delta, body, stop):
+                return False
+        elif kind in (b'stco', b'co64'):
+            fmt = 'I' if kind == b'stco' else 'Q'
+            count = struct.unpack_from('>I', moov, body + 4)[0]
+            offsets = struct.unpack_from(f'>{count}{fmt}', moov, body + 8)
+            if kind == b'stco' and offsets and max(offsets) + delta > 0xFFFFFFFF:
+                return False
+            struct.pack_into(f'>{count}{fmt}', moov, body + 8, *(o + delta for o in offsets))
+    return True
+
+def _move_moov_to_front(path: str, atoms: list) -> bool:
+    """
+    原地把檔尾的 moov 搬到第一個 mdat 前面：mdat 起到 moov 之前的資料整段往後挪 moov 的長度
+    （mmap 由尾端往前分塊搬，不需要第二份檔案），再寫入修正過 offset 的 moov。
+    """
+    _, moov_off, moov_size = next(a for a in atoms if a[0] == b'moov')
+    mdat_off = next(a[1] for a in atoms if a[0] == b'mdat')
+    with open(path, 'r+b') as f:
+        f.seek(moov_off)
+        moov = bytearray(f.read(moov_size))
+        if not _patch_chunk_offsets(moov, moov_size):
+            return False
+        with mmap.mmap(f.fileno(), 0) as mm:
+            end = moov_off
+            while end > mdat_off:
+                start = max(mdat_off, end - FASTSTART_CHUNK)
+                mm.move(start + moov_size, start, end - start)
+                end = start
+            mm[mdat_off:mdat_off + moov_size] = moov
+            mm.flush()
+    return True
+
+def fix_mp4_inplace(path: str) -> bool:
+    """
+    讓 MP4 可以正常播放／邊下邊播（moov 在 mdat 前面）。先只掃頂層 atom 判斷要不要動：
+    - moov 已在前面、或是分段式（moof）MP4 → 不需處理
+    - 只是 moov 在檔尾 → 原地搬 moov 並修正 stco/co64，不重寫影音資料
+    - 截斷、沒有 moov 等真的壞掉的檔案（或 stco 會溢位）→ 才用 ffmpeg 整個重封裝，不設時限
+    回傳 True=已修復或不需修復，False=修復失敗。
+    """
+    try:
+        with open(path, 'rb') as f:
+            atoms = _scan_top_level_atoms(f, os.path.getsize(path))
+    except OSError:
+        atoms = None
+    if atoms:
+        kinds = [a[0] for a in atoms]
+        if b'moov' in kinds:
+            if b'mdat' not in kinds or b'moof' in kinds or kinds.index(b'moov') < kinds.index(b'mdat'):
+                return True
+            try:
+                if _move_moov_to_front(path, atoms):
+                    return True
+            except (OSError, ValueError, struct.error):
+                pass
+
+    try:
+        if not shutil.which("ffmpeg"):
+            return False
+        tmp_out = path[:-4] + "_fixed.mp4"
+        proc = subprocess.run(
+            ["ffmpeg", "-v", "error", "-y",
+             "-i", path, "-c", "copy", "-movflags", "+faststart", tmp_out],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        if proc.returncode == 0 and os.path.exists(tmp_out) and os.path.getsize(tmp_out) > 0:
+            try:
+                os.replace(tmp_out, path)  
+                return True
+            except Exception:
+                return False
+        if os.path.exists(tmp_out):
+            try: os.remove(tmp_out)
+            except Exception: pass
+        return False
+    except Exception:
+        return False
+
+def probe_container_bitrates(path: str, duration: float | None):
+    """
+    回傳 (stream_kbps, avg_kbps, codec_name)
+    - stream_kbps: 音訊流 bit_rate（若可得）
+    - avg_kbps   : 用檔案大小÷時長推得的平均位元率（若可得）
+    - codec_name : 音訊 codec 名稱（例如 'flac','opus','aac','mp3','pcm_s16le'）
+    先用 read_audio_header 讀標頭；認不得的容器才開 ffprobe。兩者都沒有時 codec 為 None。
+    """
+    if not path or not os.path.exists(path):
+        return None, None, None
+
+    stream_kbps, avg_kbps, codec = None, None, None
+
+    header = read_audio_header(path)
+    if header is not None:
+        codec, stream_kbps, header_duration = header
+        duration = duration or header_duration
+    if not (codec and (stream_kbps or duration)) and shutil.which('ffprobe'):
+        try:
+            proc = subprocess.run(
+                ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+                 '-show_entries', 'stream=codec_name,bit_rate', '-of', 'default=nw=1:nk=1', path],
+                capture_output=True, text=True, timeout=10
+            )
+            if proc.returncode == 0:
+                lines = [x.strip() for x in proc.stdout.splitlines() if x.strip()]
+                if lines:
+                    for x in lines:
+                        if x.isdigit():
+                            stream_kbps = float(x) / 1000.0
+                        else:
+                            codec = x
+        except Exception:
+            pass
+
+    try:
+        if duration and duration > 0:
+            size_bytes = os.path.getsize(path)
+            avg_kbps = (size_bytes * 8.0 / duration) / 1000.0
+    except Exception:
+        pass
+
+    return stream_kbps, avg_kbps, (codec or None)
+
+def run_postprocess(task: dict) -> dict:
+    """
+    在後製程序裡執行（需可 pickle，故為模組層級函式）：
+    yt-dlp 後處理器（抽音訊/轉檔）→ 直播 MP4 修復 → 位元率探測。
+    回傳最終檔案、位元率與各步驟起訖（time.time()，主程序直接併入工作的時間軸）。
+    """
+    started = time.time()
+    phases = []
+    path = task['path']
+    if task.get('postprocessors'):
+        YtDlpLoader.ensure()
+        t0 = time.time()
+        opts = {'quiet': True, 'no_warnings': True, 'postprocessors': task['postprocessors']}
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = dict(task.get('info') or {})
+            info['ext'] = os.path.splitext(path)[1].lstrip('.')
+            info = ydl.post_process(path, info)
+            path = info.get('filepath') or path
+        name = '+'.join(pp['key'] for pp in task['postprocessors'])
+        phases.append((f"pp:{name}", t0, time.time()))
+    if task.get('fix_mp4') and path.lower().endswith('.mp4'):
+        t0 = time.time()
+        fix_mp4_inplace(path)
+        phases.append(('fix_mp4', t0, time.time()))
+    t0 = time.time()
+    bitrates = probe_container_bitrates(path, task.get('duration'))
+    phases.append(('probe', t0, time.time()))
+    return {'path': path, 'bitrates': bitrates, 'started': started, 'phases': phases}
+
+
+class PostProcessPool:
+    """
+    下載與後製分成兩段管線：下載完的檔案排進有上限的佇列，由獨立的程序池處理，
+    ffmpeg 吃 CPU 時網路端可以繼續下一個工作。佇列滿時 submit 會等，下載端自然放慢。
+    程序用 spawn 啟動（主程序有 Tk 與多條執行緒，fork 不安全），第一次送工作時才建立。
+    """
+    def __init__(self, workers: int = POSTPROCESS_WORKERS, queue_factor: int = POSTPROCESS_QUEUE_FACTOR):
+        self.workers = max(1, int(workers))
+        self.capacity = self.workers * max(1, int(queue_factor))
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._queued = 0
+        self._blocked = 0
+
+    def submit(self, task: dict, callback):
+        with self._lock:
+            self._blocked += 1
+        self._slots.acquire()
+        with self._lock:
+            self._blocked -= 1
+            self._queued += 1
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            executor = self._executor
+        fut = executor.submit(run_postprocess, task)
+        fut.add_done_callback(lambda f: self._done(f, callback))
+
+    def _done(self, fut, callback):
+        with self._lock:
+            self._queued -= 1
+        self._slots.release()
+        callback(fut)
+
+    def depth(self) -> tuple:
+        """
+        (處理中, 排隊中, 佇列已滿而等著送進來的下載)。
+        """
+        with self._lock:
+            running = min(self._queued, self.workers)
+            return running, self._queued - running, self._blocked
+
+
+class LiveCapture:
+    """
+    追蹤 yt-dlp 在各工作執行緒啟動的 ffmpeg（直播錄製用），讓「中止」能送 'q' 請它正常結束：
+    ffmpeg 會寫完檔尾並以 0 結束，yt-dlp 就把錄到的部分當成完成的下載照常後製。
+    以替換 yt_dlp.downloader.external 裡的 Popen 達成，只需安裝一次。
+    """
+    _lock = threading.Lock()
+    _procs = {}
+    _installed = False
+
+    @classmethod
+    def install(cls):
+        with cls._lock:
+            if cls._installed:
+                return
+            from yt_dlp.downloader import external
+
+            class _TrackedPopen(external.Popen):
+                def __init__(self, *args, **kwargs):
+                    super().__init__(*args, **kwargs)
+                    self._owner = threading.get_ident()
+                    with cls._lock:
+                        cls._procs[self._owner] = self
+
+                def __exit__(self, *exc):
+                    with cls._lock:
+                        if cls._procs.get(self._owner) is self:
+                            del cls._procs[self._owner]
+                    return super().__exit__(*exc)
+
+            external.Popen = _TrackedPopen
+            cls._installed = True
+
+    @classmethod
+    def request_stop(cls, thread_ident, force: bool = False) -> bool:
+        """
+        對該執行緒目前的 ffmpeg 送 'q'；force=True 或送不出去時直接結束程序。
+        回傳 False 表示目前沒有在跑的 ffmpeg（例如原生分片錄製，改由 hook 處理）。
+        """
+        with cls._lock:
+            proc = cls._procs.get(thread_ident)
+        if proc is None or proc.poll() is not None:
+            return False
+        if not force and proc.stdin is not None:
+            try:
+                proc.stdin.write(b'q')
+                proc.stdin.flush()
+                return True
+            except (OSError, ValueError):
+                pass
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        return True
+
+
+class NetworkSession:
+    """
+    所有工作共用的連線狀態：一份 cookie jar、一個 request director（連線池、TLS 連線）與擷取器清單。
+    每個工作仍各自建 YoutubeDL（hook、格式、輸出路徑都不同），但建好後把這些換成共用的，
+    cookies.txt 只在 mtime 變了才重新解析，連到同一站也不必每個工作重新握手。
+    YoutubeDL 預設建構時要花約 90 ms 排出一千多個擷取器的清單，這裡以 auto_init=False 建立，
+    直接複製常駐 YoutubeDL 排好的清單。擷取器實例（_ies_instances）則不共用：實例綁在建立它的
+    YoutubeDL 上（set_downloader），抽取時讀的是那個工作的參數與 hook，同時進行的工作不能共用；
+    實例本身的初始化約 2 ms。
+    """
+    def __init__(self, cookie_path: str, quiet: bool = False):
+        self.cookie_path = cookie_path
+        self.quiet = quiet
+        self._lock = threading.Lock()
+        self._jar = None
+        self._mtime = None
+        self._director = None
+        self._owner = None
+
+    def _cookie_mtime(self):
+        try:
+            return os.stat(self.cookie_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load_jar(self):
+        jar = _TrackedCookieJar(self.cookie_path)
+        if self._mtime is not None:
+            jar.load()
+        jar.changed = False
+        return jar
+
+    def cookiejar(self):
+        """
+        共用的 cookie jar；cookies.txt 被換掉（例如重新匯出）時就地換成新內容，
+        request director 拿的是同一個物件，不用重建。
+        """
+        with self._lock:
+            mtime = self._cookie_mtime()
+            if self._jar is None:
+                self._mtime = mtime
+                self._jar = self._load_jar()
+            elif mtime != self._mtime:
+                self._mtime = mtime
+                fresh = self._load_jar()
+                with self._jar._cookies_lock:
+                    self._jar._cookies = fresh._cookies
+                self._jar.changed = False
+            return self._jar
+
+    def _shared(self, jar):
+        """
+        常駐的 YoutubeDL：提供共用的 director 與排好的擷取器清單（網路相關參數所有工作都一樣）。
+        """
+        with self._lock:
+            if self._owner is None:
+                owner = yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': self.quiet})
+                owner.cookiejar = jar
+                self._director = owner._request_director
+                self._owner = owner
+            return self._owner
+
+    def open(self, opts: dict):
+        """
+        建立工作用的 YoutubeDL 並換上共用的 cookie jar 與 director。
+        """
+        jar = self.cookiejar()
+        opts = dict(opts)
+        if self._mtime is not None:
+            opts['cookiefile'] = self.cookie_path   # 擷取器靠這個判斷使用者有沒有給 cookies
+        owner = self._shared(jar)
+        ydl = yt_dlp.YoutubeDL(opts, auto_init=False)
+        ydl._ies = dict(owner._ies)       # 副本：工作可以再 add_info_extractor 而不影響別人
+        ydl.cookiejar = jar
+        ydl._request_director = self._director
+        return ydl
+
+    def release(self, ydl):
+        """
+        取代 ydl.close()：共用的 director 不能跟著關；cookie 有變才寫回檔案，
+        寫完記下新的 mtime，免得下個工作把自己寫的檔案當成外部更新又重讀一次。
+        """
+        ydl.__dict__.pop('_request_director', None)
+        ydl.params.pop('cookiefile', None)
+        ydl.close()
+        with self._lock:
+            jar = self._jar
+            if jar is None or not jar.changed or self._mtime is None:
+                return
+            if self._cookie_mtime() != self._mtime:
+                return      # 檔案已被外部換掉，下次 cookiejar() 會重讀，不要蓋掉
+            jar.changed = False
+            try:
+                jar.save()
+            except OSError:
+                return
+            self._mtime = self._cookie_mtime()
+
+
+class ExtractionCache:
+    """
+    extract_info 結果的本機快取，一筆一個 JSON 檔，以 normalize_url() 後的網址為 key。
+    讀取時會更新檔案 mtime；總大小超過 max_bytes 時從最久沒用的開始刪（LRU）。
+    """
+    def __init__(self, root: str, max_bytes: int = 64 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = collections.OrderedDict()   
+        self._total = 0
+        os.makedirs(root, exist_ok=True)
+
+        entries = []
+        for fn in os.listdir(root):
+            if not fn.endswith(".json"):
+                continue
+            try:
+                st = os.stat(os.path.join(root, fn))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, fn, st.st_size))
+        for _, fn, size in sorted(entries):
+            self._index[fn] = size
+            self._total += size
+
+    def _name(self, key: str) -> str:
+        return hashlib.sha1(normalize_url(key).encode("utf-8")).hexdigest() + ".json"
+
+    def get(self, key: str, with_expiry: bool = False):
+        """
+        回傳快取的 info；沒有、已過期或檔案損毀時回傳 None。
+        with_expiry=True 時回傳 (info, 到期時間)，查不到為 (None, None)。
+        """
+        miss = (None, None) if with_expiry else None
+        name = self._name(key)
+        with self._lock:
+            if name not in self._index:
+                return miss
+        path = os.path.join(self.root, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                rec = json.load(f)
+        except (OSError, ValueError):
+            self.invalidate(key)
+            return miss
+        if rec.get("key") != normalize_url(key) or rec.get("expires", 0) <= time.time():
+            self.invalidate(key)
+            return miss
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if name in self._index:
+                self._index.move_to_end(name)
+        info = strip_cookies(rec.get("info"))       # 舊版寫進去的 cookies 也不讀回來
+        if with_expiry:
+            return info, rec.get("expires")
+        return info
+
+    def put(self, key: str, info: dict, ttl: int):
+        """
+        寫入前先 strip_cookies：快取目錄就在程式旁邊，不能留下 session cookie。
+        """
+        if not info or ttl <= 0:
+            return
+        info = strip_cookies(info)
+        name = self._name(key)
+        path = os.path.join(self.root, name)
+        now = time.time()
+        rec = {"key": normalize_url(key), "created": now, "expires": now + ttl, "info": info}
+        data = json.dumps(rec, ensure_ascii=False).encode("utf-8")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try: os.remove(tmp)
+            except OSError: pass
+            return
+        with self._lock:
+            self._total -= self._index.pop(name, 0)
+            self._index[name] = len(data)
+            self._total += len(data)
+            while self._total > self.max_bytes and len(self._index) > 1:
+                old, size = self._index.popitem(last=False)
+                self._total -= size
+                try: os.remove(os.path.join(self.root, old))
+                except OSError: pass
+
+    def invalidate(self, key: str):
+        name = self._name(key)
+        with self._lock:
+            self._total -= self._index.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.root, name))
+        except OSError:
+            pass
+
+
+class BloomFilter:
+    """
+    固定大小的位元陣列 + k 個雜湊（blake2b 雙雜湊），百萬筆約 1.2 MB；只會誤判「可能有」。
+    """
+    def __init__(self, capacity: int, error_rate: float = ARCHIVE_BLOOM_ERROR):
+        capacity = max(1024, int(capacity))
+        self.bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.capacity = capacity
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._array[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class DownloadArchive:
+    """
+    已下載清單：檔案格式與 yt-dlp --download-archive 相同（一行「extractor id」），可互相沿用。
+    查詢先過 Bloom filter，絕大多數新網址在這裡就確定沒下載過；可能命中時再用 set 精確比對。
+    筆數超過 ARCHIVE_SET_LIMIT 時放掉 set，只在 Bloom 命中時讀檔確認，記憶體維持在 MB 等級。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids = set()
+        self._exact = True
+        self.count = 0
+        self._load()
+
+    def _iter_file(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line
+        except OSError:
+            return
+
+    def _load(self, capacity: int = 0):
+        lines = sum(1 for _ in self._iter_file())
+        self._bloom = BloomFilter(max(capacity, lines * 2))
+        self._ids = set()
+        self._exact = lines <= ARCHIVE_SET_LIMIT
+        self.count = 0
+        for line in self._iter_file():
+            self._bloom.add(line)
+            if self._exact:
+                self._ids.add(line)
+            self.count += 1
+
+    def _contains(self, archive_id: str) -> bool:
+        if archive_id not in self._bloom:
+            return False
+        if self._exact:
+            return archive_id in self._ids
+        return any(line == archive_id for line in self._iter_file())
+
+    def __contains__(self, archive_id: str | None) -> bool:
+        if not archive_id or not self.count:
+            return False
+        with self._lock:
+            return self._contains(archive_id)
+
+    def add(self, archive_id: str | None):
+        if not archive_id:
+            return
+        with self._lock:
+            if self.count and self._contains(archive_id):
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(archive_id + "\n")
+            self.count += 1
+            if self.count > self._bloom.capacity:
+                self._load(self.count * 2)       # 超過設計容量誤判率會升高，重建成兩倍大
+                return
+            self._bloom.add(archive_id)
+            if self._exact:
+                self._ids.add(archive_id)
+                if len(self._ids) > ARCHIVE_SET_LIMIT:
+                    self._ids = set()
+                    self._exact = False
+
+
+class OutputCatalog:
+    """
+    下載紀錄（SQLite，放在各 <網域>_<格式> 輸出目錄旁）：每個工作一列，以 extractor:id:格式 為鍵，
+    記下來源、輸出路徑、大小與各階段時間。hook 回報時就寫入，完成後找檔案直接查索引，
+    不用再 listdir 整個輸出目錄比對時間，同時跑多個工作也不會抓錯檔。
+    """
+    _COLUMNS = ('video_id', 'extractor', 'url', 'fmt_kind', 'title', 'path', 'size',
+                'started', 'downloaded', 'finished', 'status')
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error:
+            # 目錄不可寫等情況：退回記憶體內，本次執行照樣可用
+            self._db = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            " key TEXT PRIMARY KEY, video_id TEXT, extractor TEXT, url TEXT, fmt_kind TEXT,"
+            " title TEXT, path TEXT, size INTEGER,"
+            " started REAL, downloaded REAL, finished REAL, status TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outputs_path ON outputs(path)")
+
+    @staticmethod
+    def key_for(info: dict, fmt_kind: str, url: str) -> str:
+        extractor = info.get('extractor_key') or info.get('ie_key') or 'Generic'
+        return f"{extractor}:{info.get('id') or url}:{fmt_kind}"
+
+    def begin(self, job, info: dict, fmt_kind: str | None = None) -> str:
+        fmt_kind = fmt_kind or job.fmt_kind
+        key = self.key_for(info, fmt_kind, job.url)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO outputs (key, video_id, extractor, url, fmt_kind, title, started, status)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, 'downloading')"
+                " ON CONFLICT(key) DO UPDATE SET url=excluded.url, title=excluded.title,"
+                " started=excluded.started, finished=NULL, status='downloading'",
+                (key, info.get('id'), info.get('extractor_key') or info.get('ie_key'),
+                 job.url, fmt_kind, info.get('title'), time.time()))
+        return key
+
+    def update(self, key: str | None, **fields):
+        if not key or not fields:
+            return
+        cols = [c for c in fields if c in self._COLUMNS]
+        with self._lock:
+            self._db.execute(
+                f"UPDATE outputs SET {', '.join(c + '=?' for c in cols)} WHERE key=?",
+                [fields[c] for c in cols] + [key])
+
+    def path(self, key: str | None) -> str | None:
+        if not key:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT path FROM outputs WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+class JobMetrics:
+    """
+    單一工作的時間軸：各階段起訖（time.time()，後製子程序回傳的時間可直接併入）、
+    位元組、平均/最高速度、重試與略過的分片數、實際下載的格式。
+    同一階段可出現多次（影/音分軌各下載一次、暫停後續傳）。hook 可能來自分片執行緒，故加鎖。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = []
+        self._open = {}
+        self.attempts = 0
+        self.bytes = 0
+        self.peak_speed = 0.0
+        self.retries = 0
+        self.skipped_fragments = 0
+        self.fallbacks = 0
+        self.refreshes = 0
+        self.format_ids = []
+        self.format_reason = None
+        self.audio_plan = {}
+        self.outcome = None
+
+    def begin(self, name: str, at: float | None = None):
+        with self._lock:
+            self._open.setdefault(name, at or time.time())
+
+    def end(self, name: str, at: float | None = None):
+        with self._lock:
+            start = self._open.pop(name, None)
+            if start is not None:
+                self.phases.append((name, start, at or time.time()))
+
+    def add(self, name: str, start: float, end: float):
+        with self._lock:
+            self.phases.append((name, start, end))
+
+    def close(self):
+        """
+        工作結束時把還沒收尾的階段（中止、失敗時）一律結束在現在。
+        """
+        now = time.time()
+        with self._lock:
+            for name, start in self._open.items():
+                self.phases.append((name, start, now))
+            self._open.clear()
+
+    def record_progress(self, d: dict):
+        st = d.get('status')
+        with self._lock:
+            if st == 'downloading':
+                if 'download' not in self._open:
+                    self._open['download'] = time.time()
+                speed = d.get('speed')
+                if speed and speed > self.peak_speed:
+                    self.peak_speed = float(speed)
+            elif st == 'finished':
+                start = self._open.pop('download', None)
+                if start is not None:
+                    self.phases.append(('download', start, time.time()))
+                self.bytes += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+                fid = (d.get('info_dict') or {}).get('format_id')
+                if fid and fid not in self.format_ids:
+                    self.format_ids.append(fid)
+
+    def seconds(self, name: str) -> float:
+        return sum(end - start for n, start, end in self.phases if n == name)
+
+    def as_record(self, job) -> dict:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        transfer = self.seconds('download')
+        return {
+            'job': job.id, 'url': job.url, 'title': job.title,
+            'format': job.fmt_kind, 'quality': job.quality, 'outcome': self.outcome,
+            'started': round(phases[0][1], 3) if phases else None,
+            'finished': round(max(p[2] for p in phases), 3) if phases else None,
+            'attempts': self.attempts, 'bytes': self.bytes,
+            'avg_speed': round(self.bytes / transfer, 1) if transfer > 0 else None,
+            'peak_speed': round(self.peak_speed, 1) or None,
+            'retries': self.retries, 'skipped_fragments': self.skipped_fragments,
+            'refreshes': self.refreshes, 'fallbacks': self.fallbacks, 'format_ids': self.format_ids,
+            'format_reason': self.format_reason, 'audio_plan': self.audio_plan,
+            'phases': [{'phase': n, 'start': round(a, 3), 'end': round(b, 3), 'seconds': round(b - a, 3)}
+                       for n, a, b in phases],
+        }
+
+
+class MetricsLog:
+    """
+    工作結束時把 JobMetrics 附加一行到 JSON lines 檔；有給 prom_path 時，
+    另把本次執行的累計值重寫成 Prometheus 文字格式（node_exporter textfile collector 可直接讀）。
+    先寫暫存檔再 os.replace，讀取端不會讀到寫一半的檔案。
+    """
+    def __init__(self, path: str, prom_path: str | None = None):
+        self.path = path
+        self.prom_path = prom_path
+        self._lock = threading.Lock()
+        self._jobs = collections.Counter()
+        self._phase_seconds = collections.Counter()
+        self._phase_count = collections.Counter()
+        self._totals = collections.Counter()
+        self._peak_speed = 0.0
+
+    def record(self, job):
+        rec = job.metrics.as_record(job)
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with self._lock:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError:
+                pass
+            self._jobs[rec['outcome']] += 1
+            for ph in rec['phases']:
+                self._phase_seconds[ph['phase']] += ph['seconds']
+                self._phase_count[ph['phase']] += 1
+            self._totals['bytes'] += rec['bytes']
+            self._totals['download_seconds'] += job.metrics.seconds('download')
+            self._totals['retries'] += rec['retries']
+            self._totals['skipped_fragments'] += rec['skipped_fragments']
+            self._totals['refreshes'] += rec['refreshes']
+            self._totals['fallbacks'] += rec['fallbacks']
+            self._peak_speed = max(self._peak_speed, rec['peak_speed'] or 0)
+            if self.prom_path:
+                self._write_prom()
+
+    def _write_prom(self):
+        lines = [
+            "# HELP ytdl_jobs_total 結束的工作數（依結果）",
+            "# TYPE ytdl_jobs_total counter",
+        ]
+        lines += [f'ytdl_jobs_total{{outcome="{k}"}} {v}' for k, v in sorted(self._jobs.items())]
+        lines += [
+            "# HELP ytdl_phase_seconds 各階段累計耗時",
+            "# TYPE ytdl_phase_seconds summary",
+        ]
+        for phase in sorted(self._phase_count):
+            lines.append(f'ytdl_phase_seconds_sum{{phase="{phase}"}} {self._phase_seconds[phase]:.3f}')
+            lines.append(f'ytdl_phase_seconds_count{{phase="{phase}"}} {self._phase_count[phase]}')
+        for name, kind, help_text, value in (
+            ("downloaded_bytes_total", "counter", "下載的位元組", self._totals['bytes']),
+            ("download_seconds_total", "counter", "傳輸階段累計秒數（與位元組相除即平均速度）",
+             round(self._totals['download_seconds'], 3)),
+            ("retries_total", "counter", "HTTP/分片重試次數", self._totals['retries']),
+            ("skipped_fragments_total", "counter", "重試後仍略過的分片數", self._totals['skipped_fragments']),
+            ("hls_refreshes_total", "counter", "HLS 清單過期後重新取得並接續分片的次數", self._totals['refreshes']),
+            ("fallbacks_total", "counter", "HLS 失效改用 DASH/mp4 的次數", self._totals['fallbacks']),
+            ("peak_speed_bytes", "gauge", "單一工作出現過的最高速度（bytes/s）", round(self._peak_speed, 1)),
+        ):
+            lines += [f"# HELP ytdl_{name} {help_text}", f"# TYPE ytdl_{name} {kind}", f"ytdl_{name} {value}"]
+        tmp = self.prom_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp, self.prom_path)
+        except OSError:
+            pass
+
+
+class DownloadJob:
+    """
+    單一下載工作的狀態。每個 URL 各自一份，暫停/中止/檔名等互不干擾。
+    送出時就把 UI 上的格式、畫質、密碼記下來，之後改 UI 不影響已排隊的工作；
+    限速則是全域設定（BandwidthScheduler），隨時調整都會套用到進行中的工作。
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, url: str, fmt_kind: str, quality: str,
+                 password: str | None = None,
+                 use_cache: bool = True, parent: "DownloadJob | None" = None,
+                 use_archive: bool = True, extra_kinds=()):
+        self.id = next(DownloadJob._ids)
+        self.url = url
+        self.fmt_kind = fmt_kind
+        # 同一次下載另外要產出的格式（從本機檔案轉，不再連網）
+        self.extra_kinds = tuple(k for k in dict.fromkeys(extra_kinds) if k != fmt_kind)
+        self.quality = quality
+        self.priority = False
+        self.password = password
+        self.use_cache = use_cache
+        self.use_archive = use_archive
+        self.archive_id = None
+
+        # 播放清單：parent 指向清單工作；清單工作本身的 children 為子工作列表
+        self.parent = parent
+        self.children = None
+        self.feeding = False
+        self.entry_slots = None
+        self.slot_released = False
+        self.ie_key = None
+        self.entry_info = None
+
+        self.pause_flag = False
+        self.stop_flag = False
+        # 剛丟出 FragmentLost：執行緒池裡已排進去的分片在第一次進度回報就中止，不再整段抓完
+        self.fragments_lost = False
+        self.paused = False
+        self.running = False
+        self.done = False
+        self.failed = False
+        self.title = None
+        self.last_filename = None
+        self.catalog_key = None
+        self.source_bitrate_kbps = None
+        self.audio_notes = []
+        # 多格式工作：[(格式, 本機來源檔, 後處理器, 下載紀錄鍵)]、後製結果與產出的檔案
+        self.derived = []
+        self.post_futures = {}
+        self.post_pending = 0
+        self.derived_paths = {}
+        self.is_live = False
+        self.live_reported = 0.0
+        self.worker_ident = None
+        self.ydl = None
+        self.final_path = None
+        # 暫停續傳：最後一次進度（bytes、分片序號）、解析結果的到期時間與續傳紀錄
+        self.last_progress = None
+        self.info_expires = None
+        self.resume = None
+        # 分片下載中的格式：format_id → (分片總數, 輸出檔名)。清單過期換新時用來確認分片序號還對得上，
+        # 改用別的格式前用來清掉接不上的 .part / .ytdl
+        self.hls_parts = {}
+        self.journal_id = None
+        self.finished = threading.Event()
+        self.metrics = JobMetrics()
+        self.status = "排隊中"
+        self.progress = ""
+
+    def reset_flags(self):
+        self.pause_flag = False
+        self.stop_flag = False
+        self.fragments_lost = False
+        self.paused = False
+
+    @property
+    def priority_weight(self) -> float:
+        return PRIORITY_WEIGHT if self.priority else 1
+
+    @classmethod
+    def for_entry(cls, parent: "DownloadJob", url: str) -> "DownloadJob":
+        """
+        播放清單中的一項：沿用清單工作送出時的設定。
+        """
+        child = cls(url, parent.fmt_kind, parent.quality,
+                           password=parent.password,
+                           use_cache=parent.use_cache, parent=parent,
+                           use_archive=parent.use_archive, extra_kinds=parent.extra_kinds)
+        child.priority = parent.priority
+        return child
+
+
+class JobJournal:
+    """
+    工作的預寫日誌（JSON lines，只附加）：送出（submit）、狀態變化（update）、結束（done）各一筆。
+    寫入先排進記憶體，由背景執行緒每 JOURNAL_FSYNC_INTERVAL 秒批次寫入並 fsync 一次，不會每個事件都等磁碟。
+    開啟時重播整份日誌，還沒 done 的就是上次沒做完的工作（pending）；
+    重播後把日誌壓縮成只剩這些工作，檔案不會無限長大。最後一行若在當機時只寫了一半就略過。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._pending_lines = []
+        self._closed = False
+        self.pending = self._replay()
+        self._f = None
+        try:
+            self._compact()
+            self._f = open(path, "a", encoding="utf-8")
+        except OSError:
+            return      # 目錄不可寫：本次執行不記日誌
+        threading.Thread(target=self._writer, name="job-journal", daemon=True).start()
+        atexit.register(self.close)
+
+    def _replay(self) -> list:
+        jobs = {}
+        try:
+            f = open(self.path, "r", encoding="utf-8")
+        except OSError:
+            return []
+        with f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                op, key = rec.pop('op', None), rec.pop('id', None)
+                rec.pop('time', None)
+                if op == 'submit':
+                    jobs[key] = dict({'state': 'queued'}, **rec)
+                elif key in jobs:
+                    if op == 'done':
+                        del jobs[key]
+                    elif op == 'update':
+                        jobs[key].update(rec)
+        return [dict(rec, id=key) for key, rec in jobs.items()]
+
+    def _compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in self.pending:
+                f.write(json.dumps(dict(rec, op='submit'), ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def append(self, op: str, job_id: str, **fields):
+        if self._f is None:
+            return
+        rec = {'op': op, 'id': job_id, 'time': round(time.time(), 3)}
+        rec.update(fields)
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with self._cond:
+            self._pending_lines.append(line)
+            self._cond.notify()
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while not self._pending_lines and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            time.sleep(JOURNAL_FSYNC_INTERVAL)     # 收集這段時間內的其他事件，一起寫一起 fsync
+            self._flush()
+
+    def _flush(self):
+        with self._cond:
+            lines, self._pending_lines = self._pending_lines, []
+        if not lines or self._f is None:
+            return
+        with self._io_lock:
+            try:
+                self._f.write("".join(lines))
+                self._f.flush()
+                os.fsync(self._f.fileno())
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        正常結束時把還在佇列裡的事件寫完（由 atexit 呼叫）。
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flush()
+
+
+class DownloadQueue:
+    """
+    有上限的工作池：最多同時跑 max_workers 個工作，其餘依序排隊。
+    每個工作在自己的執行緒上跑 runner(job)，跑完就從佇列補下一個。
+    """
+    def __init__(self, runner, max_workers: int = 3):
+        self._runner = runner
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._running = 0
+        self.max_workers = max(1, int(max_workers))
+
+    def submit(self, job: DownloadJob):
+        with self._lock:
+            self._pending.append(job)
+        self._pump()
+
+    def cancel_pending(self, job: DownloadJob) -> bool:
+        """
+        還沒開始的工作直接從佇列拿掉；回傳 True 表示確實在排隊中。
+        """
+        with self._lock:
+            try:
+                self._pending.remove(job)
+                return True
+            except ValueError:
+                return False
+
+    def set_max_workers(self, n: int):
+        with self._lock:
+            self.max_workers = max(1, int(n))
+        self._pump()
+
+    def depth(self) -> tuple:
+        """
+        (執行中, 排隊中)。
+        """
+        with self._lock:
+            return self._running, len(self._pending)
+
+    def _pump(self):
+        with self._lock:
+            while self._running < self.max_workers and self._pending:
+                job = self._pending.popleft()
+                self._running += 1
+                threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job: DownloadJob):
+        try:
+            self._runner(job)
+        finally:
+            with self._lock:
+                self._running -= 1
+            self._pump()
+
+
+class EngineListener:
+    """
+    DownloadEngine 回報事件的介面；預設全部不做事，GUI 與命令列各自覆寫需要的部分。
+    這些方法會在下載執行緒上被呼叫，實作端需自行切回自己的執行緒（例如 Tk 的 after）。
+    """
+    def on_job_added(self, job): pass
+    def on_status(self, job, text: str): pass
+    def on_title(self, job, text: str): pass
+    def on_job_changed(self, job): pass
+    def on_job_finished(self, job): pass
+    def on_failed(self, job): pass
+    def on_warning(self, title: str, text: str): pass
+
+
+class DownloadEngine:
+    """
+    與 UI 無關的下載流程：格式預設、站點設定、直播偵測、HLS 回退、MP4 修復、位元率探測。
+    Tk 視窗與 --batch 命令列共用同一套，進度由 self.progress 讓 UI 自行定時取用。
+    """
+    def __init__(self, listener: EngineListener, max_workers: int = 3, quiet: bool = False,
+                 max_fragments: int = FRAGMENT_CONCURRENCY_MAX,
+                 post_workers: int = POSTPROCESS_WORKERS, rate_limit: int | None = None,
+                 metrics_prom: str | None = None, journal: str | None = None,
+                 data_dir: str | None = None, state_dir: str | None = None,
+                 session: "NetworkSession | None" = None):
+        # data_dir：解析快取與 cookies.txt，預設在程式旁；state_dir：下載紀錄資料庫、指標與已下載清單，預設為目前目錄
+        data_dir = data_dir or os.path.dirname(os.path.abspath(__file__))
+        self.state_dir = os.path.abspath(state_dir or os.curdir)
+        self.listener = listener
+        self.quiet = quiet
+        self.jobs = {}
+        self.ffprobe_warned = False
+        self._playlist_lock = threading.Lock()
+        self.progress = ProgressAggregator()
+        self.fragments = FragmentConcurrency(max_n=max_fragments)
+        self.scorer = FormatScorer()
+        self.bandwidth = BandwidthScheduler(rate_limit)
+        self.queue = DownloadQueue(self.download, max_workers=max_workers)
+        self.postproc = PostProcessPool(post_workers)
+        self.extract_cache = ExtractionCache(os.path.join(data_dir, 'extract_cache'))
+        self.catalog = OutputCatalog(os.path.join(self.state_dir, CATALOG_FILE))
+        self.metrics = MetricsLog(os.path.join(self.state_dir, METRICS_FILE), metrics_prom)
+        self.journal = JobJournal(journal) if journal else None
+        self.session = session or NetworkSession(os.path.join(data_dir, 'cookies.txt'), quiet=quiet)
+        self._archives = {}
+        self._archives_lock = threading.Lock()
+        self._post_lock = threading.Lock()
+
+    def submit(self, job: DownloadJob):
+        self.jobs[job.id] = job
+        if self.journal is not None and job.parent is None and job.journal_id is None:
+            # 播放清單的子項不記：恢復時重跑清單，已下載的由下載紀錄略過
+            job.journal_id = uuid.uuid4().hex
+            self.journal.append('submit', job.journal_id, url=job.url, fmt_kind=job.fmt_kind,
+                                quality=job.quality, use_cache=job.use_cache,
+                                use_archive=job.use_archive, priority=job.priority,
+                                extra_kinds=list(job.extra_kinds))
+        job.metrics.begin('queue')
+        self.queue.submit(job)
+
+    def _journal(self, job: DownloadJob, **fields):
+        if self.journal is not None and job.journal_id is not None:
+            self.journal.append('update', job.journal_id, **fields)
+
+    def open_journal(self, path: str) -> list:
+        """
+        建好引擎之後才開啟工作日誌，並恢復上次沒做完的工作（回傳值同 restore_journal）。
+        """
+        self.journal = JobJournal(path)
+        return self.restore_journal()
+
+    def restore_journal(self) -> list:
+        """
+        把上次沒做完的工作重新建立：暫停中的維持暫停，其餘直接排入佇列。
+        有續傳紀錄且網址仍有效的不必重新解析，.part 檔由 yt-dlp 接著下載。
+        回傳恢復的工作（UI 自行加入列表）。密碼不寫進日誌，需要密碼的工作恢復後要重新送出。
+        """
+        if self.journal is None:
+            return []
+        restored = []
+        for rec in self.journal.pending:
+            job = DownloadJob(rec['url'], rec['fmt_kind'], rec['quality'],
+                              use_cache=rec.get('use_cache', True),
+                              use_archive=rec.get('use_archive', True),
+                              extra_kinds=rec.get('extra_kinds') or ())
+            job.journal_id = rec['id']
+            job.priority = bool(rec.get('priority'))
+            job.title = rec.get('title')
+            job.resume = rec.get('resume')
+            restored.append(job)
+            if rec.get('state') == 'paused':
+                self.jobs[job.id] = job
+                job.paused = True
+                job.status = "已暫停"
+            else:
+                self.submit(job)
+        self.journal.pending = []
+        return restored
+
+    def set_max_workers(self, n: int):
+        self.queue.set_max_workers(n)
+
+    def set_rate_limit(self, rate: int | None):
+        """
+        全部工作合計的限速（bytes/s，None=不限），立即套用到進行中的下載。
+        """
+        self.bandwidth.set_rate(rate)
+
+    def set_priority(self, job: DownloadJob, priority: bool):
+        job.priority = priority
+        self._journal(job, priority=priority)
+        self.bandwidth.set_weight(job, job.priority_weight)
+        self.listener.on_job_changed(job)
+
+    def pause(self, job: DownloadJob):
+        if job.done or job.paused:
+            return
+        if job.children is not None:
+            # 播放清單本身：只控制是否繼續排入新項目
+            job.paused = True
+            self._update_status("播放清單已暫停", job)
+        elif self.queue.cancel_pending(job):
+            job.paused = True
+            self._update_status("已暫停", job)
+        elif not job.is_live:
+            job.pause_flag = True
+        self.listener.on_job_changed(job)
+
+    def resume(self, job: DownloadJob):
+        if job.done or not job.paused:
+            return
+        job.paused = False
+        if job.children is not None:
+            self._update_status("播放清單繼續…", job)
+        else:
+            self._update_status("重新續傳…", job)
+            self._journal(job, state='queued')
+            job.metrics.begin('queue')
+            self.queue.submit(job)
+        self.listener.on_job_changed(job)
+
+    def stop(self, job: DownloadJob):
+        if job.done:
+            return
+
+        if job.children is not None:
+            job.stop_flag = True
+            job.paused = False
+            return
+
+        if job.is_live and job.running:
+            # 直播：讓錄製正常收尾並照常後製，而不是丟掉整段錄影
+            job.stop_flag = True
+            LiveCapture.request_stop(job.worker_ident)
+            self._update_status("正在結束直播錄製…", job)
+            return
+
+        if job.paused or self.queue.cancel_pending(job):
+            self._finish_job(job, "已中止。已下載的部分已保留（.part），可日後續傳。")
+            return
+
+        job.stop_flag = True
+
+    def stage_depths(self) -> dict:
+        """
+        各管線階段的佇列深度，用來看瓶頸在下載端還是後製端。
+        """
+        dl_running, dl_pending = self.queue.depth()
+        pp_running, pp_pending, pp_blocked = self.postproc.depth()
+        return {
+            'download_running': dl_running, 'download_pending': dl_pending,
+            'post_running': pp_running, 'post_pending': pp_pending, 'post_blocked': pp_blocked,
+        }
+
+    def archive_for(self, fmt_kind: str) -> DownloadArchive:
+        """
+        每種輸出格式各一份已下載清單（下載過 MP4 仍可另外抓 MP3）。
+        """
+        with self._archives_lock:
+            archive = self._archives.get(fmt_kind)
+            if archive is None:
+                archive = DownloadArchive(os.path.join(self.state_dir, ARCHIVE_FILE.format(fmt=fmt_kind)))
+                self._archives[fmt_kind] = archive
+            return archive
+
+    def _skip_archived(self, job: DownloadJob):
+        job.metrics.outcome = 'skipped'
+        self._finish_job(job, "已下載過（下載紀錄中已有），略過。")
+
+    def wait_all(self, poll: float = 0.5):
+        """
+        阻塞到所有工作（含播放清單陸續展開的子工作）都結束為止，給命令列模式用。
+        """
+        while True:
+            pending = [j for j in list(self.jobs.values())
+                       if not j.finished.is_set() and not j.paused]
+            if not pending:
+                return
+            pending[0].finished.wait(poll)
+
+    def _finish_job(self, job: DownloadJob, text: str | None = None):
+        """
+        工作結束（完成/中止/失敗）：標記後更新列表與按鈕。
+        """
+        job.done = True
+        job.running = False
+        job.paused = False
+        if text is not None:
+            self._update_status(text, job)
+        self._release_playlist_slot(job)
+        self.fragments.forget(job)
+        self.bandwidth.forget(job)
+        if not job.finished.is_set():
+            if job.journal_id is not None and self.journal is not None:
+                self.journal.append('done', job.journal_id,
+                                    outcome='failed' if job.failed else 'finished')
+            if job.children is None:      # 播放清單本身沒有下載，只記子工作
+                m = job.metrics
+                m.outcome = m.outcome or ('failed' if job.failed else 'stopped')
+                m.close()
+                self.metrics.record(job)
+            job.finished.set()
+            self.listener.on_job_finished(job)
+
+    def _release_playlist_slot(self, job: DownloadJob):
+        """
+        子工作結束時把名額還給播放清單，讓它排入下一項。
+        """
+        parent = job.parent
+        if parent is None or job.slot_released:
+            return
+        job.slot_released = True
+        parent.entry_slots.release()
+        self._check_playlist_done(parent)
+
+    def _check_playlist_done(self, parent: DownloadJob):
+        with self._playlist_lock:
+            if parent.done or parent.feeding or not all(c.done for c in parent.children):
+                return
+            parent.done = True
+        total = len(parent.children)
+        failed = sum(1 for c in parent.children if c.failed)
+        if parent.stop_flag:
+            text = f"播放清單已中止（已處理 {total} 項）"
+        else:
+            text = f"播放清單完成：共 {total} 項" + (f"，{failed} 項失敗" if failed else "")
+        self._finish_job(parent, text)
+
+    def _fan_out_playlist(self, job: DownloadJob, ydl, playlist: dict):
+        """
+        播放清單以 flat 方式列出，交給背景執行緒邊讀邊排入子工作；
+        清單工作本身不佔工作池名額，也不會一次把所有項目解析完。
+        """
+        job.title = playlist.get('title') or job.url
+        job.children = []
+        job.feeding = True
+        job.entry_slots = threading.Semaphore(PLAYLIST_MAX_IN_FLIGHT)
+        self.listener.on_title(job, f"播放清單：{job.title}")
+        job.ydl = None      # 交給 _feed_playlist，lazy entries 翻頁時還要用到
+        threading.Thread(target=self._feed_playlist,
+                         args=(job, ydl, playlist.get('entries') or []),
+                         daemon=True).start()
+
+    def _feed_playlist(self, job: DownloadJob, ydl, entries):
+        count = 0
+        skipped = 0
+        archive = self.archive_for(job.fmt_kind) if job.use_archive else None
+        try:
+            for entry in entries:
+                if archive is not None and entry and archive.count:
+                    # 重新同步播放清單時，已下載的項目不建立子工作
+                    aid = info_archive_id(entry) or url_archive_id(entry.get('url') or '')
+                    if aid in archive:
+                        skipped += 1
+                        self._update_status(f"播放清單：已排入 {count} 項，略過 {skipped} 項已下載", job)
+                        continue
+                while job.paused and not job.stop_flag:
+                    time.sleep(0.5)
+                while not job.stop_flag and not job.entry_slots.acquire(timeout=0.5):
+                    pass
+                if job.stop_flag:
+                    break
+                if not entry:
+                    job.entry_slots.release()
+                    continue
+
+                entry_url = entry.get('url') or entry.get('webpage_url')
+                child = DownloadJob.for_entry(job, normalize_url(entry_url or job.url))
+                child.ie_key = entry.get('ie_key')
+                if entry.get('_type', 'video') == 'video' and entry.get('formats'):
+                    child.entry_info = entry     # 已由擷取器直接解析好的項目
+                child.title = entry.get('title')
+                job.children.append(child)
+                self.jobs[child.id] = child
+                self.listener.on_job_added(child)
+                child.metrics.begin('queue')
+                self.queue.submit(child)
+                count += 1
+                self._update_status(f"播放清單：已排入 {count} 項" +
+                                    (f"，略過 {skipped} 項已下載" if skipped else ""), job)
+        except Exception as e:
+            self._update_status(f"播放清單列舉失敗：{strip_ansi(str(e))}", job)
+        finally:
+            self.session.release(ydl)
+            job.feeding = False
+            self._check_playlist_done(job)
+
+    def download(self, job: DownloadJob):
+        """
+        單一路徑完成抓資訊 → 下載並支援暫停/續傳。由工作池在背景執行緒呼叫。
+        直播與一般影片共用同一個 YoutubeDL 與選項，只在錄製時調整少數參數。
+        """
+        url = job.url
+        job.reset_flags()
+        job.running = True
+        job.worker_ident = threading.get_ident()
+        job.metrics.end('queue')
+        job.metrics.attempts += 1
+        self._update_status("初始化下載 …", job)
+        self.listener.on_job_changed(job)
+        try:
+            if not YtDlpLoader.ready():
+                job.metrics.begin('load_yt_dlp')
+            YtDlpLoader.ensure()
+            job.metrics.end('load_yt_dlp')
+        except Exception as e:
+            job.failed = True
+            self._finish_job(job, f"錯誤：無法載入 yt-dlp：{e}")
+            self.listener.on_failed(job)
+            return
+
+        archive = self.archive_for(job.fmt_kind) if job.use_archive else None
+        if archive is not None and archive.count and job.entry_info is None:
+            # 從網址就認得出來的已下載項目：連抽取都不用做
+            if url_archive_id(url) in archive:
+                self._skip_archived(job)
+                return
+
+        try:
+            ydl_opts = self._build_base_opts(job)
+            self._add_format_opts(ydl_opts, job)
+
+            fmt_kind = job.fmt_kind
+            netloc = urlparse(url).netloc.lower().split(':', 1)[0]
+            domain_for_dir = re.sub(r'[^a-z0-9.-]', '_', netloc)
+            save_dir = f"{domain_for_dir}_{fmt_kind}"
+            os.makedirs(save_dir, exist_ok=True)
+            ydl_opts['outtmpl'] = os.path.join(save_dir, '%(title)s.%(ext)s')
+            # 抽音訊等後處理不在下載執行緒做，留給後製段
+            postprocessors = ydl_opts.pop('postprocessors', [])
+
+            # 同一個 YoutubeDL 從抽取用到下載與 HLS 回退，整個工作只抽取一次
+            ydl = self.session.open(ydl_opts)
+            job.ydl = ydl
+            resume = job.resume
+            if resume is not None:
+                # 續傳：釘住暫停前選定的格式，不會選到與 .part 不同的格式
+                self._pin_format(ydl, resume['format_spec'])
+            if resume is not None and resume['expires'] > time.time():
+                info = resume['info']
+                self._update_status(self._resume_text(resume), job)
+            else:
+                job.metrics.begin('extract')
+                info = self._extract_info(ydl, job)
+                job.metrics.end('extract')
+            if not info:
+                raise ydl_utils.DownloadError("無法取得影片資訊")
+            if info.get('_type') in ('playlist', 'multi_video'):
+                self._fan_out_playlist(job, ydl, info)
+                return
+
+            job.archive_id = info_archive_id(info)
+            if archive is not None and job.archive_id in archive:
+                self._skip_archived(job)
+                return
+            if resume is None and fmt_kind not in ("mp3", "flac") and not info.get('is_live'):
+                info = self._score_formats(ydl, job, info, netloc)
+            if resume is None or info is not resume['info']:
+                job.resume = self._resume_record(ydl, job, info, ydl_opts.get('format'))
+            self._journal(job, state='downloading', title=info.get('title'), resume=job.resume)
+
+            if ydl_opts.get('merge_output_format') == 'mp4':
+                v_ext = (info.get('ext') or '').lower()
+                if v_ext and v_ext not in ('mp4', 'm4v', 'mov'):
+                    ydl.params.pop('merge_output_format', None)
+
+            job.source_bitrate_kbps = self._get_source_audio_bitrate_kbps(info)
+            postprocessors = self._plan_audio(job, ydl, info, postprocessors)
+            duration = info.get('duration')
+
+            title = info.get('title', '未知標題')
+            job.title = title
+            self.listener.on_title(job, f"下載中：{title}")
+            job.catalog_key = self.catalog.begin(job, info)
+
+            job.metrics.begin('download')     # 含連線建立；之後每個格式的傳輸由 _hook 記
+            try:
+                if info.get('is_live'):
+                    self._record_live(job, ydl, info)
+                else:
+                    self._process_info(ydl, info)
+            except Exception as e:
+                if not self._fragments_lost(e):
+                    raise e
+                self._drop_cancelled_fragments(job)
+                self.extract_cache.invalidate(url)
+                job.metrics.end('download')
+                # 先換新清單從斷掉的分片接續，接不上才整個改用非 HLS 格式
+                info = self._refresh_hls(job, ydl, info)
+                if info is not None:
+                    self._update_status("HLS 分片失效，嘗試改用 DASH/mp4 下載…", job)
+                    job.metrics.fallbacks += 1
+                    job.metrics.begin('hls_fallback')
+                    try:
+                        q = job.quality
+                        if q == "原片最高":
+                            fmt_str = "bestvideo[protocol!^=m3u8]+bestaudio[protocol!^=m3u8]/best[protocol!^=m3u8]"
+                        else:
+                            height = 2160 if q.lower() == "4k" else int(q.rstrip("p"))
+                            fmt_str = (
+                                f"bestvideo[height<={height}][protocol!^=m3u8]+"
+                                f"bestaudio[protocol!^=m3u8]/best[height<={height}][protocol!^=m3u8]"
+                            )
+
+                        self._discard_hls_parts(job)
+                        self._pin_format(ydl, fmt_str)
+                        if resume is not None and info is resume['info']:
+                            # 續傳紀錄只留了原本選中的格式，回退需要完整的格式清單
+                            info = self._extract_info(ydl, job)
+                        if job.resume is not None:
+                            job.resume['format_spec'] = fmt_str
+                        self._process_info(ydl, info)
+                    except Exception as e2:
+                        raise e2
+                    finally:
+                        job.metrics.end('hls_fallback')
+
+            if job.metrics.attempts == 1 and not job.metrics.refreshes:
+                self.scorer.observe(netloc, job.metrics.bytes, job.metrics.seconds('download'))
+            job.resume = None
+            final_path = self._resolve_final_output_path(job)
+            job.final_path = final_path
+            if job.extra_kinds:
+                job.derived = self._derive_outputs(job, ydl, info, final_path, domain_for_dir)
+            job.done = True
+            job.running = False
+            self._release_playlist_slot(job)
+            self.listener.on_job_changed(job)
+            self._post_process(job, final_path, duration, postprocessors)
+
+        except yt_dlp.utils.DownloadCancelled:
+            if job.stop_flag:
+                job.resume = None
+                self.catalog.update(job.catalog_key, status='stopped')
+                self._finish_job(job, "已中止。已下載的部分已保留（.part），可日後續傳。")
+                return
+            self.catalog.update(job.catalog_key, status='paused')
+            if job.resume is not None and job.last_progress is not None:
+                job.resume['downloaded_bytes'], job.resume['fragment_index'] = job.last_progress
+            self._journal(job, state='paused', resume=job.resume)
+            job.metrics.close()
+            self.bandwidth.forget(job)
+            job.running = False
+            job.paused = True
+            self._update_status("已暫停", job)
+            self.listener.on_job_changed(job)
+
+        except Exception as e:
+            self.extract_cache.invalidate(url)
+            job.resume = None
+            self.catalog.update(job.catalog_key, status='failed', finished=time.time())
+            job.failed = True
+            self._finish_job(job, f"錯誤：{strip_ansi(str(e))}")
+            self.listener.on_failed(job)
+
+        finally:
+            if job.ydl is not None:
+                self.session.release(job.ydl)
+                job.ydl = None
+
+    def _record_live(self, job: DownloadJob, ydl, info: dict):
+        """
+        直播直接用已抽取的 info 在本程序內錄製（不再另開 yt-dlp 子程序重新抽取）。
+        - HLS 直播由 yt-dlp 交給 ffmpeg：以 LiveCapture 取得該 ffmpeg，中止時送 'q' 讓它正常收尾
+        - live_from_start 等原生分片錄製：hook 收到中止時丟 KeyboardInterrupt，yt-dlp 視為正常結束
+        兩種情況錄到的部分都會照常後製（合併、轉檔、嵌入縮圖）。
+        """
+        job.is_live = True
+        LiveCapture.install()
+        ydl.params.update({
+            'hls_use_mpegts': True,               # 中途停止仍是可播放的 TS
+            'concurrent_fragment_downloads': 1,   # 原生分片只有單執行緒時才能優雅中止
+        })
+        ydl.params.pop('hls_prefer_native', None)
+        fmt_str = self._format_spec(job, live=True)
+        ydl.params['format'] = fmt_str
+        ydl.format_selector = ydl.build_format_selector(fmt_str)
+
+        self._update_status("直播錄製中…按「中止」會結束錄製並保留檔案。", job)
+        self.listener.on_job_changed(job)
+        done = threading.Event()
+        threading.Thread(target=self._watch_live, args=(job, ydl, info, done), daemon=True).start()
+        try:
+            self._process_info(ydl, info)
+        except KeyboardInterrupt:
+            if not job.stop_flag:
+                raise
+        finally:
+            done.set()
+
+    def _watch_live(self, job: DownloadJob, ydl, info: dict, done: threading.Event):
+        """
+        ffmpeg 錄製期間 yt-dlp 不會呼叫 progress hook：每秒看一次輸出檔大小，
+        以一般 hook 的欄位（downloaded_bytes / elapsed / speed）回報；
+        收到中止後送 'q'，逾時仍未結束才強制結束 ffmpeg。
+        """
+        base = os.path.splitext(ydl.prepare_filename(info))[0]
+        exts = {info.get('ext'), ydl.params.get('merge_output_format'), 'mp4', 'ts', 'mkv', 'webm', 'm4a'}
+        candidates = [f"{base}.{e}{suffix}" for e in exts if e for suffix in ('.part', '')]
+        t0 = time.monotonic()
+        last_size, last_t = 0, t0
+        stop_sent = None
+        while not done.wait(1.0):
+            now = time.monotonic()
+            if job.stop_flag:
+                if stop_sent is None:
+                    LiveCapture.request_stop(job.worker_ident)
+                    stop_sent = now
+                elif now - stop_sent > LIVE_STOP_GRACE:
+                    LiveCapture.request_stop(job.worker_ident, force=True)
+                continue
+            size = 0
+            for path in candidates:
+                try:
+                    size = max(size, os.path.getsize(path))
+                except OSError:
+                    pass
+            speed = (size - last_size) / max(now - last_t, 1e-3)
+            last_size, last_t = size, now
+            self._hook(job, {'status': 'downloading', 'downloaded_bytes': size,
+                             'elapsed': now - t0, 'speed': speed})
+
+    def _extract_info(self, ydl, job: DownloadJob) -> dict:
+        """
+        先查本機快取；命中時只在本地重跑格式選擇（不連網），否則完整抽取後寫入快取。
+        直播不快取。取消勾選快取時仍會以新結果覆寫舊紀錄。
+        串流網址的到期時間記在 job.info_expires，給暫停續傳判斷能否沿用。
+        """
+        if job.use_cache:
+            cached, expires = self.extract_cache.get(job.url, with_expiry=True)
+            if cached is not None:
+                self._update_status("使用快取的解析結果…", job)
+                job.info_expires = expires
+                return ydl.process_ie_result(cached, download=False)
+
+        if job.entry_info is not None:
+            info, job.entry_info = job.entry_info, None
+            job.info_expires = time.time() + extract_cache_ttl(job.url, info)
+            return ydl.process_ie_result(info, download=False)
+
+        # 先不處理（process=False），播放清單就能在解析任何一項之前被辨識出來
+        info = ydl.extract_info(job.url, download=False, process=False, ie_key=job.ie_key)
+        if info.get('_type') in ('playlist', 'multi_video'):
+            return info
+        info = ydl.process_ie_result(info, download=False)
+        if info.get('_type') in ('playlist', 'multi_video'):
+            return info
+        if info and not info.get('is_live'):
+            ttl = extract_cache_ttl(job.url, info)
+            job.info_expires = time.time() + ttl
+            self.extract_cache.put(job.url, ydl.sanitize_info(info), ttl)
+        return info
+
+    def _score_formats(self, ydl, job: DownloadJob, info: dict, host: str) -> dict:
+        """
+        以 FormatScorer 在畫質上限內改挑總大小最小的影音組合，釘住後在本地重跑格式選擇（不連網）。
+        原本的格式字串接在後面當備援；挑選理由寫進 yt-dlp 的輸出與工作統計。
+        """
+        q = job.quality
+        cap = None if q == "原片最高" else (2160 if q.lower() == "4k" else int(q.rstrip("p")))
+        speed = self.scorer.throughput(host)
+        if self.bandwidth.rate:
+            speed = min(speed or self.bandwidth.rate, self.bandwidth.rate)
+        picked = self.scorer.choose(info.get('formats') or [], info.get('duration'), cap,
+                                    ydl.params.get('merge_output_format'), speed)
+        if picked is None:
+            return info
+        spec, reason = picked
+        unchanged = spec == info.get('format_id')
+        job.metrics.format_reason = reason + ("（與預設選擇相同）" if unchanged else "")
+        ydl.to_screen(f"[格式] {job.metrics.format_reason}")
+        if unchanged:
+            return info
+        base = ydl.params.get('format')
+        self._pin_format(ydl, f"{spec}/{base}" if base else spec)
+        return ydl.process_ie_result(info, download=False)
+
+    def _pin_format(self, ydl, fmt_str: str):
+        ydl.params['format'] = fmt_str
+        ydl.format_selector = ydl.build_format_selector(fmt_str)
+
+    def _refresh_hls(self, job: DownloadJob, ydl, info: dict) -> dict | None:
+        """
+        HLS 分片抓不到（多半是簽名清單過期）時，先重新解析並釘住同一個 format_id，
+        拿新清單從最後完成的分片接續：yt-dlp 依 .part / .ytdl 記的分片序號跳過已下載的分片，已下載的部分不會丟。
+        新清單的分片數與原本不同就對不回序號，不硬接。
+        成功接續回傳 None；接不上時回傳給換格式回退用的 info（有重新解析到就是新的那份）。
+        """
+        fid = info.get('format_id')
+        if not fid or info.get('is_live'):
+            return info
+        stalled = 0
+        while stalled < HLS_REFRESH_ATTEMPTS:
+            before = job.last_progress
+            frag = (before or (None, None))[1]
+            self._update_status(
+                f"HLS 清單已過期，重新取得清單後從第 {frag + 1} 個分片接續…" if frag else "HLS 清單已過期，重新取得清單…", job)
+            job.metrics.refreshes += 1
+            job.metrics.begin('hls_refresh')
+            try:
+                self._pin_format(ydl, fid)
+                try:
+                    fresh = self._extract_info(ydl, job)
+                except Exception:
+                    return info
+                if not fresh or fresh.get('format_id') != fid:
+                    return info
+                info = fresh
+                for f in fresh.get('requested_formats') or [fresh]:
+                    known = job.hls_parts.get(f.get('format_id'), (None,))[0]
+                    if known and (f.get('protocol') or '').startswith('m3u8') \
+                            and self._hls_fragment_count(ydl, f) != known:
+                        return info
+                if job.resume is not None:
+                    job.resume.update(info=self._resume_record(ydl, job, fresh, None)['info'],
+                                      expires=job.info_expires or 0)
+                self._process_info(ydl, fresh)
+                return None
+            except Exception as e:
+                if not self._fragments_lost(e):
+                    raise
+                self._drop_cancelled_fragments(job)
+                self.extract_cache.invalidate(job.url)
+                stalled = 0 if job.last_progress != before else stalled + 1
+            finally:
+                job.metrics.end('hls_refresh')
+        return info
+
+    @staticmethod
+    def _fragments_lost(e: Exception) -> bool:
+        return isinstance(e, FragmentLost) or "fragment not found" in str(e).lower()
+
+    @staticmethod
+    def _drop_cancelled_fragments(job: DownloadJob):
+        """
+        FragmentLost 傳到這裡時執行緒池已收完：放行 _hook，並刪掉被中途取消的分片暫存（*-FragN.part），
+        否則下一輪 yt-dlp 會拿它們續傳，而那些請求多半已經讀完或對不上，反而被當成抓不到的分片。
+        已完整下載的 *-FragN 留著，下一輪直接沿用。
+        """
+        job.fragments_lost = False
+        for _, filename in job.hls_parts.values():
+            if not filename:
+                continue
+            for path in glob.glob(glob.escape(filename) + '.part-Frag*.part'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _discard_hls_parts(job: DownloadJob):
+        """換格式後輸出檔名可能相同，先刪掉 HLS 留下的 .part / .ytdl / 分片暫存，免得被當成續傳的開頭。"""
+        for _, filename in job.hls_parts.values():
+            if not filename:
+                continue
+            for path in [filename + '.part', filename + '.ytdl'] + glob.glob(glob.escape(filename) + '.part-Frag*'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        job.hls_parts.clear()
+
+    @staticmethod
+    def _hls_fragment_count(ydl, fmt: dict) -> int | None:
+        """抓新的媒體清單數有幾個 #EXTINF；抓不到或不是媒體清單時回傳 None。"""
+        try:
+            req = yt_dlp.networking.Request(fmt['url'], headers=fmt.get('http_headers') or {})
+            with ydl.urlopen(req) as resp:
+                text = resp.read().decode('utf-8', 'replace')
+        except Exception:
+            return None
+        return text.count('#EXTINF') or None
+
+    def _resume_record(self, ydl, job: DownloadJob, info: dict, base_spec: str | None) -> dict | None:
+        """
+        暫停後續傳用的紀錄：選定的 format_id（續傳時釘住，後面接原本的格式字串以防網址過期後重新解析時已無此格式）、
+        只含選中格式的精簡 info（RESUME_INFO_FIELDS / RESUME_FORMAT_FIELDS，串流網址仍有效）與其到期時間。可 JSON 序列化。
+        暫停時再補上最後的 bytes 與分片序號；實際接續位置仍由 yt-dlp 依 .part / .ytdl 檔決定。
+        """
+        fid = info.get('format_id')
+        if not fid or info.get('is_live') or info.get('_type') in ('playlist', 'multi_video'):
+            return None
+        chosen = set(fid.split('+'))
+
+        def _fmt(f):
+            return {k: f[k] for k in RESUME_FORMAT_FIELDS if f.get(k) is not None}
+
+        slim = {k: info[k] for k in RESUME_INFO_FIELDS if info.get(k) is not None}
+        # 合併後的 ext / 編碼，續傳時的音訊規劃與位元率估計要用；串流網址與分片只留在 formats 裡
+        slim.update((k, v) for k, v in _fmt(info).items()
+                    if k not in ('url', 'manifest_url', 'fragments', 'fragment_base_url', 'http_headers'))
+        slim['formats'] = [_fmt(f) for f in info.get('formats') or [] if f.get('format_id') in chosen]
+        if info.get('requested_formats'):
+            slim['requested_formats'] = [_fmt(f) for f in info['requested_formats']]
+        return {
+            'format_spec': f"{fid}/{base_spec}" if base_spec else fid,
+            'info': strip_cookies(ydl.sanitize_info(slim)),
+            'expires': job.info_expires or 0,
+            'downloaded_bytes': None,
+            'fragment_index': None,
+        }
+
+    @staticmethod
+    def _resume_text(resume: dict) -> str:
+        text = "沿用暫停前的格式與網址續傳"
+        if resume.get('downloaded_bytes'):
+            text += f"（已下載 {format_size(resume['downloaded_bytes'])}"
+            if resume.get('fragment_index'):
+                text += f"，第 {resume['fragment_index']} 個分片"
+            text += "）"
+        return text + "…"
+
+    def _process_info(self, ydl, info: dict):
+        """
+        把 extract_info 已解析好的 info 直接交給 process_ie_result 下載＋後製，
+        不再重新抓網頁與格式。傳入副本，原 info 留給回退與位元率計算使用。
+        """
+        ydl.process_ie_result(copy.deepcopy(info), download=True)
+
+    def _host_matches(self, netloc: str, key: str) -> bool:
+        return host_matches(netloc, key)
+
+    def _add_password_opts(self, opts: dict, job: DownloadJob):
+        """
+        依送出工作時的需要密碼勾選，自動塞入三種參數。
+        """
+        pwd = job.password
+        if pwd:
+            opts.update({
+                'video_password': pwd,   
+                'videopassword':  pwd,   
+                'http_password':  pwd,   
+            })
+
+    def _build_base_opts(self, job: DownloadJob) -> dict:
+        opts = {
+            'continuedl': True,
+            'extract_flat': 'in_playlist',
+            'progress_hooks': [lambda d: self._hook(job, d)],
+            'postprocessor_hooks': [lambda d: self._pp_hook(job, d)],
+            'concurrent_fragment_downloads': self.fragments.initial(job),
+            'buffersize': BANDWIDTH_BLOCK,
+            'noresizebuffer': True,
+            'retries': DOWNLOAD_RETRIES,
+            'fragment_retries': DOWNLOAD_RETRIES,
+            'logger': _JobLogger(self, job),
+        }
+        if self.quiet:
+            opts.update({'quiet': True, 'noprogress': True})
+        self._add_password_opts(opts, job)
+        return opts
+
+    def _get_source_audio_bitrate_kbps(self, info: dict):
         """
         從 extract_info(...) 的實際將被下載格式推回來源音訊位元率（kbps）。
         先看 requested_formats / requested_downloads（實際選用的音訊 stream），
@@ -563,94 +3088,201 @@ class YTDownloaderGUI(tk.Tk):
             pass
         return None
 
-    def _probe_container_bitrate_kbps(self, path: str, duration: float | None):
+    @staticmethod
+    def _source_audio_codec(info: dict) -> tuple:
+        """選中的音訊格式的 (編碼, 副檔名)，編碼正規化成 FFmpegExtractAudio 的名稱；不知道時為 None。"""
+        fmt = info
+        for f in info.get('requested_formats') or []:
+            if (f.get('acodec') or 'none') != 'none':
+                fmt = f
+                if (f.get('vcodec') or 'none') == 'none':
+                    break
+        acodec = (fmt.get('acodec') or '').lower()
+        if not acodec or acodec == 'none':
+            return None, fmt.get('ext')
+        if acodec.startswith(('mp4a.40', 'aac')):
+            return 'aac', fmt.get('ext')
+        if acodec.startswith(('mp3', 'mp4a.6b', 'mp4a.69')):
+            return 'mp3', fmt.get('ext')
+        if acodec.startswith('pcm'):
+            return 'wav', fmt.get('ext')
+        return acodec.split('.')[0], fmt.get('ext')
+
+    def _plan_audio(self, job: DownloadJob, ydl, info: dict, postprocessors: list,
+                    kind: str | None = None, src_ext: str | None = None) -> list:
         """
-        先嘗試用 ffprobe 取容器音訊流 bitrate；沒有 ffprobe 就用 filesize/duration 估算。
+        抽音訊前依來源決定怎麼做，能不重新編碼就不編碼：
+        - 來源編碼已是目標、副檔名也相同：拿掉 FFmpegExtractAudio，後製完全不跑 ffmpeg；副檔名不同時 yt-dlp 會直接複製串流
+        - 轉 MP3：編碼位元率不超過來源（取不高於來源的標準位元率），128 kbps 的來源不會被撐成 192
+        - 無損目標但來源有損：轉成 FLAC 只會變大、音質不變，改為原樣換容器（preferredcodec='best'）並警告
+        決策依格式記在 job.metrics.audio_plan，給無損來源的提示附在完成狀態後面。
+        kind 為多格式工作中從本機檔案另外產出的格式（預設為主格式）；這時要轉的是已合併的本機檔，
+        src_ext 傳它的副檔名，取代選中音訊格式的副檔名（例如 m4a 音軌已併進 .mp4）。
         """
-        if not path or not os.path.exists(path):
-            return None
+        src, ext = self._source_audio_codec(info)
+        ext = src_ext or ext
+        kbps = job.source_bitrate_kbps
+        kind = kind or job.fmt_kind
+        prefix = "" if kind == job.fmt_kind else f"{kind.upper()}："
+        plans = job.metrics.audio_plan
+        planned = []
+        for pp in postprocessors:
+            target = pp.get('preferredcodec') if pp.get('key') == 'FFmpegExtractAudio' else None
+            if target is None or src is None:
+                planned.append(pp)
+                continue
+            if src == target:
+                if (ext or '').lower() == target:
+                    plans[kind] = 'keep'
+                    ydl.to_screen(f"[音訊] {prefix}來源已是 {target}，不需轉檔")
+                    continue
+                plans[kind] = 'copy'
+                ydl.to_screen(f"[音訊] {prefix}來源已是 {target}，只換容器（串流複製）")
+            elif target in LOSSLESS_ACODECS and src not in LOSSLESS_ACODECS:
+                pp = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'best'}
+                plans[kind] = 'remux'
+                job.audio_notes.append(f"{prefix}來源為有損 {src}，未轉成 {target.upper()}，保留原始音訊")
+                ydl.report_warning(
+                    f"{prefix}來源是有損的 {src}{f'（約 {kbps:.0f} kbps）' if kbps else ''}，"
+                    f"轉成 {target.upper()} 只會變大、音質不會變好；改為保留原始音訊串流")
+            elif target == 'mp3' and kbps and pp.get('preferredquality') and kbps < float(pp['preferredquality']):
+                cap = max([b for b in MP3_BITRATES if b <= kbps] or [MP3_BITRATES[0]])
+                pp = dict(pp, preferredquality=str(cap))
+                plans[kind] = f'encode@{cap}'
+                ydl.to_screen(f"[音訊] {prefix}來源約 {kbps:.0f} kbps，MP3 以 {cap} kbps 編碼")
+            else:
+                plans[kind] = f"encode@{pp.get('preferredquality') or 'auto'}"
+            planned.append(pp)
+        return planned
 
+    def _warn_missing_ffprobe(self):
         if not shutil.which('ffprobe') and not self.ffprobe_warned:
             self.ffprobe_warned = True
-            messagebox.showwarning(
+            self.listener.on_warning(
                 "未安裝 ffprobe",
                 "將以檔案大小/時長估算音訊位元率，可能不準確。\n"
                 "建議安裝 FFmpeg（其中包含 ffprobe）。"
             )
 
-        if shutil.which('ffprobe'):
-            try:
-                proc = subprocess.run(
-                    ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
-                     '-show_entries', 'stream=bit_rate', '-of', 'default=nw=1:nk=1', path],
-                    capture_output=True, text=True, timeout=10
-                )
-                if proc.returncode == 0:
-                    out = proc.stdout.strip()
-                    if out.isdigit():
-                        return float(out) / 1000.0  
-            except Exception:
-                pass
-
-        try:
-            if duration and duration > 0:
-                size_bytes = os.path.getsize(path)
-                kbps = (size_bytes * 8.0 / duration) / 1000.0
-                return kbps
-        except Exception:
-            pass
-        return None
-
-    def _probe_container_bitrates(self, path: str, duration: float | None):
+    def _derive_outputs(self, job: DownloadJob, ydl, info: dict, path: str | None, domain_dir: str) -> list:
         """
-        回傳 (stream_kbps, avg_kbps, codec_name)
-        - stream_kbps: ffprobe 音訊流 bit_rate（若可得）
-        - avg_kbps   : 用檔案大小÷時長推得的平均位元率（若可得）
-        - codec_name : ffprobe 得到的音訊 codec 名稱（例如 'flac','opus','aac','mp3','pcm_s16le'）
+        多格式工作：主格式下載完，其餘格式都從這份本機檔案產出，不再連網。
+        每個格式在自己的 <網域>_<格式> 目錄放一個硬連結（不佔空間；不同磁碟才複製），
+        後製對連結轉檔、刪除都不影響主檔。直播檔之後會就地修復，改用複製。
         """
+        derived = []
         if not path or not os.path.exists(path):
-            return None, None, None
+            return derived
+        for kind in job.extra_kinds:
+            save_dir = f"{domain_dir}_{kind}"
+            dest = os.path.join(save_dir, os.path.basename(path))
+            try:
+                os.makedirs(save_dir, exist_ok=True)
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                if job.is_live:
+                    shutil.copy2(path, dest)
+                else:
+                    try:
+                        os.link(path, dest)
+                    except OSError:
+                        shutil.copy2(path, dest)
+            except OSError as e:
+                job.audio_notes.append(f"{kind.upper()} 失敗：{e}")
+                continue
+            pps = self._plan_audio(job, ydl, info, self._audio_postprocessors(kind), kind=kind,
+                                   src_ext=os.path.splitext(dest)[1].lstrip('.'))
+            derived.append((kind, dest, pps, self.catalog.begin(job, info, kind)))
+        return derived
 
-        stream_kbps, avg_kbps, codec = None, None, None
+    def _post_process(self, job: DownloadJob, path: str, duration: float | None, postprocessors: list):
+        """
+        下載段到此結束：把檔案交給後製段（抽音訊/轉檔、直播 MP4 修復、位元率探測）。
+        多格式工作的其他格式同時送進程序池並行處理，全部完成才結束工作。
+        後製佇列滿時會在這裡等，下載工作池的名額也一併保留，形成背壓。
+        """
+        task = {
+            'path': path,
+            'postprocessors': postprocessors,
+            'fix_mp4': job.is_live,
+            'duration': duration,
+            'info': {'id': str(job.id), 'title': job.title},
+        }
+        tasks = [(job.fmt_kind, task)] + [(kind, dict(task, path=src, postprocessors=pps))
+                                          for kind, src, pps, _ in job.derived]
+        self._update_status("等待後製…", job)
+        self._journal(job, state='post')
+        job.metrics.begin('post_wait')
+        job.post_futures = {}
+        job.post_pending = len(tasks)
+        for kind, t in tasks:
+            self.postproc.submit(t, lambda fut, kind=kind: self._post_task_done(job, kind, fut))
 
-        if not shutil.which('ffprobe') and not self.ffprobe_warned:
-            self.ffprobe_warned = True
-            messagebox.showwarning(
-                "未安裝 ffprobe",
-                "將以檔案大小/時長估算音訊位元率，可能不準確。\n"
-                "建議安裝 FFmpeg（其中包含 ffprobe）。"
-            )
+    def _post_task_done(self, job: DownloadJob, kind: str, fut):
+        with self._post_lock:
+            job.post_futures[kind] = fut
+            job.post_pending -= 1
+            if job.post_pending:
+                return
+        self._post_process_done(job, job.post_futures.pop(job.fmt_kind))
 
-        if shutil.which('ffprobe'):
+    def _collect_derived(self, job: DownloadJob):
+        """多格式工作其他格式的後製結果：併入時間軸、寫下載紀錄與各格式的下載紀錄檔。"""
+        for kind, _, _, key in job.derived:
+            fut = job.post_futures.get(kind)
+            if fut is None:
+                continue
             try:
-                proc = subprocess.run(
-                    ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
-                     '-show_entries', 'stream=codec_name,bit_rate', '-of', 'default=nw=1:nk=1', path],
-                    capture_output=True, text=True, timeout=10
-                )
-                if proc.returncode == 0:
-                    lines = [x.strip() for x in proc.stdout.splitlines() if x.strip()]
-                    if lines:
-                        for x in lines:
-                            if x.isdigit():
-                                stream_kbps = float(x) / 1000.0
-                            else:
-                                codec = x
-            except Exception:
-                pass
+                res = fut.result()
+            except Exception as e:
+                self.catalog.update(key, status='failed', finished=time.time())
+                job.audio_notes.append(f"{kind.upper()} 失敗：{strip_ansi(str(e))}")
+                continue
+            for name, start, end in res['phases']:
+                job.metrics.add(f"{kind}:{name}", start, end)
+            job.derived_paths[kind] = res['path']
+            if job.use_archive:
+                self.archive_for(kind).add(job.archive_id)
+            self.catalog.update(key, path=res['path'], status='done', finished=time.time(),
+                                size=os.path.getsize(res['path']) if os.path.exists(res['path']) else None)
+        if job.derived_paths:
+            job.audio_notes.append("另存 " + "、".join(k.upper() for k in job.derived_paths))
+        job.post_futures = {}
 
+    def _post_process_done(self, job: DownloadJob, fut):
+        """
+        後製程序完成後的回呼（在程序池的管理執行緒上）。
+        """
         try:
-            if duration and duration > 0:
-                size_bytes = os.path.getsize(path)
-                avg_kbps = (size_bytes * 8.0 / duration) / 1000.0
-        except Exception:
-            pass
-
-        return stream_kbps, avg_kbps, (codec or None)
+            res = fut.result()
+        except Exception as e:
+            job.failed = True
+            self.catalog.update(job.catalog_key, status='failed', finished=time.time())
+            self._finish_job(job, f"後製失敗：{strip_ansi(str(e))}")
+            self.listener.on_failed(job)
+            return
+        job.metrics.end('post_wait', at=res['started'])
+        for name, start, end in res['phases']:
+            job.metrics.add(name, start, end)
+        job.metrics.outcome = 'done'
+        job.final_path = res['path']
+        self._collect_derived(job)
+        if job.use_archive:
+            self.archive_for(job.fmt_kind).add(job.archive_id)
+        self.catalog.update(job.catalog_key, path=res['path'], status='done', finished=time.time(),
+                            size=os.path.getsize(res['path']) if os.path.exists(res['path']) else None)
+        if res['bitrates'][2] is None:
+            self._warn_missing_ffprobe()
+        try:
+            self._display_bitrates(job, *res['bitrates'])
+        finally:
+            self._finish_job(job)
 
-    def _probe_and_display(self, final_path: str, duration: float | None):
-        stream_kbps, avg_kbps, codec = self._probe_container_bitrates(final_path, duration)
+    @staticmethod
+    def _status_note(job: DownloadJob) -> str:
+        return f"（{'；'.join(job.audio_notes)}）" if job.audio_notes else ""
 
+    def _display_bitrates(self, job: DownloadJob, stream_kbps, avg_kbps, codec):
         container_kbps = None
         codec_l = (codec or "").lower()
         if codec_l.startswith("flac") or codec_l.startswith("pcm_"):
@@ -658,7 +3290,7 @@ class YTDownloaderGUI(tk.Tk):
         else:
             container_kbps = stream_kbps or avg_kbps
 
-        src_kbps = self.source_bitrate_kbps
+        src_kbps = job.source_bitrate_kbps
         src_str = None
         if src_kbps:
             if container_kbps and src_kbps > container_kbps:
@@ -678,237 +3310,570 @@ class YTDownloaderGUI(tk.Tk):
                     else:
                         extra_note = f"（流≈{s}）"
             if src_str:
-                self._update_status(f"來源音訊位元：{src_str}/{main} kbps(封裝原因可能導致檔案數值顯示虛高)")
+                self._update_status(f"來源音訊位元：{src_str}/{main} kbps(封裝原因可能導致檔案數值顯示虛高)" + self._status_note(job), job)
             else:
-                self._update_status(f"下載完成！容器音訊位元率：{main} kbps{extra_note}")
+                self._update_status(f"下載完成！容器音訊位元率：{main} kbps{extra_note}" + self._status_note(job), job)
         else:
             if src_str:
-                self._update_status(f"來源音訊位元：{src_str} kbps(封裝原因可能導致檔案數值顯示虛高)")
+                self._update_status(f"來源音訊位元：{src_str} kbps(封裝原因可能導致檔案數值顯示虛高)" + self._status_note(job), job)
             else:
-                self._update_status("下載完成！")
+                self._update_status("下載完成！" + self._status_note(job), job)
+
+    def _add_format_opts(self, opts: dict, job: DownloadJob):
+        netloc = urlparse(job.url).netloc.lower()
+
+        fmt_kind = job.fmt_kind
+        if fmt_kind in ("mp3", "flac"):
+            opts.update({
+                'format': self._format_spec(job),
+                'postprocessors': self._audio_postprocessors(fmt_kind),
+                'embedthumbnail': True,
+                'embedmetadata': True,
+            })
+        else:
+            opts.update({
+                'format': self._format_spec(job),
+                'merge_output_format': 'mp4',
+                'hls_prefer_native': True,  
+                'hls_use_mpegts': True,    
+                'nopart': False,           
+            })
+
+        for key, site_opts in SITE_SPECIFIC_OPTS.items():
+            if self._host_matches(netloc, key):
+                if isinstance(site_opts, str):   
+                    site_opts = SITE_SPECIFIC_OPTS[site_opts]
+                if callable(site_opts):
+                    site_opts(self, opts)
+                else:
+                    opts.update(site_opts)
+                break
+
+    @staticmethod
+    def _audio_postprocessors(fmt_kind: str) -> list:
+        if fmt_kind == "flac":
+            return [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'flac'}]
+        if fmt_kind == "mp3":
+            return [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]
+        return []
+
+    def _format_spec(self, job: DownloadJob, live: bool = False) -> str:
+        """
+        依格式與畫質產生 yt-dlp 格式字串。直播多半只有 HLS/TS，不限定 mp4/m4a。
+        音訊優先挑已是目標編碼的來源（MP3 需至少約 128 kbps），後製就不用重新編碼。
+        """
+        if live and job.fmt_kind in ("mp3", "flac"):
+            return 'bestaudio/best'
+        if job.fmt_kind == "mp3":
+            return 'bestaudio[acodec=mp3][abr>=?128]/bestaudio/best'
+        if job.fmt_kind == "flac":
+            return 'bestaudio[acodec=flac]/bestaudio[acodec^=alac]/bestaudio/best'
+        q = job.quality
+        if q == "原片最高":
+            return 'bestvideo*+bestaudio/best'
+        height = 2160 if q.lower() == "4k" else int(q.rstrip("p"))
+        if live:
+            return f'bestvideo[height<={height}]+bestaudio/best[height<={height}]'
+        return (
+            f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/'
+            f'best[height<={height}][ext=mp4]/best[height<={height}]'
+        )
+
+    def _resolve_final_output_path(self, job: DownloadJob) -> str | None:
+        """
+        下載段的完成檔：以下載紀錄為準（合併/搬移後的路徑由 postprocessor hook 寫入），
+        其次是 progress hook 最後回報的檔名。
+        """
+        recorded = self.catalog.path(job.catalog_key)
+        for path in (recorded, job.last_filename):
+            if path and os.path.exists(path):
+                return path
+        return recorded or job.last_filename
+
+    def _hook(self, job: DownloadJob, d):
+        st = d.get('status')
+        if job.is_live:
+            # 原生分片錄直播時 yt-dlp 把 KeyboardInterrupt 當作「錄到這裡為止」，之後照常合併與後製
+            if job.stop_flag and st == 'downloading':
+                raise KeyboardInterrupt()
+        elif job.stop_flag or job.pause_flag or job.fragments_lost:
+            raise ydl_utils.DownloadCancelled()
+        job.metrics.record_progress(d)
+        if st == 'downloading' and job.is_live:
+            now = time.monotonic()
+            if now - job.live_reported < 1.0:
+                return
+            job.live_reported = now
+            size = d.get('downloaded_bytes') or 0
+            speed = d.get('speed')
+            text = f"直播錄製中… 已錄 {format_eta(d.get('elapsed'))}，{format_size(size)}"
+            if speed:
+                text += f"（{format_size(speed)}/s）"
+            self.listener.on_status(job, text)
+
+        elif st == 'downloading':
+            job.last_progress = (d.get('downloaded_bytes'), d.get('fragment_index'))
+            if d.get('fragment_count'):
+                job.hls_parts[(d.get('info_dict') or {}).get('format_id')] = (d['fragment_count'], d.get('filename'))
+            self.bandwidth.consume(job, d)
+            self.progress.update(job, d.get('downloaded_bytes'),
+                                 d.get('total_bytes') or d.get('total_bytes_estimate'),
+                                 d.get('speed'), d.get('eta'))
+            n = self.fragments.record_progress(job, d)
+            if n is not None and job.ydl is not None:
+                job.ydl.params['concurrent_fragment_downloads'] = n
+
+        elif st == 'finished':
+            job.last_filename = d.get('filename')
+            self._update_status("轉檔處理中…", job)
+            self.listener.on_title(job, f"{job.title} 下載完成！")
+
+    def _pp_hook(self, job: DownloadJob, d):
+        name = f"pp:{d.get('postprocessor')}"
+        if d.get('status') == 'started':
+            job.metrics.begin(name)
+        elif d.get('status') == 'finished':
+            job.metrics.end(name)
+        # 合併、修正與搬移都做完後，MoveFiles 回報的就是下載段的最終檔案
+        if d.get('status') == 'finished' and d.get('postprocessor') == 'MoveFiles':
+            path = d.get('info_dict', {}).get('filepath')
+            if path:
+                job.last_filename = path
+                self.catalog.update(job.catalog_key, path=path, downloaded=time.time(),
+                                    size=os.path.getsize(path) if os.path.exists(path) else None)
+
+    def _update_status(self, text, job: DownloadJob | None = None):
+        """
+        狀態文字一律交給 listener；同時丟掉該工作尚未畫出的舊進度。
+        """
+        if job is not None:
+            self.progress.discard(job)
+        self.listener.on_status(job, text)
+
+
+class YTDownloaderGUI(EngineListener, tk.Tk if tk is not None else object):
+    def __init__(self, journal: bool = True):
+        super().__init__()
+        self.title("Video Downloader")
+        self.geometry("600x580")
+        self.resizable(False, False)
+        self.focus_job = None            
+        self._queued_keys = {}           # 匯入去重鍵 → 工作；工作結束後同一網址可以再加
+        self._ie_hints = {}              # 網域 → 比中的擷取器（url_archive_id），跨次匯入沿用
+        self.engine = DownloadEngine(self, max_workers=3)
+
+        ttk.Label(self, text="影片 / 播放清單 URL（可一次貼多行）:").pack(pady=(20, 5), anchor="w", padx=20)
+        self.url_text = tk.Text(self, height=4, width=75)
+        self.url_text.pack(padx=20)
+
+        self.format_var = tk.StringVar(value="mp4")
+        fmt_frame = ttk.Frame(self)
+        fmt_frame.pack(pady=10, anchor="w", padx=20)
+        ttk.Label(fmt_frame, text="下載格式:").pack(side="left")
+        ttk.Radiobutton(fmt_frame, text="MP4 (影片)", variable=self.format_var, value="mp4").pack(side="left", padx=5)
+        ttk.Radiobutton(fmt_frame, text="MP3 (音檔)", variable=self.format_var, value="mp3").pack(side="left")
+        ttk.Radiobutton(fmt_frame, text="FLAC (無損音檔)", variable=self.format_var, value="flac").pack(side="left", padx=5)
+        # 勾選的格式與上面的格式只下載一次，另外從本機檔案轉出
+        ttk.Label(fmt_frame, text="另存:").pack(side="left", padx=(10, 0))
+        self.extra_vars = {"mp3": tk.BooleanVar(value=False), "flac": tk.BooleanVar(value=False)}
+        ttk.Checkbutton(fmt_frame, text="MP3", variable=self.extra_vars["mp3"]).pack(side="left", padx=5)
+        ttk.Checkbutton(fmt_frame, text="FLAC", variable=self.extra_vars["flac"]).pack(side="left")
+
+        q_frame = ttk.Frame(self)
+        q_frame.pack(pady=(0, 5), anchor="w", padx=20)
+
+        ttk.Label(q_frame, text="畫質:").pack(side="left")
+        self.quality_var = tk.StringVar(value="原片最高")
+        q_choices = ["360p", "480p", "720p", "1080p", "1440p", "4k", "原片最高"]
+        ttk.Combobox(q_frame, textvariable=self.quality_var,
+                     values=q_choices, width=10, state="readonly"
+                     ).pack(side="left", padx=5)
+
+        ttk.Label(q_frame, text="同時下載:").pack(side="left", padx=(15, 0))
+        self.workers_var = tk.StringVar(value="3")
+        ttk.Spinbox(q_frame, from_=1, to=8, width=4, state="readonly",
+                    textvariable=self.workers_var,
+                    command=self.change_workers).pack(side="left", padx=5)
+
+        self.bypass_cache_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(q_frame, text="重新解析（略過快取）",
+                        variable=self.bypass_cache_var).pack(side="left", padx=(10, 0))
+
+        pass_frame = ttk.Frame(self)
+        pass_frame.pack(pady=(5, 0), anchor="w", padx=20)
+        self.need_pass_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(pass_frame, text="需要密碼", variable=self.need_pass_var, command=self.toggle_password).pack(side="left")
+        self.pass_var = tk.StringVar()
+        self.pass_entry = ttk.Entry(pass_frame, textvariable=self.pass_var, width=25, state="disabled")
+        self.pass_entry.pack(side="left", padx=5)
+
+        rate_frame = ttk.Frame(self)
+        rate_frame.pack(pady=(5, 0), anchor="w", padx=20)
+
+        ttk.Label(rate_frame, text="限速:").pack(side="left")
+
+        self.rate_choice_var = tk.StringVar(value="0")       
+        choices = [str(i) for i in range(1, 11)] + ["自訂"]
+        self.rate_combo = ttk.Combobox(
+            rate_frame, textvariable=self.rate_choice_var,
+            values=choices, width=5, state="readonly"
+        )
+        self.rate_combo.pack(side="left", padx=(0, 5))
+        self.rate_combo.bind("<<ComboboxSelected>>", self.toggle_custom_rate)
+
+        self.custom_rate_var = tk.StringVar()
+        self.custom_rate_entry = ttk.Entry(
+            rate_frame, textvariable=self.custom_rate_var,
+            width=8, state="disabled"
+        )
+        self.custom_rate_entry.pack(side="left")
+        self.custom_rate_entry.bind("<Return>", lambda _e: self._apply_rate_limit())
+        self.custom_rate_entry.bind("<FocusOut>", lambda _e: self._apply_rate_limit())
+        ttk.Label(rate_frame, text="MB/s (0代表全速)").pack(side="left")
+
+        self.redownload_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(rate_frame, text="重新下載已下載過的",
+                        variable=self.redownload_var).pack(side="left", padx=(15, 0))
+
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack(pady=15)
+
+        ttk.Button(btn_frame, text="開始下載",
+                   command=self.start_download_thread).pack(side="left", padx=6)
+
+        ttk.Button(btn_frame, text="匯入清單…",
+                   command=self.import_url_file).pack(side="left", padx=6)
+
+        self.pause_btn = ttk.Button(btn_frame, text="暫停",
+                                    command=self.toggle_pause,
+                                    state="disabled")
+        self.pause_btn.pack(side="left", padx=6)
+
+        self.stop_btn = ttk.Button(
+            btn_frame, text="中止",
+            command=self.stop_download,
+            state="disabled"
+        )
+        self.stop_btn.pack(side="left", padx=6)
+
+        self.priority_btn = ttk.Button(btn_frame, text="優先",
+                                       command=self.toggle_priority,
+                                       state="disabled")
+        self.priority_btn.pack(side="left", padx=6)
+
+        self.job_tree = ttk.Treeview(self, columns=("title", "status", "progress"),
+                                     show="tree headings", height=6)
+        self.job_tree.column("#0", width=24, stretch=False)
+        self.job_tree.heading("title", text="標題 / URL")
+        self.job_tree.heading("status", text="狀態")
+        self.job_tree.heading("progress", text="進度")
+        self.job_tree.column("title", width=296)
+        self.job_tree.column("status", width=140)
+        self.job_tree.column("progress", width=90, anchor="e")
+        self.job_tree.pack(padx=20, fill="x")
+        self.job_tree.bind("<<TreeviewSelect>>", self._on_job_select)
+        
+        self.status_text = tk.Text(self, height=1, width=60,
+                                   bd=0, relief="flat",
+                                   bg=self.cget("bg"),          
+                                   state="disabled")
+        self.status_text.pack(pady=3)
+
+        self.title_var = tk.StringVar(value="")
+        ttk.Label(self, textvariable=self.title_var,
+                  font=("Helvetica", 10, "bold")).pack(pady=(2, 0))
+
+        self.stage_var = tk.StringVar(value="")
+        ttk.Label(self, textvariable=self.stage_var,
+                  foreground="#606060").pack(pady=(2, 0))
 
-    def _kill_live_proc_tree(self, proc, polite_timeout=3.0):
-        """
-        終止直播的子程序樹（yt-dlp 與它啟動的 ffmpeg）。
-        Windows：
-          1) 先送 CTRL_BREAK_EVENT（要求優雅收尾、關檔）
-          2) 逾時仍活著 → taskkill /T /F（整棵行程樹）
-          3) 仍不收 → kill()
-        POSIX：
-          1) 送 SIGTERM 到 process group（若無群組就 terminate）
-          2) 逾時 → SIGKILL（或 kill）
-        """
-        if proc is None:
-            return
+        self.status_text.tag_config("white",  foreground="#202020")
+        self.status_text.tag_config("blue",   foreground="blue")
+        self.status_text.tag_config("green",  foreground="green")
+        self.status_text.tag_config("yellow", foreground="orange")   
 
-        try:
-            if sys.platform.startswith("win"):
-                try:
-                    os.kill(proc.pid, signal.CTRL_BREAK_EVENT)
-                except Exception:
-                    pass
+        self.after(1000 // PROGRESS_FPS, self._flush_progress)
+        # 排在視窗第一次重繪之後才開始載入 yt-dlp
+        self._start_waiting = False
+        self.after_idle(YtDlpLoader.start)
+        # 重播、壓縮工作日誌要讀寫磁碟（含 fsync），同樣等視窗畫出來再做
+        if journal:
+            self.after_idle(self._restore_journal)
 
-                try:
-                    proc.wait(timeout=polite_timeout)
-                    return
-                except Exception:
-                    pass
+    def _restore_journal(self):
+        restored = self.engine.open_journal(os.path.abspath(JOURNAL_FILE))
+        for job in restored:
+            self._add_job_row(job)
+        if restored:
+            self.focus_job = restored[0]
+            self._write_status_plain(f"已恢復上次未完成的 {len(restored)} 個工作")
 
-                try:
-                    subprocess.run(
-                        ["taskkill", "/PID", str(proc.pid), "/T", "/F"],
-                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=5
-                    )
-                except Exception:
-                    pass
+    def _selected_jobs(self) -> list:
+        jobs = self.engine.jobs
+        return [jobs[int(i)] for i in self.job_tree.selection() if int(i) in jobs]
 
-                try:
-                    proc.wait(timeout=1.0)
-                    return
-                except Exception:
-                    pass
+    def _expand_selection(self) -> list:
+        """
+        選取的工作；選到播放清單時連同它底下的子工作一起回傳。
+        """
+        out, seen = [], set()
+        stack = list(reversed(self._selected_jobs()))
+        while stack:
+            job = stack.pop()
+            if job.id in seen:
+                continue
+            seen.add(job.id)
+            out.append(job)
+            if job.children:
+                stack.extend(reversed(list(job.children)))
+        return out
 
-                try:
-                    proc.kill()
-                except Exception:
-                    pass
-                try:
-                    proc.wait(timeout=1.0)
-                except Exception:
-                    pass
+    def _on_job_select(self, _evt=None):
+        sel = self._selected_jobs()
+        if sel:
+            self.focus_job = sel[0]
+            self._write_status_plain(self.focus_job.progress or self.focus_job.status)
+            self.title_var.set(self.focus_job.title or "")
+        self._refresh_buttons()
+
+    def _refresh_buttons(self):
+        """
+        依目前選取的工作決定「暫停/繼續」「中止」能不能按。
+        """
+        sel = self._selected_jobs()
+        active = [j for j in sel if not j.done]
+        if not active:
+            self.pause_btn.config(state="disabled", text="暫停")
+            self.stop_btn.config(state="disabled")
+            self.priority_btn.config(state="disabled", text="優先")
+            return
+        self.stop_btn.config(state="normal")
+        self.priority_btn.config(state="normal",
+                                 text="取消優先" if all(j.priority for j in active) else "優先")
+        if all(j.paused for j in active):
+            self.pause_btn.config(state="normal", text="繼續")
+        elif any(j.is_live or j.pause_flag for j in active):
+            self.pause_btn.config(state="disabled", text="暫停")
+        else:
+            self.pause_btn.config(state="normal", text="暫停")
+
+    def change_workers(self):
+        self.engine.set_max_workers(int(self.workers_var.get()))
 
+    def toggle_pause(self):
+        """
+        yt-dlp 的續傳依賴 .part 檔與伺服器 Range 支援，部分來源或直播在「暫停→續傳」未必成功。
+        若處於後製（postprocessors，例如轉檔/嵌圖）階段，按「暫停」無法保證狀態回復。
+        """
+        selected = [j for j in self._selected_jobs() if not j.done]
+        resume = bool(selected) and all(j.paused for j in selected)
+        for job in self._expand_selection():
+            if resume:
+                self.engine.resume(job)
             else:
-                try:
-                    os.killpg(proc.pid, signal.SIGTERM)
-                except Exception:
-                    try:
-                        proc.terminate()
-                    except Exception:
-                        pass
+                self.engine.pause(job)
+        self._refresh_buttons()
 
-                try:
-                    proc.wait(timeout=polite_timeout)
-                    return
-                except Exception:
-                    pass
+    def toggle_priority(self):
+        """
+        選取的工作在全域限速下分到較多頻寬（權重 PRIORITY_WEIGHT）；全部已是優先時則取消。
+        """
+        selected = [j for j in self._selected_jobs() if not j.done]
+        priority = not (selected and all(j.priority for j in selected))
+        for job in self._expand_selection():
+            if not job.done:
+                self.engine.set_priority(job, priority)
+        self._refresh_buttons()
 
-                try:
-                    os.killpg(proc.pid, signal.SIGKILL)
-                except Exception:
-                    try:
-                        proc.kill()
-                    except Exception:
-                        pass
+    def stop_download(self):
+        for job in self._expand_selection():
+            self.engine.stop(job)
+        self.stop_btn.config(state="disabled")
 
-                try:
-                    proc.wait(timeout=1.0)
-                except Exception:
-                    pass
+    def toggle_password(self):
+        state = "normal" if self.need_pass_var.get() else "disabled"
+        self.pass_entry.configure(state=state)
 
-        finally:
-            return
-    def _try_fix_mp4_inplace(self, path: str) -> bool:
+    def toggle_custom_rate(self, _evt=None):
         """
-        嘗試把可能缺少完整 moov 的 MP4 以 stream copy 方式重封裝到 *_fixed.mp4，
-        若成功就覆蓋回原檔。回傳 True=已修復或不需修復，False=修復失敗。
+        當選到自訂時才開放輸入欄。
+        """
+        state = "normal" if self.rate_choice_var.get() == "自訂" else "disabled"
+        self.custom_rate_entry.configure(state=state)
+        if state == "disabled":
+            self._apply_rate_limit()
+
+    def _apply_rate_limit(self) -> bool:
+        """
+        依 UI 設定更新全域限速，進行中的下載立即套用。
+        回傳 True 表示成功；False 代表格式錯誤，須中止下載。
         """
+        value = self.custom_rate_var.get().strip() if self.rate_choice_var.get() == "自訂" else self.rate_choice_var.get()
         try:
-            if not shutil.which("ffmpeg"):
-                return False
-            tmp_out = path[:-4] + "_fixed.mp4"
-            proc = subprocess.run(
-                ["ffmpeg", "-v", "error", "-y",
-                 "-i", path, "-c", "copy", "-movflags", "+faststart", tmp_out],
-                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=60
+            ratelimit = parse_rate_limit(value)
+        except ValueError:
+            self._write_status_plain("限速數字格式錯誤")
+            messagebox.showerror(
+                "限速格式錯誤",
+                "請輸入正數（例：0.5、1、2、2.5）。\n0 代表不限速。"
             )
-            if proc.returncode == 0 and os.path.exists(tmp_out) and os.path.getsize(tmp_out) > 0:
-                try:
-                    os.replace(tmp_out, path)  
-                    return True
-                except Exception:
-                    return False
-            if os.path.exists(tmp_out):
-                try: os.remove(tmp_out)
-                except Exception: pass
-            return False
-        except Exception:
             return False
+        self.engine.set_rate_limit(ratelimit)
+        return True
 
-    def _add_format_opts(self, opts: dict, url: str):
-        netloc = urlparse(url).netloc.lower()
+    def start_download_thread(self):
+        """
+        把輸入框內每一行（或以空白分隔）的 URL 各建成一個工作丟進佇列。
+        同一支影片的不同寫法、或已在佇列中的，只保留一個；整理網址在背景執行緒做，上千筆也不會卡住視窗。
+        """
+        raw_urls = self.url_text.get("1.0", "end").split()
+        if not raw_urls:
+            messagebox.showwarning("提醒", "請輸入 URL")
+            return
+        if not self._apply_rate_limit():
+            return
+        if not YtDlpLoader.ready():
+            if not self._start_waiting:
+                self._start_waiting = True
+                self._write_status_plain("yt-dlp 載入中，完成後自動開始 …")
+                self._wait_loader_then_start()
+            return
+        if YtDlpLoader.error is not None:
+            messagebox.showerror("錯誤", f"無法載入 yt-dlp：{YtDlpLoader.error}")
+            return
+        pwd = self.pass_var.get().strip() if self.need_pass_var.get() else None
+        fmt_kind, extra_kinds = split_output_kinds(
+            [self.format_var.get()] + [k for k, var in self.extra_vars.items() if var.get()])
+        quality = self.quality_var.get()
+        job_opts = dict(password=pwd or None, use_cache=not self.bypass_cache_var.get(),
+                        use_archive=not self.redownload_var.get(), extra_kinds=extra_kinds)
+        self.url_text.delete("1.0", "end")
+        if len(raw_urls) > 1:
+            self._write_status_plain(f"整理 {len(raw_urls)} 個網址中 …")
 
-        fmt_kind = self.format_var.get()
-        if fmt_kind == "flac":
-            opts.update({
-                'format': 'bestaudio/best',
-                'postprocessors': [{'key': 'FFmpegExtractAudio','preferredcodec': 'flac'}],
-                'embedthumbnail': True,
-                'embedmetadata': True,
-            })
-        elif fmt_kind == "mp3":
-            opts.update({
-                'format': 'bestaudio/best',
-                'postprocessors': [{'key': 'FFmpegExtractAudio','preferredcodec': 'mp3','preferredquality': '192'}],
-                'embedthumbnail': True,
-                'embedmetadata': True,
-            })
-        else:
-            q = self.quality_var.get()
-            if q == "原片最高":
-                fmt_str = 'bestvideo*+bestaudio/best'
-            else:
-                height = 2160 if q.lower() == "4k" else int(q.rstrip("p"))
-                fmt_str = (
-                    f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/'
-                    f'best[height<={height}][ext=mp4]/best[height<={height}]'
-                )
-            opts.update({
-                'format': fmt_str,
-                'merge_output_format': 'mp4',
-                'hls_prefer_native': True,  
-                'hls_use_mpegts': True,    
-                'nopart': False,           
-            })
+        seen = {key: job.url for key, job in self._queued_keys.items() if not job.done}
 
-        for key, site_opts in SITE_SPECIFIC_OPTS.items():
-            if self._host_matches(netloc, key):
-                if isinstance(site_opts, str):   
-                    site_opts = SITE_SPECIFIC_OPTS[site_opts]
-                if callable(site_opts):
-                    site_opts(self, opts)
-                else:
-                    opts.update(site_opts)
-                break
+        def _canonicalize():
+            # 只輸入一個網址時照舊：watch?v=…&list=… 下載整個播放清單；多行貼上 / 匯入才收斂成單支影片
+            unique, dropped = dedupe_urls(raw_urls, seen, keep_lists=len(raw_urls) == 1,
+                                          hints=self._ie_hints)
+            self.after(0, lambda: self._submit_urls(unique, dropped, fmt_kind, quality, job_opts))
+
+        threading.Thread(target=_canonicalize, name="url-import", daemon=True).start()
 
-    def _resolve_final_output_path(self, save_dir: str, title: str, fmt_kind: str, fallback_path: str | None, expected_path: str | None):
+    def _submit_urls(self, unique: list, dropped: list, fmt_kind: str, quality: str, job_opts: dict):
         """
-        根據目前下載格式（mp4/mp3/flac）與標題，推算真正的最終輸出檔路徑。
-        - 音檔：優先找 <title>.mp3 / <title>.flac
-        - 影片：沿用 yt-dlp 回報的完成檔
-        - 若以上都找不到：在 save_dir 內，用同名檔名前綴或最後修改時間最新做為備選
+        背景整理完的網址在主執行緒建立工作。同時有兩批在整理時彼此看不到，這裡再對一次佇列。
         """
-        title = ydl_utils.sanitize_filename(title, restricted=False) 
-        ext = ".mp3" if fmt_kind == "mp3" else (".flac" if fmt_kind == "flac" else None)
-        if ext:
-            candidate = os.path.join(save_dir, f"{title}{ext}")
-            if os.path.exists(candidate):
-                return candidate
+        added = 0
+        for url, key in unique:
+            queued = self._queued_keys.get(key)
+            if queued is not None and not queued.done:
+                dropped.append((url, queued.url))
+                continue
+            job = DownloadJob(url, fmt_kind, quality, **job_opts)
+            self._queued_keys[key] = job
+            added += 1
+            self._add_job_row(job)
+            if self.focus_job is None or self.focus_job.done:
+                self.focus_job = job
+            self.engine.submit(job)
+        note = f"，略過重複 {len(dropped)} 個" if dropped else ""
+        self._write_status_plain(f"已加入 {added} 個工作{note} …（{quality}）")
+        if dropped:
+            lines = [f"{raw}\n  → {same}" for raw, same in dropped[:20]]
+            if len(dropped) > 20:
+                lines.append(f"…另外 {len(dropped) - 20} 個")
+            messagebox.showinfo("略過重複的網址", "\n".join(lines))
 
-        if fallback_path and os.path.exists(fallback_path):
-            return fallback_path
+    def import_url_file(self):
+        """
+        從文字檔匯入大量 URL（一行一個，# 開頭為註解），與貼上的內容一樣去重後加入佇列。
+        """
+        path = filedialog.askopenfilename(title="匯入 URL 清單",
+                                          filetypes=[("文字檔", "*.txt"), ("所有檔案", "*.*")])
+        if not path:
+            return
+        try:
+            urls = read_url_list(path)
+        except (OSError, UnicodeDecodeError) as e:
+            messagebox.showerror("錯誤", f"無法讀取清單：{e}")
+            return
+        self.url_text.insert("end", "\n" + "\n".join(urls))
+        self.start_download_thread()
 
-        if expected_path and os.path.exists(expected_path):
-            return expected_path
+    def _wait_loader_then_start(self):
+        """
+        按下「開始下載」時 yt-dlp 還沒載入完：不卡住視窗，載入完成後再照常送出。
+        """
+        if not YtDlpLoader.ready():
+            self.after(50, self._wait_loader_then_start)
+            return
+        self._start_waiting = False
+        self.start_download_thread()
 
-        try:
-            stem = os.path.splitext(os.path.basename(fallback_path or ""))[0] or title
-            best = None
-            best_mtime = -1
-            for fn in os.listdir(save_dir):
-                full = os.path.join(save_dir, fn)
-                if not os.path.isfile(full):
-                    continue
-                if fn.startswith(stem) or fn.startswith(title):
-                    mt = os.path.getmtime(full)
-                    if mt > best_mtime:
-                        best, best_mtime = full, mt
-            if best:
-                return best
-        except Exception:
-            pass
+    def _add_job_row(self, job: DownloadJob):
+        parent_iid = str(job.parent.id) if job.parent else ""
+        if parent_iid and not self.job_tree.exists(parent_iid):
+            parent_iid = ""
+        self.job_tree.insert(parent_iid, "end", iid=str(job.id), values=(job.title or job.url, job.status, ""))
 
+    def _flush_progress(self):
+        """
+        主執行緒定時取出各工作最新進度並重繪，取代每個 chunk 都 after(0, ...)。
+        """
         try:
-            files = [os.path.join(save_dir, f) for f in os.listdir(save_dir)]
-            files = [f for f in files if os.path.isfile(f)]
-            if files:
-                return max(files, key=lambda p: os.path.getmtime(p))
-        except Exception:
-            pass
-        return fallback_path
+            for job, downloaded, total, speed, eta in self.engine.progress.drain():
+                self._show_job_progress(job, *format_progress(downloaded, total, speed, eta))
+            self.stage_var.set(format_stage_depths(self.engine.stage_depths()))
+        finally:
+            self.after(1000 // PROGRESS_FPS, self._flush_progress)
 
-    def _hook(self, d):
-        if self.stop_flag:                  
-            raise ydl_utils.DownloadCancelled()
-        if self.pause_flag:                 
-            raise ydl_utils.DownloadCancelled()
-        st = d.get('status')
-        if st == 'downloading':
-            pct   = strip_ansi(d.get('_percent_str', '')).strip()               
-            total = strip_ansi(str(d.get('_total_bytes_str')                         
-                               or d.get('_total_bytes_estimate_str',''))).strip()
-            speed = strip_ansi(d.get('_speed_str', '')).strip()                  
-            eta   = strip_ansi(d.get('_eta_str', '')).strip()                    
+    def _show_job_status(self, job: DownloadJob | None, text: str):
+        if job is None:
+            self._write_status_plain(text)
+            return
+        job.status = text
+        job.progress = ""
+        if self.job_tree.exists(str(job.id)):
+            self.job_tree.set(str(job.id), "status", text)
+        if self.focus_job is None or self.focus_job is job:
+            self._write_status_plain(text)
 
-            self.after(0, lambda: self._write_status_progress(pct, total, speed, eta))
+    def _show_job_progress(self, job: DownloadJob, pct, total, speed, eta):
+        job.status = "下載中"
+        job.progress = f"{pct} of {total} at {speed} ETA {eta}"
+        if self.job_tree.exists(str(job.id)):
+            self.job_tree.set(str(job.id), "status", job.status)
+            self.job_tree.set(str(job.id), "progress", pct)
+        if self.focus_job is None or self.focus_job is job:
+            self._write_status_progress(pct, total, speed, eta)
 
-        elif st == 'finished':
-            self.last_filename = d.get('filename')
-            self.after(0, lambda: self.pause_btn.config(state="disabled"))
-            self.after(0, lambda: self._write_status_plain("轉檔處理中…"))
-            self.after(0, lambda: self.title_var.set(f"{self.current_title} 下載完成！"))
+    def on_job_added(self, job):
+        self.after(0, lambda: self._add_job_row(job))
+
+    def on_status(self, job, text):
+        self.after(0, lambda: self._show_job_status(job, text))
+
+    def on_title(self, job, text):
+        def _apply():
+            if self.job_tree.exists(str(job.id)) and job.title:
+                self.job_tree.set(str(job.id), "title", job.title)
+            if self.focus_job is None or self.focus_job is job:
+                self.title_var.set(text)
+        self.after(0, _apply)
+
+    def on_job_changed(self, job):
+        self.after(0, self._refresh_buttons)
+
+    def on_job_finished(self, job):
+        self.after(0, self._refresh_buttons)
 
-    def _update_status(self, text):
-        self.after(0, lambda: self._write_status_plain(text))
+    def on_failed(self, job):
+        self._show_help()
+
+    def on_warning(self, title, text):
+        self.after(0, lambda: messagebox.showwarning(title, text))
     
     def _write_status_plain(self, text: str):
         """
@@ -947,6 +3912,614 @@ class YTDownloaderGUI(tk.Tk):
         )
         self.after(0, lambda: messagebox.showinfo("疑難排解", msg))
 
+
+class BatchReporter(EngineListener):
+    """
+    --batch 模式的 listener：每個事件一行 JSON 印到 stdout，方便 cron / 容器的 log 收集與解析。
+    """
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def emit(self, event: str, job=None, **fields):
+        rec = {"event": event, "time": round(time.time(), 3)}
+        if job is not None:
+            rec.update({"job": job.id, "url": job.url})
+            if job.parent is not None:
+                rec["parent"] = job.parent.id
+        rec.update(fields)
+        with self._lock:
+            self.stream.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.stream.flush()
+
+    def on_job_added(self, job):
+        self.emit("queued", job)
+
+    def on_status(self, job, text):
+        self.emit("status", job, text=text)
+
+    def on_title(self, job, text):
+        self.emit("title", job, title=job.title)
+
+    def on_job_finished(self, job):
+        extra = {'derived': job.derived_paths} if job.derived_paths else {}
+        self.emit("finished", job, ok=not job.failed and not job.stop_flag,
+                  title=job.title, path=job.final_path, **extra)
+
+    def on_warning(self, title, text):
+        self.emit("warning", title=title, text=text)
+
+    def report_progress(self, progress: ProgressAggregator):
+        for job, downloaded, total, speed, eta in progress.drain():
+            self.emit("progress", job, downloaded_bytes=downloaded, total_bytes=total,
+                      speed=speed, eta=eta)
+
+
+def read_url_list(path: str) -> list:
+    """
+    讀取 URL 清單檔（'-' 代表 stdin）；空行與 # 開頭的註解略過。
+    """
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        return [ln.strip() for ln in f if ln.strip() and not ln.lstrip().startswith("#")]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def run_batch(argv: list) -> int:
+    """
+    無視窗的批次模式：與 GUI 共用 DownloadEngine，進度以 JSON lines 輸出到 stdout。
+    例：python video-download-gui.py --batch urls.txt -f mp3 -j 4 --rate 2
+        python video-download-gui.py --batch urls.txt -f mp4,mp3,flac   （每個影片只下載一次）
+    """
+    import argparse
+
+    YtDlpLoader.start()      # 解析參數、讀清單的同時先載入
+    parser = argparse.ArgumentParser(description="yt-dlp 批次下載（無視窗）")
+    parser.add_argument("urls", nargs="*", help="要下載的 URL")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="URL 清單檔，一行一個；'-' 代表從 stdin 讀")
+    parser.add_argument("-f", "--format", default="mp4",
+                        help="mp4 / mp3 / flac；以逗號同時要多種時只下載一次，其餘從本機檔案轉出")
+    parser.add_argument("-q", "--quality", default="原片最高",
+                        choices=["360p", "480p", "720p", "1080p", "1440p", "4k", "原片最高", "best"])
+    parser.add_argument("-j", "--jobs", type=int, default=3, help="同時下載數")
+    parser.add_argument("--rate", default="0", help="限速 MB/s（所有工作合計），0 代表全速")
+    parser.add_argument("--password", help="影片 / HTTP 密碼")
+    parser.add_argument("--no-cache", action="store_true", help="略過解析快取")
+    parser.add_argument("--no-archive", action="store_true",
+                        help="不查已下載清單（已下載過的也重新下載）")
+    parser.add_argument("-N", "--max-fragments", type=int, default=FRAGMENT_CONCURRENCY_MAX,
+                        help="HLS/DASH 分片並行數上限（實際值會自動調整）")
+    parser.add_argument("--post-workers", type=int, default=POSTPROCESS_WORKERS,
+                        help="後製（轉檔/探測）程序數，預設為 CPU 核心數")
+    parser.add_argument("--progress-interval", type=float, default=1.0,
+                        help="進度事件輸出間隔（秒）")
+    parser.add_argument("--metrics-prom", metavar="FILE",
+                        help="另把累計統計寫成 Prometheus 文字格式（textfile collector 用）")
+    args = parser.parse_args(argv)
+
+    urls = list(args.urls)
+    if args.batch:
+        urls += read_url_list(args.batch)
+    if not urls:
+        parser.error("沒有任何 URL（用 --batch FILE 或直接列出）")
+    try:
+        ratelimit = parse_rate_limit(args.rate)
+    except ValueError:
+        parser.error("--rate 需為正數（例：0.5、1、2.5），0 代表不限速")
+    quality = "原片最高" if args.quality == "best" else args.quality
+    kinds = [k.strip().lower() for k in args.format.split(",") if k.strip()]
+    if not kinds or any(k not in ("mp4", "mp3", "flac") for k in kinds):
+        parser.error("-f 需為 mp4、mp3、flac，或以逗號分隔的組合（例：mp4,mp3）")
+    fmt_kind, extra_kinds = split_output_kinds(kinds)
+
+    reporter = BatchReporter()
+    try:
+        YtDlpLoader.ensure()     # 去重要用到擷取器的網址樣式
+    except Exception as e:
+        reporter.emit("summary", total=0, failed=0, error=f"無法載入 yt-dlp：{e}")
+        return 1
+    engine = DownloadEngine(reporter, max_workers=args.jobs, quiet=True,
+                            max_fragments=args.max_fragments,
+                            post_workers=args.post_workers, rate_limit=ratelimit,
+                            metrics_prom=os.path.abspath(args.metrics_prom) if args.metrics_prom else None)
+    unique, dropped = dedupe_urls(urls, keep_lists=len(urls) == 1)
+    for raw_url, same_as in dropped:
+        reporter.emit("duplicate", url=raw_url, same_as=same_as)
+    for url, _ in unique:
+        job = DownloadJob(url, fmt_kind, quality,
+                          password=args.password,
+                          use_cache=not args.no_cache,
+                          use_archive=not args.no_archive, extra_kinds=extra_kinds)
+        reporter.on_job_added(job)
+        engine.submit(job)
+
+    stop = threading.Event()
+
+    def _pump_progress():
+        last_depths = None
+        while not stop.wait(args.progress_interval):
+            reporter.report_progress(engine.progress)
+            depths = engine.stage_depths()
+            if depths != last_depths:
+                reporter.emit("stages", **depths)
+                last_depths = depths
+
+    threading.Thread(target=_pump_progress, daemon=True).start()
+    try:
+        engine.wait_all()
+    except KeyboardInterrupt:
+        for job in list(engine.jobs.values()):
+            engine.stop(job)
+        engine.wait_all()
+    finally:
+        stop.set()
+
+    failed = [j for j in engine.jobs.values() if j.failed]
+    reporter.emit("summary", total=len(engine.jobs), failed=len(failed), duplicates=len(dropped))
+    return 1 if failed else 0
+
+
+def run_startup_probe() -> int:
+    """
+    --startup-probe：開一次視窗，記下第一次畫出來與 yt-dlp 暖機完成的時間後關閉。
+    輸出絕對時間（time.time()），由 --startup-benchmark 扣掉它啟動子程序的時間。
+    """
+    reporter = BatchReporter()
+    if tk is None:
+        reporter.emit("probe", error="tkinter 不可用")
+        return 1
+    app = YTDownloaderGUI(journal=False)    # 量測用：不恢復、也不改寫使用者的工作日誌
+    app.wait_visibility()
+    app.update()
+    first_frame = time.time()
+    YtDlpLoader.ensure()
+    reporter.emit("probe", module_start=_PROCESS_T0, first_frame=first_frame,
+                  ready=max(first_frame, YtDlpLoader.ready_at))
+    app.destroy()
+    return 0
+
+
+def run_startup_benchmark(argv: list) -> int:
+    """
+    重複冷啟動 GUI，量「第一個畫面」與「可以開始下載」各花多久（自子程序啟動起算，含直譯器啟動）。
+    例：python video-download-gui.py --startup-benchmark --runs 10
+    """
+    import argparse
+    import statistics
+
+    parser = argparse.ArgumentParser(description="GUI 啟動時間量測")
+    parser.add_argument("--startup-benchmark", action="store_true")
+    parser.add_argument("--runs", type=int, default=STARTUP_BENCHMARK_RUNS, help="重複啟動次數")
+    args = parser.parse_args(argv)
+
+    reporter = BatchReporter()
+    first_frames, readies = [], []
+    for i in range(args.runs):
+        launched = time.time()
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-probe"],
+                              capture_output=True, text=True)
+        try:
+            rec = json.loads(proc.stdout.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            reporter.emit("run", run=i + 1, error=strip_ansi(proc.stderr.strip())[-500:])
+            return 1
+        if rec.get("error"):
+            reporter.emit("run", run=i + 1, error=rec["error"])
+            return 1
+        first_frames.append(rec["first_frame"] - launched)
+        readies.append(rec["ready"] - launched)
+        reporter.emit("run", run=i + 1, interpreter=round(rec["module_start"] - launched, 3),
+                      first_frame=round(first_frames[-1], 3), ready=round(readies[-1], 3))
+
+    def _stats(values):
+        return {"median": round(statistics.median(values), 3),
+                "min": round(min(values), 3), "max": round(max(values), 3)}
+
+    reporter.emit("summary", runs=args.runs, first_frame=_stats(first_frames), ready=_stats(readies))
+    return 0
+
+
+def _mp4_box(kind: bytes, *payload: bytes) -> bytes:
+    body = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+def build_synthetic_mp4(size: int, duration: float, kbps: int = 128) -> bytes:
+    """
+    不靠 ffmpeg 組出 read_audio_header 認得的 MP4：單一 AAC 音軌的 moov（faststart）加上隨機內容的 mdat。
+    內容無法播放，只求大小、標頭與 --benchmark 的後製探測一致。
+    """
+    rate = 44100
+    count = max(1, int(duration * rate / 1024))
+    sample = max(1, size // count)
+    ticks = count * 1024
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    esds = (b'\x00\x00\x00\x00' + b'\x03\x19\x00\x01\x00' + b'\x04\x11\x40\x15\x00\x00\x00'
+            + struct.pack('>II', kbps * 1000, kbps * 1000) + b'\x05\x02\x12\x10' + b'\x06\x01\x02')
+    mp4a = (b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 8
+            + struct.pack('>HHHHI', 2, 16, 0, 0, rate << 16) + _mp4_box(b'esds', esds))
+
+    def _moov(data_offset):
+        stbl = _mp4_box(b'stbl',
+                        _mp4_box(b'stsd', struct.pack('>II', 0, 1), _mp4_box(b'mp4a', mp4a)),
+                        _mp4_box(b'stts', struct.pack('>IIII', 0, 1, count, 1024)),
+                        _mp4_box(b'stsc', struct.pack('>IIIII', 0, 1, 1, count, 1)),
+                        _mp4_box(b'stsz', struct.pack('>III', 0, sample, count)),
+                        _mp4_box(b'stco', struct.pack('>III', 0, 1, data_offset)))
+        minf = _mp4_box(b'minf', _mp4_box(b'smhd', b'\x00' * 8),
+                        _mp4_box(b'dinf', _mp4_box(b'dref', struct.pack('>II', 0, 1),
+                                                   _mp4_box(b'url ', struct.pack('>I', 1)))),
+                        stbl)
+        mdia = _mp4_box(b'mdia',
+                        _mp4_box(b'mdhd', struct.pack('>IIIIIHH', 0, 0, 0, rate, ticks, 0x55c4, 0)),
+                        _mp4_box(b'hdlr', struct.pack('>II', 0, 0), b'soun', b'\x00' * 12, b'SoundHandler\x00'),
+                        minf)
+        tkhd = _mp4_box(b'tkhd', struct.pack('>IIIIII', 3, 0, 0, 1, 0, ticks), b'\x00' * 8,
+                        struct.pack('>HHHH', 0, 0, 0x0100, 0), matrix, struct.pack('>II', 0, 0))
+        mvhd = _mp4_box(b'mvhd', struct.pack('>IIIIII', 0, 0, 0, rate, ticks, 0x10000),
+                        struct.pack('>H', 0x0100), b'\x00' * 10, matrix, b'\x00' * 24, struct.pack('>I', 2))
+        return _mp4_box(b'moov', mvhd, _mp4_box(b'trak', tkhd, mdia))
+
+    ftyp = _mp4_box(b'ftyp', b'isom', struct.pack('>I', 512), b'isomiso2mp41')
+    head = len(ftyp) + len(_moov(0)) + 8
+    payload_len = sample * count
+    block = os.urandom(1 << 20)
+    payload = (block * (payload_len // len(block) + 1))[:payload_len]
+    return ftyp + _moov(head) + struct.pack('>I4s', 8 + payload_len, b'mdat') + payload
+
+def build_benchmark_media(size: int, duration: float) -> bytes:
+    """
+    有 ffmpeg 就用 lavfi 產生真正可轉檔的影片（mp3/flac 後製量到的才是實際成本），否則退回 build_synthetic_mp4。
+    """
+    if shutil.which('ffmpeg'):
+        out = os.path.abspath('benchmark-source.mp4')
+        video_kbps = max(100, int(size * 8 / duration / 1000) - 128)
+        try:
+            subprocess.run(
+                ['ffmpeg', '-v', 'error', '-y',
+                 '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30',
+                 '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+                 '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast',
+                 '-b:v', f'{video_kbps}k', '-c:a', 'aac', '-b:a', '128k',
+                 '-movflags', '+faststart', out],
+                check=True, capture_output=True, timeout=600)
+            with open(out, 'rb') as f:
+                return f.read()
+        except (OSError, subprocess.SubprocessError):
+            pass
+        finally:
+            if os.path.exists(out):
+                os.remove(out)
+    return build_synthetic_mp4(size, duration)
+
+def start_media_server(media: bytes, segments: int, duration: float, latency: float = 0.0,
+                       bandwidth: int | None = None, error_rate: float = 0.0):
+    """
+    --benchmark 用的本機媒體伺服器（背景執行緒），回傳 (server, base_url)。
+    - /info.json       ：給 BenchmarkIE 抽取用的中繼資料
+    - /media.mp4       ：一般 HTTP 下載，支援 Range
+    - /hls/index.m3u8、/seg/<i>：同一份檔案切成 segments 段，HLS/DASH 下載後拼回來就是原檔
+    latency 為每個請求回應前的延遲（秒），bandwidth 為每條連線的速率上限（bytes/s），
+    error_rate 為媒體請求（不含 info 與播放清單）直接回 503 的機率。
+    """
+    import http.server
+    import random
+
+    seg_len = -(-len(media) // segments)
+    seg_dur = duration / segments
+    view = memoryview(media)
+    info = json.dumps({'size': len(media), 'segments': segments, 'duration': duration}).encode()
+    playlist = ('#EXTM3U\n#EXT-X-VERSION:3\n'
+                f'#EXT-X-TARGETDURATION:{math.ceil(seg_dur)}\n#EXT-X-MEDIA-SEQUENCE:0\n'
+                + ''.join(f'#EXTINF:{seg_dur:.3f},\n/seg/{i}\n' for i in range(segments))
+                + '#EXT-X-ENDLIST\n').encode()
+
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'      # keep-alive，與真實 CDN 一樣可重用連線
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if latency:
+                time.sleep(latency)
+            if path == '/info.json':
+                return self._send(info, 'application/json')
+            if path == '/hls/index.m3u8':
+                return self._send(playlist, 'application/vnd.apple.mpegurl')
+            body = None
+            if path == '/media.mp4':
+                body = view
+            elif path.startswith('/seg/') and path[5:].isdigit():
+                i = int(path[5:])
+                if i < segments:
+                    body = view[i * seg_len:(i + 1) * seg_len]
+            if body is None:
+                return self.send_error(404)
+            if error_rate and random.random() < error_rate:
+                return self.send_error(503)
+            self._send(body, 'video/mp4', ranged=True)
+
+        def _send(self, body, ctype: str, ranged: bool = False):
+            total = len(body)
+            start, end = 0, total
+            m = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '') if ranged else None
+            if m and (m.group(1) or m.group(2)):
+                if m.group(1):
+                    start = int(m.group(1))
+                    end = min(int(m.group(2)) + 1, total) if m.group(2) else total
+                else:
+                    start = max(0, total - int(m.group(2)))
+                if start >= total:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{total}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{total}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            t0 = time.monotonic()
+            sent = 0
+            try:
+                for pos in range(start, end, 64 * 1024):
+                    chunk = body[pos:min(pos + 64 * 1024, end)]
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    if bandwidth:
+                        ahead = sent / bandwidth - (time.monotonic() - t0)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="benchmark-server", daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+def benchmark_extractor():
+    """
+    與 start_media_server 配對的假擷取器（需先 YtDlpLoader.ensure()）：
+    http://127.0.0.1:<port>/bench/<progressive|hls|dash>/<id>。
+    抽取時真的去抓 /info.json，量到的抽取成本包含一次本機 HTTP 往返與 yt-dlp 的格式處理。
+    """
+    from yt_dlp.extractor.common import InfoExtractor
+
+    class BenchmarkIE(InfoExtractor):
+        IE_NAME = 'benchmark'
+        _VALID_URL = r'(?P<base>https?://127\.0\.0\.1:\d+)/bench/(?P<proto>progressive|hls|dash)/(?P<id>[\w-]+)'
+
+        def _real_extract(self, url):
+            base, proto, video_id = self._match_valid_url(url).group('base', 'proto', 'id')
+            meta = self._download_json(f'{base}/info.json', video_id)
+            fmt = {'format_id': proto, 'ext': 'mp4', 'vcodec': 'avc1.64001f', 'acodec': 'mp4a.40.2',
+                   'width': 1280, 'height': 720}
+            if proto == 'progressive':
+                fmt.update(url=f'{base}/media.mp4', filesize=meta['size'])
+            elif proto == 'hls':
+                fmt.update(url=f'{base}/hls/index.m3u8', protocol='m3u8_native')
+            else:
+                seg_dur = meta['duration'] / meta['segments']
+                fmt.update(url=f'{base}/bench/dash', protocol='http_dash_segments',
+                           fragment_base_url=f'{base}/seg/', filesize_approx=meta['size'],
+                           fragments=[{'path': str(i), 'duration': seg_dur}
+                                      for i in range(meta['segments'])])
+            return {'id': video_id, 'title': video_id, 'duration': meta['duration'], 'formats': [fmt]}
+
+    return BenchmarkIE
+
+
+class _BenchmarkSession(NetworkSession):
+    def __init__(self, cookie_path: str, extractor):
+        super().__init__(cookie_path, quiet=True)
+        self.extractor = extractor
+
+    def open(self, opts: dict):
+        ydl = super().open(opts)
+        ydl.add_info_extractor(self.extractor())
+        return ydl
+
+
+class _BenchmarkListener(EngineListener):
+    def on_status(self, job, text):
+        if job is not None:
+            job.status = text
+
+
+class BenchmarkEngine(DownloadEngine):
+    """
+    --benchmark 用：照常走 download() → _hook → 後製程序池，只在各段前後記時間（perf_counter）。
+    工作目錄（輸出、下載紀錄、解析快取、cookie）都在暫存目錄，不碰使用者的檔案。
+    """
+    def __init__(self, workdir: str, extractor):
+        super().__init__(_BenchmarkListener(), max_workers=1, quiet=True, post_workers=1,
+                         data_dir=workdir, state_dir=workdir,
+                         session=_BenchmarkSession(os.path.join(workdir, 'cookies.txt'), extractor))
+        self.stats = {}
+        self.ui_ticks = 0
+        self.ui_seconds = 0.0
+
+    def _stat(self, job: DownloadJob) -> dict:
+        return self.stats.setdefault(job.id, {'hook_calls': 0, 'hook_seconds': 0.0})
+
+    def download(self, job: DownloadJob):
+        self._stat(job)['start'] = time.perf_counter()
+        super().download(job)
+
+    def _extract_info(self, ydl, job: DownloadJob) -> dict:
+        t0 = time.perf_counter()
+        try:
+            return super()._extract_info(ydl, job)
+        finally:
+            stat = self._stat(job)
+            if 'extracted' not in stat:     # HLS 清單過期重新解析不算在內
+                stat['extracted'] = time.perf_counter()
+                stat['extract_seconds'] = stat['extracted'] - t0
+
+    def _hook(self, job: DownloadJob, d):
+        t0 = time.perf_counter()
+        try:
+            super()._hook(job, d)
+        finally:
+            stat = self._stat(job)
+            stat['hook_calls'] += 1
+            stat['hook_seconds'] += time.perf_counter() - t0
+            if d.get('status') == 'downloading':
+                if d.get('downloaded_bytes') and 'first_byte' not in stat:
+                    stat['first_byte'] = t0
+            elif d.get('status') == 'finished':
+                stat['downloaded'] = t0
+                stat['bytes'] = d.get('total_bytes') or d.get('downloaded_bytes')
+
+    def _post_process(self, job: DownloadJob, path: str, duration, postprocessors: list):
+        self._stat(job)['post_start'] = time.perf_counter()
+        super()._post_process(job, path, duration, postprocessors)
+
+    def _post_process_done(self, job: DownloadJob, fut):
+        self._stat(job)['post_end'] = time.perf_counter()
+        super()._post_process_done(job, fut)
+
+    def flush_ui(self):
+        """
+        模擬 GUI 每一幀做的事（取出進度、格式化文字、統計階段深度），累計花掉的時間。
+        """
+        t0 = time.perf_counter()
+        for job, downloaded, total, speed, eta in self.progress.drain():
+            format_progress(downloaded, total, speed, eta)
+        format_stage_depths(self.stage_depths())
+        self.ui_seconds += time.perf_counter() - t0
+        self.ui_ticks += 1
+
+
+def run_benchmark(argv: list) -> int:
+    """
+    離線基準測試：本機伺服器提供合成的 progressive MP4 / HLS / DASH，BenchmarkIE 負責抽取，
+    真正的 download()、_hook 與後製程序池照常執行。每次執行輸出一行 JSON，最後是各情境的中位數。
+    例：python video-download-gui.py --benchmark --size 64 --latency 50 --bandwidth 20 --error-rate 0.02
+    """
+    import argparse
+    import statistics
+    import tempfile
+
+    YtDlpLoader.start()
+    parser = argparse.ArgumentParser(description="離線下載基準測試")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--size", type=float, default=BENCHMARK_MEDIA_MB, help="合成媒體大小（MB）")
+    parser.add_argument("--duration", type=float, default=BENCHMARK_MEDIA_SECONDS, help="合成媒體長度（秒）")
+    parser.add_argument("--segments", type=int, default=BENCHMARK_SEGMENTS, help="HLS/DASH 分段數")
+    parser.add_argument("--latency", type=float, default=0, help="每個請求的回應延遲（毫秒）")
+    parser.add_argument("--bandwidth", type=float, default=0, help="每條連線的速率上限 MB/s，0 代表不限")
+    parser.add_argument("--error-rate", type=float, default=0, help="媒體請求回 503 的機率（0~1）")
+    parser.add_argument("--runs", type=int, default=BENCHMARK_RUNS, help="每個情境執行幾次")
+    parser.add_argument("--protocols", default="progressive,hls,dash")
+    parser.add_argument("--formats", default="mp4,mp3,flac",
+                        help="後製預設；mp3/flac 只跑 progressive（後製成本與來源協定無關）")
+    parser.add_argument("--keep", action="store_true", help="保留暫存工作目錄")
+    args = parser.parse_args(argv)
+
+    reporter = BatchReporter()
+    protocols = [p for p in args.protocols.split(",") if p]
+    formats = [f for f in args.formats.split(",") if f]
+    scenarios = [(p, "mp4") for p in protocols if "mp4" in formats]
+    if "progressive" in protocols:
+        for fmt in formats:
+            if fmt in ("mp3", "flac"):
+                if shutil.which("ffmpeg"):
+                    scenarios.append(("progressive", fmt))
+                else:
+                    reporter.emit("skipped", protocol="progressive", format=fmt, reason="找不到 ffmpeg")
+
+    workdir = tempfile.mkdtemp(prefix="ytdl-benchmark-")
+    prev_cwd = os.getcwd()
+    os.chdir(workdir)          # 輸出目錄與下載紀錄資料庫都以目前目錄為準
+    server = None
+    try:
+        media = build_benchmark_media(int(args.size * 1024 * 1024), args.duration)
+        server, base = start_media_server(
+            media, args.segments, args.duration, latency=args.latency / 1000.0,
+            bandwidth=int(args.bandwidth * 1024 * 1024) or None, error_rate=args.error_rate)
+        reporter.emit("setup", size=len(media), segments=args.segments, latency_ms=args.latency,
+                      bandwidth=args.bandwidth, error_rate=args.error_rate, workdir=workdir)
+        YtDlpLoader.ensure()
+        engine = BenchmarkEngine(workdir, benchmark_extractor())
+
+        stop = threading.Event()
+
+        def _pump_ui():
+            while not stop.wait(1.0 / PROGRESS_FPS):
+                engine.flush_ui()
+
+        threading.Thread(target=_pump_ui, daemon=True).start()
+
+        results = {}
+        failed = 0
+        for proto, fmt in scenarios:
+            for i in range(args.runs):
+                job = DownloadJob(f"{base}/bench/{proto}/{proto}-{fmt}-{i + 1}", fmt, "原片最高",
+                                  use_cache=False, use_archive=False)
+                job.ie_key = 'Benchmark'
+                engine.submit(job)
+                job.finished.wait()
+                st = engine.stats.get(job.id, {})
+                if job.failed or 'downloaded' not in st:
+                    failed += 1
+                    reporter.emit("run", protocol=proto, format=fmt, run=i + 1, ok=False, status=job.status)
+                    continue
+                transfer = st['downloaded'] - st['extracted']
+                rec = {
+                    'mb_s': st['bytes'] / transfer / (1024 * 1024) if transfer > 0 else None,
+                    'ttfb_ms': (st['first_byte'] - st['extracted']) * 1000 if 'first_byte' in st else None,
+                    'extract_ms': st['extract_seconds'] * 1000,
+                    'hook_us': st['hook_seconds'] / st['hook_calls'] * 1e6 if st['hook_calls'] else None,
+                    'post_ms': (st['post_end'] - st['post_start']) * 1000 if 'post_end' in st else None,
+                }
+                results.setdefault((proto, fmt), []).append(rec)
+                # 重試後仍失敗的分片會換新清單接續，檔案仍應完整；refreshes 為接續次數
+                reporter.emit("run", protocol=proto, format=fmt, run=i + 1, ok=True,
+                              bytes=st['bytes'], complete=st['bytes'] == len(media),
+                              hook_calls=st['hook_calls'], refreshes=job.metrics.refreshes,
+                              **{k: round(v, 3) for k, v in rec.items() if v is not None})
+                if job.final_path and os.path.exists(job.final_path):
+                    os.remove(job.final_path)
+        stop.set()
+
+        for (proto, fmt), recs in results.items():
+            summary = {}
+            for key in ('mb_s', 'ttfb_ms', 'extract_ms', 'hook_us', 'post_ms'):
+                values = [r[key] for r in recs if r[key] is not None]
+                if values:
+                    summary[key] = round(statistics.median(values), 3)
+            reporter.emit("summary", protocol=proto, format=fmt, runs=len(recs), **summary)
+        if engine.ui_ticks:
+            reporter.emit("ui", ticks=engine.ui_ticks,
+                          flush_us=round(engine.ui_seconds / engine.ui_ticks * 1e6, 3))
+        return 1 if failed else 0
+    finally:
+        if server is not None:
+            server.shutdown()
+        os.chdir(prev_cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    if sys.argv[1:2] == ["--startup-probe"]:
+        sys.exit(run_startup_probe())
+    if sys.argv[1:2] == ["--startup-benchmark"]:
+        sys.exit(run_startup_benchmark(sys.argv[1:]))
+    if sys.argv[1:2] == ["--benchmark"]:
+        sys.exit(run_benchmark(sys.argv[1:]))
+    if len(sys.argv) > 1:
+        sys.exit(run_batch(sys.argv[1:]))
     app = YTDownloaderGUI()
     app.mainloop()